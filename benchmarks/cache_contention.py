@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""Measures how fast the reactor thread can store datapoints into the
+MetricCache while a writer thread drains it, and the longest a single store
+had to wait.
+
+The baseline is the original cache: one dict of lists behind one lock,
+drained by snapshotting counts() and popping the largest metrics first. The
+sharded cache is drained by its CACHE_WRITE_STRATEGY the way the writer does.
+It is measured storing one datapoint per store() call and storing the
+batches the receivers hand over with storeBatch(). A single store() costs more
+than the baseline's, so the receivers, the WAL replay, the snapshot load and
+the spill read-back all store batches; the store() rows show what is left
+for callers that only ever have one datapoint. Both drainers sleep for
+--write-cost seconds per update to stand in for the whisper write, which
+releases the GIL the same way.
+
+  benchmarks/cache_contention.py [--metrics N] [--points N] [--shards N] [--batch N] [--write-cost S]
+"""
+
+import sys
+import time
+import threading
+from optparse import OptionParser
+from os.path import dirname, abspath, join
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'lib'))
+
+from carbon.conf import settings
+from carbon.cache import ShardedMetricCache
+
+
+class BaselineCache(dict):
+  "The MetricCache as it was before sharding"
+  def __init__(self):
+    self.size = 0
+    self.lock = threading.Lock()
+
+  def store(self, metric, datapoint):
+    try:
+      self.lock.acquire()
+      self.setdefault(metric, []).append(datapoint)
+      self.size += 1
+    finally:
+      self.lock.release()
+    self.isFull()
+
+  def isFull(self):
+    return self.size >= settings.MAX_CACHE_SIZE
+
+  def pop(self, metric):
+    try:
+      self.lock.acquire()
+      datapoints = dict.pop(self, metric)
+      self.size -= len(datapoints)
+      return datapoints
+    finally:
+      self.lock.release()
+
+  def counts(self):
+    try:
+      self.lock.acquire()
+      return [ (metric, len(datapoints)) for (metric, datapoints) in self.items() ]
+    finally:
+      self.lock.release()
+
+
+def drainBaseline(cache, done, drained, writeCost):
+  while not done.isSet() or cache:
+    counts = cache.counts()
+    counts.sort(key=lambda item: item[1], reverse=True)
+    for metric, size in counts:
+      drained[0] += len(cache.pop(metric))
+      time.sleep(writeCost)
+
+
+def drainSharded(cache, done, drained, writeCost):
+  while not done.isSet() or cache:
+    metric = cache.strategy.chooseItem()
+    if metric is None:
+      time.sleep(0.001)
+      continue
+    drained[0] += len(cache.popQueue(metric))
+    time.sleep(writeCost)
+
+
+def run(cache, drain, metricCount, pointCount, batchSize, writeCost):
+  metrics = [ 'bench.host%d.metric%d' % (i % 100, i) for i in range(metricCount) ]
+  done = threading.Event()
+  drained = [0]
+  writerThread = threading.Thread(target=drain, args=(cache, done, drained, writeCost))
+  writerThread.start()
+
+  worstStall = 0.0
+  now = time.time()
+  start = time.time()
+  if batchSize:
+    for first in xrange(0, pointCount, batchSize):
+      batch = [ (metrics[i % metricCount], (now, float(i)))
+                for i in xrange(first, min(first + batchSize, pointCount)) ]
+      t = time.time()
+      cache.storeBatch(batch)
+      worstStall = max(worstStall, time.time() - t)
+  else:
+    store = cache.store
+    for i in xrange(pointCount):
+      t = time.time()
+      store(metrics[i % metricCount], (now, float(i)))
+      stall = time.time() - t
+      if stall > worstStall:
+        worstStall = stall
+  elapsed = time.time() - start
+
+  done.set()
+  writerThread.join()
+  assert drained[0] == pointCount
+  return pointCount / elapsed, worstStall
+
+
+def main():
+  parser = OptionParser()
+  parser.add_option('--metrics', type='int', default=20000)
+  parser.add_option('--points', type='int', default=300000)
+  parser.add_option('--shards', type='int', default=16)
+  parser.add_option('--batch', type='int', default=500, help="datapoints per storeBatch() call")
+  parser.add_option('--write-cost', type='float', default=0.0001, help="seconds each update holds the writer")
+  options, args = parser.parse_args()
+
+  runs = [
+    ('baseline', lambda: BaselineCache(), drainBaseline, 0),
+    ('store() 1 shard', lambda: ShardedMetricCache(1), drainSharded, 0),
+    ('store() %d shards' % options.shards, lambda: ShardedMetricCache(options.shards), drainSharded, 0),
+    ('storeBatch() %d shards' % options.shards, lambda: ShardedMetricCache(options.shards), drainSharded, options.batch),
+  ]
+  baselineRate = None
+  for label, makeCache, drain, batchSize in runs:
+    rate, stall = run(makeCache(), drain, options.metrics, options.points, batchSize, options.write_cost)
+    baselineRate = baselineRate or rate
+    print "%-22s %10.0f datapoints/sec (%.2fx)  worst stall %.4fs" % (label, rate, rate / baselineRate, stall)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""Reports the resident memory cost per cached datapoint, comparing the
+original list-of-tuples storage against the array-backed DatapointQueue.
+
+Each variant is measured in a forked child so one does not inherit the
+other's freed-but-not-returned heap.
+
+  benchmarks/cache_memory.py [--metrics N] [--points-per-metric N]
+"""
+
+import os
+import sys
+import time
+from optparse import OptionParser
+from os.path import dirname, abspath, join
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'lib'))
+
+from carbon.cache import ShardedMetricCache
+
+
+PAGESIZE = os.sysconf('SC_PAGESIZE')
+
+
+def rss():
+  return int( open('/proc/self/statm').read().split()[1] ) * PAGESIZE
+
+
+def fillLists(metrics, pointsPerMetric):
+  cache = {}
+  now = time.time()
+  for i in xrange(pointsPerMetric):
+    for metric in metrics:
+      cache.setdefault(metric, []).append( (now + i, float(i)) )
+  return cache
+
+
+def fillArrays(metrics, pointsPerMetric):
+  cache = ShardedMetricCache()
+  now = time.time()
+  for i in xrange(pointsPerMetric):
+    for metric in metrics:
+      cache.store(metric, (now + i, float(i)))
+  return cache
+
+
+def measure(fill, metrics, pointsPerMetric):
+  readFd, writeFd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(readFd)
+    before = rss()
+    cache = fill(metrics, pointsPerMetric)
+    os.write(writeFd, str(rss() - before))
+    os._exit(0)
+
+  os.close(writeFd)
+  result = int( os.read(readFd, 64) )
+  os.waitpid(pid, 0)
+  return result
+
+
+def main():
+  parser = OptionParser()
+  parser.add_option('--metrics', type='int', default=100000)
+  parser.add_option('--points-per-metric', type='int', default=60)
+  options, args = parser.parse_args()
+
+  metrics = [ 'bench.host%d.metric%d' % (i % 100, i) for i in range(options.metrics) ]
+  totalPoints = options.metrics * options.points_per_metric
+
+  for label, fill in (('list of tuples', fillLists), ('DatapointQueue', fillArrays)):
+    used = measure(fill, metrics, options.points_per_metric)
+    print "%-15s %12d points %8.1f MB %8.1f bytes/point" % (
+      label, totalPoints, used / 1048576.0, float(used) / totalPoints)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""Compares the pickle and columnar protocols between carbon daemons: bytes
+on the wire per datapoint, and CPU time per datapoint to encode a message
+the way CarbonClientProtocol does and to decode it the way the receivers do.
+The same --metrics metrics are sent every round, in messages of
+MAX_DATAPOINTS_PER_MESSAGE datapoints, so the columnar protocol only sends
+their names in the first round. The best of --repeat runs is reported.
+
+  benchmarks/columnar_protocol.py [--metrics N] [--rounds N] [--repeat N]
+"""
+
+import sys
+import time
+from optparse import OptionParser
+from os.path import dirname, abspath, join
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'lib'))
+
+from carbon.conf import settings
+from carbon.util import pickle, RestrictedUnpickler, parseDatapoints
+from carbon.columnar import ColumnarEncoder, ColumnarDecoder
+
+
+class PickleCodec(object):
+  name = 'pickle'
+
+  def encode(self, datapoints):
+    return pickle.dumps(datapoints, protocol=-1)
+
+  def decode(self, message):
+    return parseDatapoints(RestrictedUnpickler.loads(message))
+
+
+class ColumnarCodec(object):
+  def __init__(self, compressionLevel):
+    self.name = 'columnar' if not compressionLevel else 'columnar zlib %d' % compressionLevel
+    self.encoder = ColumnarEncoder(compressionLevel)
+    self.decoder = ColumnarDecoder()
+
+  def encode(self, datapoints):
+    return self.encoder.encode(datapoints)
+
+  def decode(self, message):
+    return self.decoder.decode(message)
+
+
+def run(makeCodec, batches):
+  "Returns (bytes sent, encode seconds, decode seconds)"
+  codec = makeCodec()
+  sent, encodeTime, decodeTime = 0, 0.0, 0.0
+  for batch in batches:
+    started = time.time()
+    message = codec.encode(batch)
+    encoded = time.time()
+    codec.decode(message)
+    encodeTime += encoded - started
+    decodeTime += time.time() - encoded
+    sent += len(message) + 4 # Int32StringReceiver length prefix
+  return sent, encodeTime, decodeTime, codec.name
+
+
+def main():
+  parser = OptionParser(usage="%prog [options]")
+  parser.add_option('--metrics', type='int', default=10000)
+  parser.add_option('--rounds', type='int', default=10)
+  parser.add_option('--repeat', type='int', default=3)
+  options, args = parser.parse_args()
+
+  now = int(time.time())
+  metrics = [ 'bench.host%d.cpu%d.metric%d' % (i % 100, i % 8, i) for i in xrange(options.metrics) ]
+  datapoints = [ (metric, (now + r * 60, float(i % 1000) / 7))
+                 for r in xrange(options.rounds)
+                 for (i, metric) in enumerate(metrics) ]
+  size = settings.MAX_DATAPOINTS_PER_MESSAGE
+  batches = [ datapoints[i:i + size] for i in xrange(0, len(datapoints), size) ]
+  points = float(len(datapoints))
+
+  print "%d datapoints of %d metrics, %d datapoints per message" % (len(datapoints), options.metrics, size)
+  print "%-18s %12s %14s %14s" % ('protocol', 'bytes/point', 'encode us/pt', 'decode us/pt')
+  for makeCodec in (PickleCodec, lambda: ColumnarCodec(0), lambda: ColumnarCodec(1), lambda: ColumnarCodec(6)):
+    results = [ run(makeCodec, batches) for i in xrange(options.repeat) ]
+    sent, name = results[0][0], results[0][3]
+    encodeTime = min([ result[1] for result in results ])
+    decodeTime = min([ result[2] for result in results ])
+    print "%-18s %12.1f %14.2f %14.2f" % (name, sent / points,
+                                          encodeTime / points * 1e6, decodeTime / points * 1e6)
+
+
+if __name__ == '__main__':
+  main()
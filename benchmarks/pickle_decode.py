@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""Measures how fast the pickle receiver can turn messages into datapoints:
+SafeUnpickler.loads() and the float() coercion loop the receiver used to
+run, the same loop after an insecure cPickle.loads() (USE_INSECURE_UNPICKLER),
+and RestrictedUnpickler.loads() followed by parseDatapoints(). Messages
+are pickled the way carbon-relay sends them. The best of --repeat runs of
+each is reported.
+
+  benchmarks/pickle_decode.py [--messages N] [--points N] [--repeat N]
+"""
+
+import sys
+import time
+from optparse import OptionParser
+from os.path import dirname, abspath, join
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'lib'))
+
+from carbon.util import pickle, SafeUnpickler, RestrictedUnpickler, parseDatapoints
+
+
+def coerce(datapoints):
+  "The loop MetricPickleReceiver ran over every message before parseDatapoints()"
+  batch = []
+  for (metric, datapoint) in datapoints:
+    try:
+      datapoint = ( float(datapoint[0]), float(datapoint[1]) )
+    except:
+      continue
+    batch.append((metric, datapoint))
+  return batch
+
+
+def safe(message):
+  return coerce(SafeUnpickler.loads(message))
+
+
+def insecure(message):
+  return coerce(pickle.loads(message))
+
+
+def restricted(message):
+  return parseDatapoints(RestrictedUnpickler.loads(message))
+
+
+def run(decode, messages):
+  start = time.time()
+  for message in messages:
+    decode(message)
+  return time.time() - start
+
+
+def main():
+  parser = OptionParser(usage="%prog [options]")
+  parser.add_option('--messages', type='int', default=2000)
+  parser.add_option('--points', type='int', default=500, help="datapoints per message")
+  parser.add_option('--repeat', type='int', default=5)
+  options, args = parser.parse_args()
+
+  now = int(time.time())
+  messages = []
+  for i in xrange(options.messages):
+    datapoints = [ ('bench.host%d.metric%d' % (j % 100, j), (now + i, float(j)))
+                   for j in xrange(options.points) ]
+    messages.append(pickle.dumps(datapoints, protocol=-1))
+
+  points = options.messages * options.points
+  print "%d messages of %d datapoints" % (options.messages, options.points)
+  baseline = None
+  for decode in (safe, insecure, restricted):
+    elapsed = min([ run(decode, messages) for i in xrange(options.repeat) ])
+    rate = points / elapsed
+    if baseline is None:
+      baseline = rate
+    print "%-12s %10.0f datapoints/sec (%.2fx)" % (decode.__name__, rate, rate / baseline)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""Measures how fast a CarbonClientFactory takes datapoints and sends them to
+a connected destination, and how many timers it puts on the reactor doing
+so. Datapoints are fed in from the reactor --tick at a time, the way a busy
+relay's receivers hand them over, to a destination that is a StringTransport.
+
+  benchmarks/relay_send.py [--points N] [--metrics N] [--tick N]
+"""
+
+import sys
+import time
+from optparse import OptionParser
+from os.path import dirname, abspath, join
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'lib'))
+
+from twisted.internet import reactor
+from twisted.test.proto_helpers import StringTransport
+
+from carbon.conf import settings
+from carbon import client
+
+
+class Run(object):
+  """Stands in for the reactor in carbon.client, counting the timers it
+  schedules"""
+  def __init__(self, pointCount, metricCount, tick):
+    self.pointCount = pointCount
+    self.tick = tick
+    self.metrics = [ 'bench.host%d.metric%d' % (i % 100, i) for i in xrange(metricCount) ]
+    self.scheduled = 0
+    self.mostPending = 0
+    self.factory = client.CarbonClientFactory(('127.0.0.1', 2004, None))
+    self.transport = StringTransport()
+    self.factory.buildProtocol(None).makeConnection(self.transport)
+
+  def callLater(self, *args, **kwargs):
+    self.scheduled += 1
+    return reactor.callLater(*args, **kwargs)
+
+  def __getattr__(self, name):
+    return getattr(reactor, name)
+
+  def feed(self, start):
+    now = time.time()
+    metrics, metricCount = self.metrics, len(self.metrics)
+    sendDatapoint = self.factory.sendDatapoint
+    for i in xrange(start, min(start + self.tick, self.pointCount)):
+      sendDatapoint(metrics[i % metricCount], (now, float(i)))
+    self.mostPending = max(self.mostPending, len(reactor.getDelayedCalls()))
+    self.transport.clear()
+    if start + self.tick < self.pointCount:
+      reactor.callLater(0, self.feed, start + self.tick)
+    else:
+      self.drain()
+
+  def drain(self):
+    self.transport.clear()
+    if self.factory.hasQueuedDatapoints() or reactor.getDelayedCalls():
+      reactor.callLater(0, self.drain)
+    else:
+      self.elapsed = time.time() - self.started
+      reactor.stop()
+
+  def __call__(self):
+    client.reactor = self
+    self.started = time.time()
+    reactor.callWhenRunning(self.feed, 0)
+    reactor.run()
+    return self.pointCount / self.elapsed
+
+
+def main():
+  parser = OptionParser(usage="%prog [options]")
+  parser.add_option('--points', type='int', default=300000)
+  parser.add_option('--metrics', type='int', default=10000)
+  parser.add_option('--tick', type='int', default=1000, help="datapoints received per reactor iteration")
+  options, args = parser.parse_args()
+
+  settings.MAX_QUEUE_SIZE = float('inf')
+  run = Run(options.points, options.metrics, options.tick)
+  rate = run()
+  print "%d datapoints, %d per reactor iteration" % (options.points, options.tick)
+  print "throughput          %10.0f datapoints/sec" % rate
+  print "timers scheduled    %10d" % run.scheduled
+  print "most timers pending %10d" % run.mostPending
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""Measures how fast datapoints can be stored into the MetricCache with and
+without a WriteAheadLog (ENABLE_WAL). With the log every store is buffered
+and each batch of --batch datapoints is committed and fsynced by the commit
+thread, the way WAL_SYNC_INTERVAL batches them in carbon-cache. The best of
+--repeat runs of each is reported.
+
+  benchmarks/wal_ingest.py [--metrics N] [--points N] [--batch N] [--repeat N]
+"""
+
+import sys
+import time
+import shutil
+import tempfile
+import threading
+from optparse import OptionParser
+from os.path import dirname, abspath, join
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'lib'))
+
+from carbon.conf import settings
+from carbon.cache import ShardedMetricCache
+from carbon.wal import WriteAheadLog
+
+
+def run(metricCount, pointCount, batchSize, directory=None):
+  cache = ShardedMetricCache(settings.CACHE_SHARDS)
+  metrics = [ 'bench.host%d.metric%d' % (i % 100, i) for i in xrange(metricCount) ]
+
+  wal = None
+  if directory is not None:
+    wal = WriteAheadLog(directory, cache)
+    cache.setWriteAheadLog(wal)
+    wal.thread = threading.Thread(target=wal.commitForever)
+    wal.thread.start()
+
+  now = int(time.time())
+  stored = 0
+  start = time.time()
+  for i in xrange(pointCount):
+    datapoint = (now + i, float(i))
+    for metric in metrics:
+      cache.store(metric, datapoint)
+      stored += 1
+      if wal is not None and stored % batchSize == 0:
+        wal.sync()
+
+  if wal is not None:
+    wal.sync()
+    wal.commits.put(None)
+    wal.thread.join()
+  return stored / (time.time() - start)
+
+
+def main():
+  parser = OptionParser(usage="%prog [options]")
+  parser.add_option('--metrics', type='int', default=10000)
+  parser.add_option('--points', type='int', default=50, help="datapoints per metric")
+  parser.add_option('--batch', type='int', default=50000, help="datapoints per WAL commit")
+  parser.add_option('--repeat', type='int', default=3)
+  options, args = parser.parse_args()
+
+  plain, logged = 0, 0
+  for i in xrange(options.repeat):
+    plain = max(plain, run(options.metrics, options.points, options.batch))
+    directory = tempfile.mkdtemp()
+    try:
+      logged = max(logged, run(options.metrics, options.points, options.batch, directory))
+    finally:
+      shutil.rmtree(directory)
+
+  print "%d metrics, %d datapoints, %d datapoints per commit" % (
+    options.metrics, options.metrics * options.points, options.batch)
+  print "MetricCache.store            %10.0f datapoints/sec" % plain
+  print "MetricCache.store with WAL   %10.0f datapoints/sec (%.1f%% slower)" % (
+    logged, (1 - logged / plain) * 100)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""Reports the per-update latency of writing a few datapoints to each of a set
+of whisper files round-robin, opening the file for every update as
+whisper.update_many() does versus keeping the files open in a
+WhisperFileCache (WHISPER_FILE_CACHE_SIZE).
+
+  benchmarks/whisper_files.py [--files N] [--rounds N] [--points N]
+"""
+
+import sys
+import time
+import shutil
+import tempfile
+from optparse import OptionParser
+from os.path import dirname, abspath, join
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'lib'))
+
+import whisper
+from carbon.conf import settings
+
+settings.setdefault('CONF_DIR', tempfile.gettempdir())
+from carbon.storage import WhisperFileCache
+
+
+def run(update, paths, rounds, pointsPerUpdate):
+  now = int(time.time())
+  updates = 0
+  start = time.time()
+  for i in xrange(rounds):
+    timestamp = now - (rounds - i) * 60
+    points = [ (timestamp + j, float(j)) for j in xrange(pointsPerUpdate) ]
+    for path in paths:
+      update(path, points)
+      updates += 1
+  return (time.time() - start) / updates
+
+
+def main():
+  parser = OptionParser(usage="%prog [options]")
+  parser.add_option('--files', type='int', default=1000)
+  parser.add_option('--rounds', type='int', default=20)
+  parser.add_option('--points', type='int', default=3, help="datapoints per update")
+  options, args = parser.parse_args()
+
+  directory = tempfile.mkdtemp()
+  try:
+    paths = [ join(directory, 'metric%d.wsp' % i) for i in xrange(options.files) ]
+    for path in paths:
+      whisper.create(path, [(1, 86400), (60, 10080)])
+
+    uncached = run(whisper.update_many, paths, options.rounds, options.points)
+
+    whisper.CACHE_HEADERS = True
+    files = WhisperFileCache(options.files)
+    cached = run(files.update_many, paths, options.rounds, options.points)
+    files.closeAll()
+  finally:
+    shutil.rmtree(directory)
+
+  print "%d files, %d updates of %d points each" % (options.files, options.files * options.rounds, options.points)
+  print "whisper.update_many           %8.1f usec/update" % (uncached * 1e6)
+  print "WhisperFileCache.update_many  %8.1f usec/update (%.2fx)" % (cached * 1e6, uncached / cached)
+
+
+if __name__ == '__main__':
+  main()
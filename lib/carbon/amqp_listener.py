@@ -110,6 +110,8 @@ class AMQPGraphiteProtocol(AMQClient):
 
         metric = message.routing_key
 
+        # Posted together so the cache takes each shard's lock once per message
+        batch = []
         for line in message.content.body.split("\n"):
             line = line.strip()
             if not line:
@@ -126,12 +128,15 @@ class AMQPGraphiteProtocol(AMQClient):
                 log.listener("invalid message line: %s" % (line,))
                 continue
 
-            events.metricReceived(metric, datapoint)
+            batch.append((metric, datapoint))
 
             if self.factory.verbose:
                 log.listener("Metric posted: %s %s %s" %
                              (metric, value, timestamp,))
 
+        if batch:
+            events.metricsReceivedBatch(batch)
+
 
 class AMQPReconnectingFactory(ReconnectingClientFactory):
     """The reconnecting factory.
@@ -12,14 +12,151 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License."""
 
-from threading import Lock
+import os
+import time
+import marshal
+from array import array
+from collections import deque
+from heapq import heapify, heappush, heappop
+from itertools import izip
+from threading import Lock, Condition
 from carbon.conf import settings
+from carbon.exceptions import CarbonConfigException
 
 
-class MetricCache(dict):
+UNLIMITED = float('inf')
+
+# Approximate memory cost of cached datapoints, as measured by
+# benchmarks/cache_memory.py: each queue costs QUEUE_BYTES plus the length of
+# the metric name, each datapoint POINT_BYTES including the arrays' slack.
+QUEUE_BYTES = 430
+POINT_BYTES = 18
+
+# The shards are dicts that define their own get()
+getQueue = dict.get
+
+# Stale arrivals beyond twice the number of queues in a shard, plus this, get
+# compacted away
+ARRIVALS_SLACK = 1000
+
+
+class DatapointQueue(object):
+  """Datapoints for one metric kept in parallel arrays of doubles, which is
+  16 bytes per point instead of a tuple and two float objects. created is
+  when the first of the queued datapoints arrived and deadline when they are
+  due to be written, if the cache has write deadlines."""
+  __slots__ = ('timestamps', 'values', 'created', 'deadline')
+  step = 0 # see CoalescingQueue
+
   def __init__(self):
+    self.timestamps = array('d')
+    self.values = array('d')
+    self.created = time.time()
+    self.deadline = None
+
+  def append(self, datapoint):
+    "Returns False if datapoint was merged into the last one"
+    self.timestamps.append(datapoint[0])
+    self.values.append(datapoint[1])
+    return True
+
+  def __len__(self):
+    return len(self.timestamps)
+
+  def __iter__(self):
+    return izip(self.timestamps, self.values)
+
+  def datapoints(self):
+    "Returns a list of (timestamp, value) tuples, as whisper.update_many expects"
+    return zip(self.timestamps, self.values)
+
+
+class CoalescingQueue(DatapointQueue):
+  """A DatapointQueue that replaces the last datapoint with one falling in
+  the same step-aligned interval, as whisper would. Only the last value is
+  kept because the writer may already have written part of an interval,
+  anything combining the values would overwrite that on disk."""
+  __slots__ = ('step',)
+
+  def __init__(self, step):
+    DatapointQueue.__init__(self)
+    self.step = step
+
+  def append(self, datapoint):
+    step = self.step
+    if self.timestamps:
+      timestamp = datapoint[0]
+      last = self.timestamps[-1]
+      if timestamp - timestamp % step == last - last % step:
+        self.timestamps[-1] = timestamp
+        self.values[-1] = datapoint[1]
+        return False
+    return DatapointQueue.append(self, datapoint)
+
+
+class MetricCacheShard(dict):
+  """A slice of the MetricCache with its own lock and size counter. Each
+  metric always lives in the same shard, so the reactor thread storing one
+  metric never waits on the writer thread popping a metric from another
+  shard.
+
+  Metrics are also indexed by the power of two their queue size falls in, so
+  the writer can find a (nearly) largest queue without sorting every queue in
+  the cache. buckets[n] holds the metrics whose queue size has a bit length
+  of n and topBucket is an upper bound on the highest non-empty bucket.
+
+  coalesce, if set, returns the step a new metric's queue coalesces
+  datapoints in. coalesced counts the datapoints merged and invalid the
+  ones dropped because their timestamp or value isn't a double.
+
+  deadline, if set, returns how many seconds after it is created a new
+  metric's queue is due to be written. The queues are indexed by their
+  deadline in a heap and the metrics whose queue holds batchSize datapoints
+  are kept in a set, so dueQueues() only looks at the queues that are due."""
+  def __init__(self, coalesce=None):
+    dict.__init__(self)
     self.size = 0
+    self.queueBytes = 0
+    self.coalesce = coalesce
+    self.coalesced = 0
+    self.invalid = 0
     self.lock = Lock()
+    self.buckets = [ set() for i in range(64) ]
+    self.topBucket = 0
+    self.arrivals = None # deque of (metric, created), only kept for 'oldest'
+    self.deadline = None
+    self.batchSize = 0
+    self.deadlines = [] # heap of (deadline, metric, created)
+    self.batched = set()
+
+  def setDeadlines(self, deadline, batchSize):
+    try:
+      self.lock.acquire()
+      self.deadline = deadline
+      self.batchSize = batchSize
+      self.deadlines = []
+      self.batched = set()
+      if deadline is None:
+        return
+      for (metric, queue) in self.items():
+        queue.deadline = queue.created + deadline(metric)
+        self.deadlines.append((queue.deadline, metric, queue.created))
+        if len(queue) >= batchSize:
+          self.batched.add(metric)
+      heapify(self.deadlines)
+    finally:
+      self.lock.release()
+
+  def trackArrivals(self, enabled):
+    try:
+      self.lock.acquire()
+      if enabled:
+        arrivals = sorted([ (queue.created, metric) for (metric, queue) in self.items() ])
+        self.arrivals = deque([ (metric, created) for (created, metric) in arrivals ])
+      else:
+        self.arrivals = None
+    finally:
+      self.lock.release()
 
   def __setitem__(self, key, value):
     raise TypeError("Use store() method instead!")
@@ -27,37 +164,749 @@ class MetricCache(dict):
   def store(self, metric, datapoint):
     try:
       self.lock.acquire()
-      self.setdefault(metric, []).append(datapoint)
-      self.size += 1
+      self.storeLocked([(metric, datapoint)])
     finally:
       self.lock.release()
 
-    if self.isFull():
-      log.msg("MetricCache is full: self.size=%d" % self.size)
-      state.events.cacheFull()
+  def storeMany(self, datapoints):
+    "Stores a list of (metric, datapoint) under one acquisition of the lock"
+    try:
+      self.lock.acquire()
+      self.storeLocked(datapoints)
+    finally:
+      self.lock.release()
 
-  def isFull(self):
-    return self.size >= settings.MAX_CACHE_SIZE
+  def storeLocked(self, datapoints):
+    # This runs for every datapoint received, so it takes a whole list per
+    # call and inlines DatapointQueue.append() and len() for queues that
+    # don't coalesce
+    batchSize = self.batchSize
+    added = 0
+    try:
+      for (metric, datapoint) in datapoints:
+        # Converted before anything is changed, a number a double can't hold
+        # drops just this datapoint instead of leaving a timestamp without
+        # its value or an empty queue behind
+        try:
+          timestamp = float(datapoint[0])
+          value = float(datapoint[1])
+        except (TypeError, ValueError, OverflowError, IndexError):
+          self.invalid += 1
+          continue
+
+        # Most datapoints arrive after the writer popped their metric's queue,
+        # raising KeyError for those would cost more than the get() call
+        queue = getQueue(self, metric)
+        if queue is None:
+          step = 0 if self.coalesce is None else self.coalesce(metric)
+          if step:
+            queue = CoalescingQueue(step)
+          else:
+            queue = DatapointQueue()
+          dict.__setitem__(self, metric, queue)
+          self.queueBytes += QUEUE_BYTES + len(metric)
+          if self.arrivals is not None:
+            self.arrivals.append((metric, queue.created))
+          if self.deadline is not None:
+            queue.deadline = queue.created + self.deadline(metric)
+            heappush(self.deadlines, (queue.deadline, metric, queue.created))
+        timestamps = queue.timestamps
+        if queue.step:
+          if not queue.append((timestamp, value)):
+            self.coalesced += 1
+            continue
+        else:
+          timestamps.append(timestamp)
+          queue.values.append(value)
+        added += 1
+
+        # Only move buckets when the queue size crosses a power of two
+        queueSize = len(timestamps)
+        if queueSize & (queueSize - 1) == 0 or queueSize == batchSize:
+          self.grew(metric, queueSize)
+    finally:
+      self.size += added
+
+  def grew(self, metric, queueSize):
+    """Indexes a queue that just grew to queueSize datapoints, a power of two
+    or batchSize"""
+    if queueSize & (queueSize - 1) == 0:
+      bucket = queueSize.bit_length()
+      self.buckets[bucket - 1].discard(metric)
+      self.buckets[bucket].add(metric)
+      if bucket > self.topBucket:
+        self.topBucket = bucket
+    if queueSize == self.batchSize:
+      self.batched.add(metric)
+
+  def popQueue(self, metric):
+    try:
+      self.lock.acquire()
+      queue = dict.pop(self, metric)
+      self.size -= len(queue)
+      self.queueBytes -= QUEUE_BYTES + len(metric)
+      self.buckets[len(queue).bit_length()].discard(metric)
+      # oldest() only trims stale arrivals off the head, behind a queue that
+      # isn't being written they would pile up
+      arrivals = self.arrivals
+      if arrivals is not None and len(arrivals) > 2 * len(self) + ARRIVALS_SLACK:
+        self.compactArrivals()
+      # The same goes for the deadlines of queues written before they were due
+      self.batched.discard(metric)
+      if len(self.deadlines) > 2 * len(self) + ARRIVALS_SLACK:
+        self.compactDeadlines()
+      return queue
+    finally:
+      self.lock.release()
+
+  def isLive(self, metric, created):
+    "Whether metric's queue is the one created at created, the lock must be held"
+    queue = dict.get(self, metric)
+    return queue is not None and queue.created == created
+
+  def compactArrivals(self):
+    "Drops the arrivals of popped queues, the lock must be held"
+    self.arrivals = deque([ (metric, created) for (metric, created) in self.arrivals
+                            if self.isLive(metric, created) ])
+
+  def compactDeadlines(self):
+    "Drops the deadlines of popped queues, the lock must be held"
+    self.deadlines = [ entry for entry in self.deadlines if self.isLive(entry[1], entry[2]) ]
+    heapify(self.deadlines)
+
+  def dueQueues(self, now):
+    """Returns the (metric, DatapointQueue) pairs due to be written at now:
+    past their deadline or holding batchSize datapoints"""
+    try:
+      self.lock.acquire()
+      due = {}
+      deadlines = self.deadlines
+      while deadlines and deadlines[0][0] <= now:
+        entry = heappop(deadlines)
+        if self.isLive(entry[1], entry[2]):
+          due[entry[1]] = entry
+      # Due queues stay indexed until they are popped, in case the writer
+      # stops before writing them
+      for entry in due.values():
+        heappush(deadlines, entry)
+      for metric in self.batched:
+        due[metric] = None
+      return [ (metric, dict.__getitem__(self, metric)) for metric in due ]
+    finally:
+      self.lock.release()
 
   def pop(self, metric):
+    return self.popQueue(metric).datapoints()
+
+  def largest(self):
+    """Returns (bucket, metric) for a metric in the highest non-empty size
+    bucket, or (0, None) if the shard is empty"""
+    try:
+      self.lock.acquire()
+      buckets = self.buckets
+      while self.topBucket and not buckets[self.topBucket]:
+        self.topBucket -= 1
+      if not self.topBucket:
+        return (0, None)
+      for metric in buckets[self.topBucket]:
+        return (self.topBucket, metric)
+    finally:
+      self.lock.release()
+
+  def oldest(self):
+    """Returns (created, metric) for the queue whose first datapoint arrived
+    earliest, or (None, None) if the shard is empty. Entries for queues that
+    have since been popped are discarded lazily."""
     try:
       self.lock.acquire()
-      datapoints = dict.pop(self, metric)
-      self.size -= len(datapoints)
-      return datapoints
+      arrivals = self.arrivals
+      while arrivals:
+        metric, created = arrivals[0]
+        queue = dict.get(self, metric)
+        if queue is not None and queue.created == created:
+          return (created, metric)
+        arrivals.popleft()
+      return (None, None)
+    finally:
+      self.lock.release()
+
+  def get(self, metric, default=None):
+    try:
+      self.lock.acquire()
+      queue = dict.get(self, metric)
+      if queue is None:
+        return default
+      return queue.datapoints()
     finally:
       self.lock.release()
 
   def counts(self):
     try:
       self.lock.acquire()
-      return [ (metric, len(datapoints)) for (metric, datapoints) in self.items() ]
+      return [ (metric, len(queue)) for (metric, queue) in self.items() ]
     finally:
       self.lock.release()
 
+  def queues(self):
+    try:
+      self.lock.acquire()
+      return self.items()
+    finally:
+      self.lock.release()
+
+
+class ShardGroup(object):
+  """Operations over a group of MetricCacheShards. Metrics are looked up via
+  shardFor(), the group only needs to own the shards it iterates over."""
+  shards = []
+
+  def shardFor(self, metric):
+    raise NotImplementedError()
+
+  @property
+  def size(self):
+    return sum([shard.size for shard in self.shards])
+
+  @property
+  def bytes(self):
+    "Approximate memory used by the cached datapoints"
+    return sum([shard.size * POINT_BYTES + shard.queueBytes for shard in self.shards])
+
+  def __len__(self):
+    return sum([len(shard) for shard in self.shards])
+
+  def __nonzero__(self):
+    for shard in self.shards:
+      if shard:
+        return True
+    return False
+
+  def __contains__(self, metric):
+    return metric in self.shardFor(metric)
+
+  def __iter__(self):
+    for shard in self.shards:
+      for metric in shard.keys():
+        yield metric
+
+  def pop(self, metric):
+    return self.shardFor(metric).pop(metric)
+
+  def popQueue(self, metric):
+    return self.shardFor(metric).popQueue(metric)
+
+  def get(self, metric, default=None):
+    return self.shardFor(metric).get(metric, default)
+
+  def counts(self):
+    counts = []
+    for shard in self.shards:
+      counts.extend(shard.counts())
+    return counts
+
+  def queues(self):
+    "Generates the (metric, DatapointQueue) pairs in the group"
+    for shard in self.shards:
+      for item in shard.queues():
+        yield item
+
+  def largestMetric(self):
+    """Returns a metric whose queue is within a factor of two of the largest
+    queue in the group, or None if it is empty. This only looks at the size
+    index of each shard, it never snapshots or sorts the queues."""
+    bestBucket, bestMetric = 0, None
+    for shard in self.shards:
+      bucket, metric = shard.largest()
+      if bucket > bestBucket:
+        bestBucket, bestMetric = bucket, metric
+    return bestMetric
+
+  def oldestQueue(self):
+    """Returns (created, metric) for the queue with the longest waiting
+    datapoint or (None, None) if the group is empty, needs arrival tracking"""
+    bestCreated, bestMetric = None, None
+    for shard in self.shards:
+      created, metric = shard.oldest()
+      if created is not None and (bestCreated is None or created < bestCreated):
+        bestCreated, bestMetric = created, metric
+    return (bestCreated, bestMetric)
+
+  def oldestMetric(self):
+    "Returns the metric with the longest waiting datapoint, needs arrival tracking"
+    return self.oldestQueue()[1]
+
+  def dueQueues(self, now):
+    """Returns the (metric, DatapointQueue) pairs in the group due to be
+    written at now, needs write deadlines"""
+    due = []
+    for shard in self.shards:
+      due.extend(shard.dueQueues(now))
+    return due
+
+  def overdueMetric(self, createdBefore):
+    """Returns the metric with the longest waiting datapoint if its queue was
+    created before createdBefore, otherwise None, needs arrival tracking"""
+    created, metric = self.oldestQueue()
+    if created is not None and created < createdBefore:
+      return metric
+    return None
+
+
+class ShardedMetricCache(ShardGroup):
+  """Metric name -> datapoints cache split into CACHE_SHARDS independently
+  locked shards, picked by the hash of the metric name. The shards are dealt
+  out to WRITER_THREADS partitions so that each writer thread drains a
+  disjoint slice of the metric space."""
+  wal = None # carbon.wal.WriteAheadLog when ENABLE_WAL is set
+  spill = None # carbon.spill.CacheSpill when ENABLE_CACHE_SPILL is set
+  full = False # as of the last store
+  coalesce = None # see setCoalescing()
+  deadline = None # see setDeadlines()
+  batchSize = 0
+
+  def __init__(self, shards=1, strategy='max', writers=1, policy='pause'):
+    self.configure(shards, strategy, writers, policy)
+
+  def configure(self, shards, strategy='max', writers=1, policy='pause'):
+    if strategy not in drainStrategies:
+      raise CarbonConfigException("Invalid CACHE_WRITE_STRATEGY '%s', must be one of: %s" %
+                                  (strategy, ', '.join(sorted(drainStrategies))))
+    if policy not in memoryPolicies:
+      raise CarbonConfigException("Invalid CACHE_MEMORY_POLICY '%s', must be one of: %s" %
+                                  (policy, ', '.join(sorted(memoryPolicies))))
+
+    # Round up so every writer owns the same number of shards
+    writers = max(1, int(writers))
+    shards = max(1, int(shards))
+    shards += -shards % writers
+
+    oldShards = self.shards
+    self.shardCount = shards
+    self.shards = [ MetricCacheShard(self.coalesce) for i in range(shards) ]
+    for shard in self.shards:
+      shard.setDeadlines(self.deadline, self.batchSize)
+
+    # Anything stored before the cache was (re)configured gets rehashed
+    for shard in oldShards:
+      for metric in shard.keys():
+        datapoints = shard.pop(metric)
+        self.shardFor(metric).storeMany([ (metric, datapoint) for datapoint in datapoints ])
+
+    # Whether the cache can fill up at all, looked up once instead of on
+    # every store
+    self.limited = settings.MAX_CACHE_SIZE != UNLIMITED or settings.MAX_CACHE_MEMORY != UNLIMITED
+
+    strategyClass = drainStrategies[strategy]
+    self.policy = memoryPolicies[policy](self)
+    for shard in self.shards:
+      shard.trackArrivals(strategyClass.tracksArrivals or self.policy.tracksArrivals or
+                          self.wal is not None)
+    self.strategy = strategyClass(self)
+    self.partitions = [ MetricCachePartition(self, i, writers, strategyClass)
+                        for i in range(writers) ]
+    # Shards are dealt out to the partitions round robin
+    self.shardPartitions = [ self.partitions[i % writers] for i in range(shards) ]
+
+  def setWriteAheadLog(self, wal):
+    "Logs every datapoint stored from now on to wal, which needs arrival tracking"
+    self.wal = wal
+    for shard in self.shards:
+      shard.trackArrivals(True)
+
+  def setCoalescing(self, coalesce):
+    """Replaces the metric's last queued datapoint with one falling in the
+    same interval, coalesce(metric) returns the step to use or 0"""
+    self.coalesce = coalesce
+    for shard in self.shards:
+      shard.coalesce = coalesce
+
+  def setDeadlines(self, deadline, batchSize):
+    """Indexes every queue by when it is due to be written for dueQueues():
+    deadline(metric) seconds after it was created, or once it holds
+    batchSize datapoints. deadline is called in the storing thread."""
+    self.deadline = deadline
+    self.batchSize = batchSize
+    for shard in self.shards:
+      shard.setDeadlines(deadline, batchSize)
+
+  def shardFor(self, metric):
+    return self.shards[hash(metric) % self.shardCount]
+
+  def store(self, metric, datapoint, spilling=True):
+    """Stores one datapoint. The receivers hand over whole batches to
+    storeBatch() instead, this is for everything else storing a datapoint at
+    a time, so the common case is inlined rather than going through
+    storeLocked(). With spilling False the spill is bypassed."""
+    # Once anything is spilled everything is until it has been read back, so
+    # that datapoints reach the cache in the order they were received
+    spill = self.spill
+    if spill is not None and spilling and (spill or self.isFull()) and spill.append(metric, datapoint):
+      return
+
+    # Fullness is only rechecked here once the last store found the cache full
+    if self.full and self.isFull() and not self.policy.admit(metric):
+      return
+
+    index = hash(metric) % self.shardCount
+    shard = self.shards[index]
+    lock = shard.lock
+    lock.acquire()
+    try:
+      queue = getQueue(shard, metric)
+      if queue is None or queue.step:
+        shard.storeLocked(((metric, datapoint),))
+      else:
+        # The arrays take ints and floats as they are, anything else raises
+        # before anything is appended or after only the timestamp was and is
+        # left to storeLocked() to convert or drop
+        timestamps = queue.timestamps
+        try:
+          timestamps.append(datapoint[0])
+          queue.values.append(datapoint[1])
+        except (TypeError, OverflowError, IndexError):
+          if len(timestamps) > len(queue.values):
+            timestamps.pop()
+          shard.storeLocked(((metric, datapoint),))
+        else:
+          shard.size += 1
+          queueSize = len(timestamps)
+          if queueSize & (queueSize - 1) == 0 or queueSize == shard.batchSize:
+            shard.grew(metric, queueSize)
+    finally:
+      lock.release()
+
+    # Logged after the store so the queue's created time is never later than
+    # the point's WAL entry
+    if self.wal is not None:
+      self.wal.append(metric, datapoint)
+
+    partition = self.shardPartitions[index]
+    if partition.waiting:
+      partition.wake()
+
+    if self.limited:
+      self.full = self.isFull()
+      if self.full:
+        self.policy.full()
+
+  def storeBatch(self, batch, spilling=True):
+    """Stores a list of (metric, datapoint), taking each shard's lock once.
+    Makes the same decisions as store() for each datapoint, what the spill
+    or the memory policy doesn't take is stored together. With spilling
+    False the spill is bypassed."""
+    spill = self.spill
+    if spilling and spill is not None and (spill or self.isFull()):
+      append = spill.append
+      batch = [ (metric, datapoint) for (metric, datapoint) in batch
+                if not append(metric, datapoint) ]
+      if not batch:
+        return
+
+    if self.full and self.isFull():
+      admit = self.policy.admit
+      batch = [ item for item in batch if admit(item[0]) ]
+      if not batch:
+        return
+
+    shardCount = self.shardCount
+    byShard = {}
+    for item in batch:
+      index = hash(item[0]) % shardCount
+      try:
+        byShard[index].append(item)
+      except KeyError:
+        byShard[index] = [item]
+
+    for (index, datapoints) in byShard.iteritems():
+      self.shards[index].storeMany(datapoints)
+      partition = self.shardPartitions[index]
+      if partition.waiting:
+        partition.wake()
+
+    if self.wal is not None:
+      self.wal.extend(batch)
+
+    if self.limited:
+      self.full = self.isFull()
+      if self.full:
+        self.policy.full()
+
+  def isFull(self):
+    # Summing the shard sizes is skipped for the common unlimited case
+    maxSize = settings.MAX_CACHE_SIZE
+    if maxSize != UNLIMITED and self.size >= maxSize:
+      return True
+    maxMemory = settings.MAX_CACHE_MEMORY
+    return maxMemory != UNLIMITED and self.bytes >= maxMemory
+
+  def hasSpace(self):
+    "Whether the cache is below 95% of both MAX_CACHE_SIZE and MAX_CACHE_MEMORY"
+    return (self.size < settings.MAX_CACHE_SIZE * 0.95 and
+            self.bytes < settings.MAX_CACHE_MEMORY * 0.95)
+
+
+class MetricCachePartition(ShardGroup):
+  """The shards of a ShardedMetricCache drained by one writer thread: every
+  count'th shard starting at index. The writer can block in waitForData()
+  until the cache stores a datapoint in one of the shards.
+
+  inflight is set by the writer while it writes datapoints it has taken out
+  of the cache, to the created time of their queue."""
+  def __init__(self, cache, index, count, strategyClass):
+    self.cache = cache
+    self.index = index
+    self.count = count
+    self.shards = cache.shards[index::count]
+    self.strategy = strategyClass(self)
+    self.condition = Condition()
+    self.waiting = False
+    self.inflight = None
+
+  def waitForData(self, timeout):
+    """Blocks until the partition holds datapoints, for at most timeout
+    seconds. Returns True if it does."""
+    try:
+      self.condition.acquire()
+      # store() checks waiting after storing, so either it sees the flag or
+      # we see its datapoint
+      self.waiting = True
+      if not self:
+        self.condition.wait(timeout)
+      self.waiting = False
+      return bool(self)
+    finally:
+      self.condition.release()
+
+  def wake(self):
+    try:
+      self.condition.acquire()
+      self.condition.notify()
+    finally:
+      self.condition.release()
+
+  def shardFor(self, metric):
+    return self.cache.shardFor(metric)
+
+  def __contains__(self, metric):
+    return (hash(metric) % self.cache.shardCount % self.count == self.index and
+            metric in self.cache.shardFor(metric))
+
+
+class DrainStrategy(object):
+  """Chooses the order in which the writer drains metrics from a cache.
+  chooseItem() returns the next metric to write or None once the cache is
+  empty."""
+  tracksArrivals = False
+
+  def __init__(self, cache):
+    self.cache = cache
+
+  def chooseItem(self):
+    raise NotImplementedError()
+
+  def orderDue(self, queues):
+    """Returns the metrics of the (metric, DatapointQueue) pairs due to be
+    written in the order to write them, used instead of chooseItem() when
+    WRITE_BATCH_INTERVALS defers writes"""
+    return [ metric for (metric, queue) in queues ]
+
+
+class MaxStrategy(DrainStrategy):
+  "Writes the metrics with the most queued datapoints first"
+  def chooseItem(self):
+    return self.cache.largestMetric()
+
+  def orderDue(self, queues):
+    queues.sort(key=lambda (metric, queue): len(queue), reverse=True)
+    return DrainStrategy.orderDue(self, queues)
+
+
+class OldestStrategy(DrainStrategy):
+  "Writes the metrics that have been waiting the longest first, bounding staleness"
+  tracksArrivals = True
+
+  def chooseItem(self):
+    return self.cache.oldestMetric()
+
+  def orderDue(self, queues):
+    queues.sort(key=lambda (metric, queue): queue.created)
+    return DrainStrategy.orderDue(self, queues)
+
+
+class PassStrategy(DrainStrategy):
+  """Makes passes over a snapshot of the cached metric names in the order
+  given by orderPass(), taking a new snapshot when a pass is finished"""
+  def __init__(self, cache):
+    DrainStrategy.__init__(self, cache)
+    self.queue = []
+
+  def orderPass(self, metrics):
+    return metrics
+
+  def chooseItem(self):
+    for attempt in (1, 2):
+      while self.queue:
+        metric = self.queue.pop()
+        if metric in self.cache:
+          return metric
+
+      self.queue = self.orderPass(list(self.cache))
+      self.queue.reverse()
+
+    return None
+
+  def orderDue(self, queues):
+    return self.orderPass(DrainStrategy.orderDue(self, queues))
+
+
+class NaiveStrategy(PassStrategy):
+  "Writes metrics in whatever order the cache holds them, spending no CPU on ordering"
+
+
+class PathStrategy(PassStrategy):
+  "Writes metrics in filesystem path order for better disk locality"
+  def orderPass(self, metrics):
+    metrics.sort(key=lambda metric: metric.replace('.', '/'))
+    return metrics
+
+
+drainStrategies = {
+  'max' : MaxStrategy,
+  'oldest' : OldestStrategy,
+  'naive' : NaiveStrategy,
+  'path' : PathStrategy,
+}
+
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_CHUNK_SIZE = 1000 # metrics per marshalled chunk
+
+
+def writeSnapshot(path, queues):
+  """Saves (metric, DatapointQueue) pairs to path, with the arrays of every
+  queue dumped as raw doubles in marshalled chunks. The snapshot is written
+  to a temporary file and renamed, so path is never left half written."""
+  tmpPath = path + '.tmp'
+  fh = open(tmpPath, 'wb')
+  try:
+    marshal.dump(SNAPSHOT_VERSION, fh)
+    chunk = []
+    for (metric, queue) in queues:
+      chunk.append((metric, queue.timestamps.tostring(), queue.values.tostring()))
+      if len(chunk) == SNAPSHOT_CHUNK_SIZE:
+        marshal.dump(chunk, fh)
+        chunk = []
+    marshal.dump(chunk, fh)
+    marshal.dump(None, fh)
+    fh.flush()
+    os.fsync(fh.fileno())
+  finally:
+    fh.close()
+  os.rename(tmpPath, path)
+
+
+def readSnapshot(path):
+  "Generates the (metric, datapoints) saved to path by writeSnapshot()"
+  fh = open(path, 'rb')
+  try:
+    version = marshal.load(fh)
+    if version != SNAPSHOT_VERSION:
+      raise ValueError("unsupported cache snapshot version %r" % (version,))
+    while True:
+      chunk = marshal.load(fh)
+      if chunk is None:
+        return
+      for (metric, timestamps, values) in chunk:
+        yield (metric, izip(array('d', timestamps), array('d', values)))
+  finally:
+    fh.close()
+
+
+class MemoryPolicy(object):
+  """Decides what happens to datapoints received while the cache is at
+  MAX_CACHE_SIZE or MAX_CACHE_MEMORY, chosen by CACHE_MEMORY_POLICY. stat
+  counts the datapoints the policy dropped, or for pause how often the cache
+  was found full."""
+  tracksArrivals = False
+  stat = None
+
+  def __init__(self, cache):
+    self.cache = cache
+
+  def admit(self, metric):
+    "Returns False to drop a datapoint for metric instead of storing it"
+    return True
+
+  def full(self):
+    "Called after a datapoint was stored and left the cache full"
+    pass
+
+
+class PausePolicy(MemoryPolicy):
+  "Stores everything and fires cacheFull, which pauses receivers with USE_FLOW_CONTROL"
+  stat = 'cache.overflow' # incremented by a cacheFull handler
+
+  def full(self):
+    log.msg("MetricCache is full: self.size=%d" % self.cache.size)
+    state.events.cacheFull()
+
+
+class DropNewestPolicy(MemoryPolicy):
+  "Drops datapoints received while the cache is full"
+  stat = 'cache.droppedNewest'
+
+  def admit(self, metric):
+    state.instrumentation.increment(self.stat)
+    return False
+
+
+class DropOldestPolicy(MemoryPolicy):
+  "Drops the queues that have waited longest until the cache has space again"
+  tracksArrivals = True
+  stat = 'cache.droppedOldest'
+
+  def full(self):
+    while not self.cache.hasSpace():
+      created, metric = self.cache.oldestQueue()
+      if metric is None:
+        break
+      try:
+        queue = self.cache.popQueue(metric)
+      except KeyError:
+        continue
+      state.instrumentation.increment(self.stat, len(queue))
+
+
+class DropNewMetricsPolicy(MemoryPolicy):
+  """Drops datapoints for metrics without a whisper file while the cache is
+  full. Anything else is still stored, the receivers are never paused, so
+  existing metrics can take the cache past its limits."""
+  stat = 'cache.droppedNewMetrics'
+
+  def __init__(self, cache):
+    MemoryPolicy.__init__(self, cache)
+    # The writer's in-memory index, admit() runs in the reactor thread and
+    # must not stat() the file
+    from carbon.writer import knownMetrics
+    self.knownMetrics = knownMetrics
+
+  def admit(self, metric):
+    if metric in self.knownMetrics:
+      return True
+    state.instrumentation.increment(self.stat)
+    return False
+
+
+memoryPolicies = {
+  'pause' : PausePolicy,
+  'drop-newest' : DropNewestPolicy,
+  'drop-oldest' : DropOldestPolicy,
+  'drop-new-metrics' : DropNewMetricsPolicy,
+}
+
 
-# Ghetto singleton
-MetricCache = MetricCache()
+# Ghetto singleton, CACHE_SHARDS is applied by configure() once settings are read
+MetricCache = ShardedMetricCache()
 
 
 # Avoid import circularities
@@ -5,8 +5,12 @@ from twisted.internet.protocol import ReconnectingClientFactory
 from twisted.protocols.basic import Int32StringReceiver
 from carbon.conf import settings
 from carbon.util import pickle
+from carbon.columnar import ColumnarEncoder
+from carbon.exceptions import CarbonConfigException
+from carbon.spill import Spill
 from carbon import log, state, instrumentation
 from collections import deque
+from os.path import join
 from time import time
 
 
@@ -26,6 +30,7 @@ class CarbonClientProtocol(Int32StringReceiver):
     self.sent = 'destinations.%s.sent' % self.destinationName
     self.relayMaxQueueLength = 'destinations.%s.relayMaxQueueLength' % self.destinationName
     self.batchesSent = 'destinations.%s.batchesSent' % self.destinationName
+    self.sendTimes = 'destinations.%s.sendTimes' % self.destinationName
 
     self.slowConnectionReset = 'destinations.%s.slowConnectionReset' % self.destinationName
 
@@ -55,10 +60,15 @@ class CarbonClientProtocol(Int32StringReceiver):
 
   def sendDatapoint(self, metric, datapoint):
     self.factory.enqueue(metric, datapoint)
-    reactor.callLater(settings.TIME_TO_DEFER_SENDING, self.sendQueued)
+    self.factory.scheduleSend()
+
+  def encode(self, datapoints):
+    return pickle.dumps(datapoints, protocol=-1)
 
   def _sendDatapoints(self, datapoints):
-      self.sendString(pickle.dumps(datapoints, protocol=-1))
+      started = time()
+      self.sendString(self.encode(datapoints))
+      instrumentation.observe(self.sendTimes, time() - started)
       instrumentation.increment(self.sent, len(datapoints))
       instrumentation.increment(self.batchesSent)
       self.factory.checkQueue()
@@ -68,9 +78,9 @@ class CarbonClientProtocol(Int32StringReceiver):
     In order to not hold the event loop and prevent stats from flowing
     in while we send them out, this will process
     settings.MAX_DATAPOINTS_PER_MESSAGE stats, send them, and if there
-    are still items in the queue, this will invoke reactor.callLater
-    to schedule another run of sendQueued after a reasonable enough time
-    for the destination to process what it has just received.
+    are still items in the queue, have the factory schedule another run
+    of sendQueued after a reasonable enough time for the destination to
+    process what it has just received.
 
     Given a queue size of one million stats, and using a
     chained_invocation_delay of 0.0001 seconds, you'd get 1,000
@@ -102,11 +112,14 @@ class CarbonClientProtocol(Int32StringReceiver):
           instrumentation.prior_stats.get('metricsReceived', 0)))
 
     self._sendDatapoints(self.factory.takeSomeFromQueue())
+    spill = self.factory.spill
+    if spill and self.factory.queueSize < SEND_QUEUE_LOW_WATERMARK:
+      spill.readBack()
     if (self.factory.queueFull.called and
         queueSize < SEND_QUEUE_LOW_WATERMARK):
       self.factory.queueHasSpace.callback(queueSize)
     if self.factory.hasQueuedDatapoints():
-      reactor.callLater(chained_invocation_delay, self.sendQueued)
+      self.factory.scheduleSend(chained_invocation_delay)
 
 
   def connectionQualityMonitor(self):
@@ -155,11 +168,63 @@ class CarbonClientProtocol(Int32StringReceiver):
   __repr__ = __str__
 
 
+class ColumnarClientProtocol(CarbonClientProtocol):
+  "Sends datapoints with the columnar protocol, see carbon.columnar"
+  def connectionMade(self):
+    # Every connection starts with an empty dictionary of metric names
+    self.encoder = ColumnarEncoder(settings.COLUMNAR_COMPRESSION_LEVEL)
+    CarbonClientProtocol.connectionMade(self)
+
+  def encode(self, datapoints):
+    return self.encoder.encode(datapoints)
+
+  def __str__(self):
+    return 'ColumnarClientProtocol(%s:%d:%s)' % (self.factory.destination)
+  __repr__ = __str__
+
+
+clientProtocols = {
+  'pickle' : CarbonClientProtocol,
+  'columnar' : ColumnarClientProtocol,
+}
+
+
+class DestinationSpill(Spill):
+  """Datapoints sent to a destination while its queue is at MAX_QUEUE_SIZE,
+  read back into the queue in order while the destination is connected. Each
+  send that leaves the queue below QUEUE_LOW_WATERMARK_PCT refills it up to
+  MAX_QUEUE_SIZE, so the spill drains as fast as the destination takes
+  datapoints rather than only every READ_INTERVAL."""
+  def __init__(self, directory, factory, segmentSize=64 * 1024 * 1024, maxSize=float('inf')):
+    Spill.__init__(self, directory, segmentSize, maxSize)
+    self.factory = factory
+    self.spilledStat = 'destinations.%s.spill.spilledPoints' % factory.destinationName
+    self.readStat = 'destinations.%s.spill.readPoints' % factory.destinationName
+
+  def readBack(self):
+    try:
+      factory = self.factory
+      read = 0
+      while self.size and factory.connectedProtocol and factory.queueSize < settings.MAX_QUEUE_SIZE:
+        chunk = self.readChunk()
+        if chunk is None:
+          break
+        factory.queue.extend(chunk)
+        self.size -= len(chunk)
+        read += len(chunk)
+      if read:
+        instrumentation.increment(self.readStat, read)
+        factory.scheduleSend(0)
+    except:
+      log.err()
+
+
 class CarbonClientFactory(ReconnectingClientFactory):
   maxDelay = 5
 
-  def __init__(self, destination):
+  def __init__(self, destination, protocol='pickle', spillDir=None):
     self.destination = destination
+    self.protocol = clientProtocols[protocol]
     self.destinationName = ('%s:%d:%s' % destination).replace('.', '_')
     self.host, self.port, self.carbon_instance = destination
     self.addr = (self.host, self.port)
@@ -167,6 +232,7 @@ class CarbonClientFactory(ReconnectingClientFactory):
     # This factory maintains protocol state across reconnects
     self.queue = deque() # Change to make this the sole source of metrics to be sent.
     self.connectedProtocol = None
+    self.sendCall = None # the one DelayedCall armed by scheduleSend()
     self.queueEmpty = Deferred()
     self.queueFull = Deferred()
     self.queueFull.addCallback(self.queueFullCallback)
@@ -179,6 +245,12 @@ class CarbonClientFactory(ReconnectingClientFactory):
     self.attemptedRelays = 'destinations.%s.attemptedRelays' % self.destinationName
     self.fullQueueDrops = 'destinations.%s.fullQueueDrops' % self.destinationName
     self.queuedUntilConnected = 'destinations.%s.queuedUntilConnected' % self.destinationName
+    self.spill = None
+    if spillDir is not None:
+      self.spill = DestinationSpill(join(spillDir, self.destinationName), self,
+                                    int(settings.DESTINATION_SPILL_SEGMENT_SIZE),
+                                    float(settings.MAX_DESTINATION_SPILL_SIZE))
+
   def queueFullCallback(self, result):
     state.events.cacheFull()
     log.clients('%s send queue is full (%d datapoints)' % (self, result))
@@ -188,12 +260,16 @@ class CarbonClientFactory(ReconnectingClientFactory):
       log.clients('%s send queue has space available' % self.connectedProtocol)
       self.queueFull = Deferred()
       self.queueFull.addCallback(self.queueFullCallback)
-      state.events.cacheSpaceAvailable()
+      self.queueSpaceAvailable()
     self.queueHasSpace = Deferred()
     self.queueHasSpace.addCallback(self.queueSpaceCallback)
 
+  def queueSpaceAvailable(self):
+    "Called once the queue drains below the low watermark after filling up"
+    state.events.cacheSpaceAvailable()
+
   def buildProtocol(self, addr):
-    self.connectedProtocol = CarbonClientProtocol()
+    self.connectedProtocol = self.protocol()
     self.connectedProtocol.factory = self
     return self.connectedProtocol
 
@@ -241,11 +317,38 @@ class CarbonClientFactory(ReconnectingClientFactory):
   def enqueue(self, metric, datapoint):
     self.queue.append((metric, datapoint))
 
+  def scheduleSend(self, delay=None):
+    """Arms a single sendQueued() of the connected protocol, delay seconds
+    from now or TIME_TO_DEFER_SENDING, however many datapoints get queued in
+    the meantime. The send is brought forward once a full message of
+    MAX_DATAPOINTS_PER_MESSAGE datapoints has been queued."""
+    call = self.sendCall
+    if call is not None and call.active():
+      # Only on the way up, a backlog keeps the pace sendQueued() set
+      if delay is None and self.queueSize == settings.MAX_DATAPOINTS_PER_MESSAGE:
+        call.reset(0)
+      return
+
+    if delay is None:
+      delay = settings.TIME_TO_DEFER_SENDING
+    self.sendCall = reactor.callLater(delay, self.sendQueued)
+
+  def sendQueued(self):
+    if self.connectedProtocol:
+      self.connectedProtocol.sendQueued()
+
   def enqueue_from_left(self, metric, datapoint):
     self.queue.appendleft((metric, datapoint))
 
   def sendDatapoint(self, metric, datapoint):
     instrumentation.increment(self.attemptedRelays)
+    # Once anything is spilled everything is until it has been read back, so
+    # that datapoints are sent in the order they were received
+    spill = self.spill
+    if spill is not None and (spill or self.queueSize >= settings.MAX_QUEUE_SIZE) and \
+       spill.append(metric, datapoint):
+      return
+
     if self.queueSize >= settings.MAX_QUEUE_SIZE:
       if not self.queueFull.called:
         self.queueFull.callback(self.queueSize)
@@ -254,7 +357,7 @@ class CarbonClientFactory(ReconnectingClientFactory):
       self.enqueue(metric, datapoint)
 
     if self.connectedProtocol:
-      reactor.callLater(settings.TIME_TO_DEFER_SENDING, self.connectedProtocol.sendQueued)
+      self.scheduleSend()
     else:
       instrumentation.increment(self.queuedUntilConnected)
 
@@ -273,7 +376,7 @@ class CarbonClientFactory(ReconnectingClientFactory):
     self.enqueue_from_left(metric, datapoint)
 
     if self.connectedProtocol:
-      reactor.callLater(settings.TIME_TO_DEFER_SENDING, self.connectedProtocol.sendQueued)
+      self.scheduleSend()
     else:
       instrumentation.increment(self.queuedUntilConnected)
 
@@ -313,19 +416,39 @@ class CarbonClientFactory(ReconnectingClientFactory):
 
 
 class CarbonClientManager(Service):
-  def __init__(self, router):
+  """Sends datapoints to the destinations chosen by router, with
+  DESTINATION_PROTOCOL unless another protocol is given. With
+  ENABLE_DESTINATION_SPILL, unless spill is False, each destination spills
+  to its own directory in DESTINATION_SPILL_DIR."""
+  def __init__(self, router, protocol=None, spill=None):
+    if protocol is None:
+      protocol = settings.DESTINATION_PROTOCOL
+    if protocol not in clientProtocols:
+      raise CarbonConfigException("Invalid DESTINATION_PROTOCOL '%s', must be one of: %s" %
+                                  (protocol, ', '.join(sorted(clientProtocols))))
+    if spill is None:
+      spill = settings.ENABLE_DESTINATION_SPILL
     self.router = router
+    self.protocol = protocol
+    self.spillDir = settings.DESTINATION_SPILL_DIR if spill else None
     self.client_factories = {} # { destination : CarbonClientFactory() }
 
   def startService(self):
     Service.startService(self)
     for factory in self.client_factories.values():
+      if factory.spill is not None and not factory.spill.running:
+        factory.spill.startService()
       if not factory.started:
         factory.startConnecting()
 
   def stopService(self):
     Service.stopService(self)
     self.stopAllClients()
+    # What is still queued in memory when the clients stop is lost, as
+    # without the spill, anything spilled is sent after the next start
+    for factory in self.client_factories.values():
+      if factory.spill is not None and factory.spill.running:
+        factory.spill.stopService()
 
   def startClient(self, destination):
     if destination in self.client_factories:
@@ -333,16 +456,21 @@ class CarbonClientManager(Service):
 
     log.clients("connecting to carbon daemon at %s:%d:%s" % destination)
     self.router.addDestination(destination)
-    factory = self.client_factories[destination] = CarbonClientFactory(destination)
+    factory = self.client_factories[destination] = self.createFactory(destination)
     connectAttempted = DeferredList(
         [factory.connectionMade, factory.connectFailed],
         fireOnOneCallback=True,
         fireOnOneErrback=True)
     if self.running:
+      if factory.spill is not None:
+        factory.spill.startService()
       factory.startConnecting() # this can trigger & replace connectFailed
 
     return connectAttempted
 
+  def createFactory(self, destination):
+    return CarbonClientFactory(destination, self.protocol, self.spillDir)
+
   def stopClient(self, destination):
     factory = self.client_factories.get(destination)
     if factory is None:
@@ -355,6 +483,8 @@ class CarbonClientManager(Service):
 
   def disconnectClient(self, destination):
     factory = self.client_factories.pop(destination)
+    if factory.spill is not None and factory.spill.running:
+      factory.spill.stopService()
     c = factory.connector
     if c and c.state == 'connecting' and not factory.hasQueuedDatapoints():
       c.stopConnecting()
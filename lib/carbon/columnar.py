@@ -0,0 +1,171 @@
+"""A compact binary encoding of batches of datapoints for traffic between
+carbon daemons, the columnar protocol. Compared to the pickle protocol each
+metric name is only sent once per connection, and the numbers are packed
+into arrays that take no work to decode.
+
+Every message is one Int32StringReceiver string: a flags byte, then the body,
+zlib compressed when FLAG_COMPRESSED is set. The body is a '!II' header
+holding the length of the new names and the number of datapoints, then
+
+  new names   the metric names seen for the first time on this connection,
+              separated by NUL bytes, which get the next ids in order
+  ids         one little-endian uint32 per datapoint, the id of its metric
+  timestamps  one little-endian double per datapoint
+  values      one little-endian double per datapoint
+
+Both ends number the names the same way so a message depends on every
+message before it on the connection. FLAG_RESET starts a new dictionary,
+which the encoder does before it would hold more than MAX_NAMES names. The
+decoder refuses to hold more than that, bounding the memory of both ends.
+"""
+
+import sys
+import zlib
+import struct
+from array import array
+
+
+FLAG_COMPRESSED = 0x1
+FLAG_RESET = 0x2
+HEADER = struct.Struct('!II')
+MAX_NAMES = 1000000
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024 # decompressed
+
+# array typecodes for 32 bit unsigned ints vary by platform
+ID_TYPECODE = [ code for code in 'IL' if array(code).itemsize == 4 ][0]
+SWAP_BYTES = sys.byteorder == 'big'
+
+
+def pack(numbers):
+  if SWAP_BYTES:
+    numbers.byteswap()
+  return numbers.tostring()
+
+
+def isDouble(number):
+  try:
+    float(number)
+    return True
+  except (TypeError, ValueError, OverflowError):
+    return False
+
+
+def unpack(typecode, data):
+  numbers = array(typecode)
+  numbers.fromstring(data)
+  if SWAP_BYTES:
+    numbers.byteswap()
+  return numbers
+
+
+class ColumnarEncoder(object):
+  "Encodes the datapoints sent on one connection"
+  def __init__(self, compressionLevel=0):
+    self.compressionLevel = compressionLevel
+    self.ids = {} # { metric : id }
+    self.reset = False
+
+  def encode(self, datapoints):
+    """Returns the message for a list of (metric, (timestamp, value)).
+    Datapoints of metrics with an empty name or one containing a NUL byte,
+    and those with a timestamp or value that doesn't fit a double, are
+    dropped."""
+    flags = 0
+    ids = self.ids
+    if self.reset:
+      ids.clear()
+      self.reset = False
+      flags |= FLAG_RESET
+
+    newNames = []
+    try:
+      if datapoints:
+        metrics, points = zip(*datapoints)
+        timestamps, values = zip(*points)[:2]
+      else:
+        metrics, timestamps, values = (), (), ()
+
+      unseen = set(metrics).difference(ids)
+      if len(ids) + len(unseen) > MAX_NAMES and ids:
+        ids.clear()
+        flags |= FLAG_RESET
+        unseen = set(metrics)
+      if len(unseen) > MAX_NAMES:
+        raise ValueError("More than %d metrics in one message" % MAX_NAMES)
+
+      skipped = False
+      for metric in unseen:
+        if not metric or '\0' in metric:
+          skipped = True
+          continue
+        ids[metric] = len(ids)
+        if isinstance(metric, unicode):
+          metric = metric.encode('utf-8')
+        newNames.append(metric)
+
+      if skipped:
+        kept = [ i for (i, metric) in enumerate(metrics) if metric in ids ]
+        metrics = [ metrics[i] for i in kept ]
+        timestamps = [ timestamps[i] for i in kept ]
+        values = [ values[i] for i in kept ]
+
+      try:
+        timestamps = array('d', timestamps)
+        values = array('d', values)
+      except (TypeError, ValueError, OverflowError):
+        kept = [ i for i in xrange(len(metrics))
+                 if isDouble(timestamps[i]) and isDouble(values[i]) ]
+        metrics = [ metrics[i] for i in kept ]
+        timestamps = array('d', [ timestamps[i] for i in kept ])
+        values = array('d', [ values[i] for i in kept ])
+      metricIds = array(ID_TYPECODE, map(ids.__getitem__, metrics))
+    except:
+      # The names numbered so far are never sent
+      self.reset = True
+      raise
+
+    names = '\0'.join(newNames)
+    body = ''.join([ HEADER.pack(len(names), len(metricIds)), names,
+                     pack(metricIds), pack(timestamps), pack(values) ])
+    if self.compressionLevel:
+      flags |= FLAG_COMPRESSED
+      body = zlib.compress(body, self.compressionLevel)
+    return chr(flags) + body
+
+
+class ColumnarDecoder(object):
+  """Decodes the messages received on one connection. Once decode() raises
+  the connection has to be dropped, the dictionary may no longer match."""
+  def __init__(self):
+    self.names = []
+
+  def decode(self, message):
+    "Returns the list of (metric, (timestamp, value)) in message"
+    flags = ord(message[0])
+    body = message[1:]
+    if flags & FLAG_COMPRESSED:
+      decompressor = zlib.decompressobj()
+      body = decompressor.decompress(body, MAX_MESSAGE_SIZE)
+      if decompressor.unconsumed_tail:
+        raise ValueError("Message is larger than %d bytes decompressed" % MAX_MESSAGE_SIZE)
+    if flags & FLAG_RESET:
+      del self.names[:]
+
+    namesLength, count = HEADER.unpack_from(body)
+    offset = HEADER.size
+    idsEnd = offset + namesLength + count * 4
+    if len(body) != idsEnd + count * 16:
+      raise ValueError("Message length doesn't match its header")
+
+    if namesLength:
+      newNames = body[offset:offset + namesLength].split('\0')
+      if len(self.names) + len(newNames) > MAX_NAMES:
+        raise ValueError("Peer sent more than %d metric names without a reset" % MAX_NAMES)
+      self.names.extend(newNames)
+    offset += namesLength
+    metricIds = unpack(ID_TYPECODE, body[offset:idsEnd])
+    timestamps = unpack('d', body[idsEnd:idsEnd + count * 8])
+    values = unpack('d', body[idsEnd + count * 8:])
+
+    metrics = map(self.names.__getitem__, metricIds)
+    return zip(metrics, zip(timestamps, values))
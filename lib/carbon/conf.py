@@ -17,7 +17,7 @@ import sys
 import pwd
 import errno
 
-from os.path import join, dirname, normpath, exists, isdir
+from os.path import join, dirname, normpath, exists, isdir, splitext
 from optparse import OptionParser
 from ConfigParser import ConfigParser
 
@@ -28,11 +28,40 @@ from carbon.exceptions import CarbonConfigException
 from twisted.python import usage
 
 
+# Set for the cache workers spawned by worker 0, see carbon.workers
+WORKER_ENVIRONMENT_KEY = 'CARBON_CACHE_WORKER'
+
+# The files and directories each cache worker keeps its own state in
+WORKER_STATE_PATHS = ('METRIC_INDEX_FILE', 'WAL_DIR', 'CACHE_SNAPSHOT_FILE', 'CACHE_SPILL_DIR')
+
+
 defaults = dict(
   USER="",
   MAX_CACHE_SIZE=float('inf'),
+  MAX_CACHE_MEMORY=float('inf'),
+  CACHE_MEMORY_POLICY='pause',
+  COALESCE_DATAPOINTS=False,
+  CACHE_SHARDS=16,
+  CACHE_WRITE_STRATEGY='max',
   MAX_UPDATES_PER_SECOND=500,
+  UPDATE_BURST_SIZE=50,
+  ADAPTIVE_UPDATE_RATE=False,
+  TARGET_UPDATE_LATENCY=0.05,
+  WRITER_THREADS=1,
+  WRITE_BATCH_DELAY=0.1,
+  WRITE_BATCH_INTERVALS=1,
+  MAX_WRITE_DELAY=300,
+  MAX_DATAPOINT_AGE=600,
   MAX_CREATES_PER_MINUTE=float('inf'),
+  MAX_CREATE_QUEUE_SIZE=1000000,
+  SCHEMA_CACHE_SIZE=100000,
+  CACHE_SNAPSHOT_ON_SHUTDOWN=False,
+  ENABLE_CACHE_SPILL=False,
+  CACHE_SPILL_SEGMENT_SIZE=64 * 1024 * 1024,
+  MAX_CACHE_SPILL_SIZE=float('inf'),
+  ENABLE_WAL=False,
+  WAL_SYNC_INTERVAL=1.0,
+  WAL_SEGMENT_SIZE=64 * 1024 * 1024,
   LINE_RECEIVER_INTERFACE='0.0.0.0',
   LINE_RECEIVER_PORT=2003,
   ENABLE_UDP_LISTENER=False,
@@ -40,14 +69,20 @@ defaults = dict(
   UDP_RECEIVER_PORT=2003,
   PICKLE_RECEIVER_INTERFACE='0.0.0.0',
   PICKLE_RECEIVER_PORT=2004,
+  COLUMNAR_RECEIVER_INTERFACE='0.0.0.0',
+  COLUMNAR_RECEIVER_PORT=0,
   CACHE_QUERY_INTERFACE='0.0.0.0',
   CACHE_QUERY_PORT=7002,
+  CACHE_WORKERS=1,
+  WORKER_HANDOFF_PORT=2404,
+  WORKER_QUERY_PORT=7402,
   LOG_UPDATES=True,
   LOG_CACHE_HITS = True,
   WHISPER_AUTOFLUSH=False,
   WHISPER_SPARSE_CREATE=False,
   WHISPER_FALLOCATE_CREATE=False,
   WHISPER_LOCK_WRITES=False,
+  WHISPER_FILE_CACHE_SIZE=0,
   MAX_DATAPOINTS_PER_MESSAGE=500,
   MAX_AGGREGATION_INTERVALS=5,
   MAX_QUEUE_SIZE=1000,
@@ -64,6 +99,11 @@ defaults = dict(
   RELAY_METHOD='rules',
   REPLICATION_FACTOR=1,
   DESTINATIONS=[],
+  DESTINATION_PROTOCOL='pickle',
+  COLUMNAR_COMPRESSION_LEVEL=0,
+  ENABLE_DESTINATION_SPILL=False,
+  DESTINATION_SPILL_SEGMENT_SIZE=16 * 1024 * 1024,
+  MAX_DESTINATION_SPILL_SIZE=float('inf'),
   USE_FLOW_CONTROL=True,
   USE_INSECURE_UNPICKLER=False,
   USE_WHITELIST=False,
@@ -235,6 +275,10 @@ class CarbonCacheOptions(usage.Options):
             else:
                 log.err("WHISPER_LOCK_WRITES is enabled but import of fcntl module failed.")
 
+        if settings.WHISPER_FILE_CACHE_SIZE:
+            log.msg("Keeping up to %d whisper files open" % settings.WHISPER_FILE_CACHE_SIZE)
+            whisper.CACHE_HEADERS = True
+
         if not "action" in self:
             self["action"] = "start"
         self.handleAction()
@@ -547,4 +591,21 @@ def read_config(program, options, **kwargs):
             join(settings["PID_DIR"], '%s.pid' % program))
         settings["LOG_DIR"] = (options["logdir"] or settings["LOG_DIR"])
 
+    # Every cache worker has its own pidfile, so the defaults below differ
+    # between them, but paths set in the config file would be shared
+    workerId = int(os.environ.get(WORKER_ENVIRONMENT_KEY, 0))
+    if program == "carbon-cache" and workerId:
+        for name in WORKER_STATE_PATHS:
+            if settings.get(name):
+                root, ext = splitext(settings[name].rstrip(os.sep))
+                settings[name] = "%s-worker-%d%s" % (root, workerId, ext)
+
+    # The writer's index of existing whisper files is kept next to the pidfile
+    settings.setdefault(
+        "METRIC_INDEX_FILE", splitext(settings["pidfile"])[0] + ".metrics")
+    settings.setdefault("WAL_DIR", splitext(settings["pidfile"])[0] + ".wal")
+    settings.setdefault("CACHE_SNAPSHOT_FILE", splitext(settings["pidfile"])[0] + ".snapshot")
+    settings.setdefault("CACHE_SPILL_DIR", splitext(settings["pidfile"])[0] + ".spill")
+    settings.setdefault("DESTINATION_SPILL_DIR", splitext(settings["pidfile"])[0] + ".queues")
+
     return settings
@@ -22,7 +22,42 @@ class Event:
         log.err(None, "Exception in %s event handler: args=%s kwargs=%s" % (self.name, args, kwargs))
 
 
-metricReceived = Event('metricReceived')
+class PointEvent(Event):
+  """The per-datapoint side of a BatchEvent. Calling it sends a batch of one
+  datapoint, its handlers are called for every datapoint of every batch."""
+  def __init__(self, name):
+    Event.__init__(self, name)
+    self.batchEvent = None
+
+  def __call__(self, metric, datapoint):
+    self.batchEvent([(metric, datapoint)])
+
+  def dispatch(self, metric, datapoint):
+    Event.__call__(self, metric, datapoint)
+
+
+class BatchEvent(Event):
+  """An Event called with a list of (metric, datapoint). Handlers that take
+  one datapoint at a time are added to pointEvent instead."""
+  def __init__(self, name, pointEvent):
+    Event.__init__(self, name)
+    self.pointEvent = pointEvent
+    pointEvent.batchEvent = self
+
+  def __call__(self, batch):
+    for handler in self.handlers:
+      try:
+        handler(batch)
+      except:
+        log.err(None, "Exception in %s event handler: %d datapoints" % (self.name, len(batch)))
+
+    if self.pointEvent.handlers:
+      for (metric, datapoint) in batch:
+        self.pointEvent.dispatch(metric, datapoint)
+
+
+metricReceived = PointEvent('metricReceived')
+metricsReceivedBatch = BatchEvent('metricsReceivedBatch', metricReceived)
 metricGenerated = Event('metricGenerated')
 specialMetricReceived = Event('specialMetricReceived')
 specialMetricGenerated = Event('specialMetricGenerated')
@@ -32,7 +67,7 @@ pauseReceivingMetrics = Event('pauseReceivingMetrics')
 resumeReceivingMetrics = Event('resumeReceivingMetrics')
 
 # Default handlers
-metricReceived.addHandler(lambda metric, datapoint: state.instrumentation.increment('metricsReceived'))
+metricsReceivedBatch.addHandler(lambda batch: state.instrumentation.increment('metricsReceived', len(batch)))
 specialMetricReceived.addHandler(lambda metric, datapoint: state.instrumentation.increment('metricsReceived'))
 
 
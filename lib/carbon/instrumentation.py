@@ -1,7 +1,9 @@
 import os
+import math
 import time
 import socket
 from resource import getrusage, RUSAGE_SELF
+from threading import Lock
 
 from twisted.application.service import Service
 from twisted.internet.task import LoopingCall
@@ -9,7 +11,10 @@ from carbon.conf import settings
 
 
 stats = {}
+statsLock = Lock() # the writer threads update stats alongside the reactor thread
 prior_stats = {}
+maxStats = set() # stats updated with max() rather than increment()
+workerGauges = {} # { workerId : (time reported, gauges) } on cache worker 0
 HOSTNAME = socket.gethostname().replace('.','_')
 PAGESIZE = os.sysconf('SC_PAGESIZE')
 rusage = getrusage(RUSAGE_SELF)
@@ -26,22 +31,158 @@ lastUsageTime = time.time()
 
 def increment(stat, increase=1):
   try:
-    stats[stat] += increase
-  except KeyError:
-    stats[stat] = increase
+    statsLock.acquire()
+    try:
+      stats[stat] += increase
+    except KeyError:
+      stats[stat] = increase
+  finally:
+    statsLock.release()
 
 def max(stat, newval):
   try:
-    if stats[stat] < newval:
+    statsLock.acquire()
+    maxStats.add(stat)
+    try:
+      if stats[stat] < newval:
+        stats[stat] = newval
+    except KeyError:
       stats[stat] = newval
-  except KeyError:
-    stats[stat] = newval
+  finally:
+    statsLock.release()
 
 def append(stat, value):
   try:
-    stats[stat].append(value)
-  except KeyError:
-    stats[stat] = [value]
+    statsLock.acquire()
+    try:
+      stats[stat].append(value)
+    except KeyError:
+      stats[stat] = [value]
+  finally:
+    statsLock.release()
+
+def observe(stat, value):
+  "Adds value to the Histogram stat, use it for durations"
+  try:
+    statsLock.acquire()
+    try:
+      stats[stat].add(value)
+    except KeyError:
+      histogram = stats[stat] = Histogram()
+      histogram.add(value)
+  finally:
+    statsLock.release()
+
+def mergeHistogram(stat, snapshot):
+  "Folds a Histogram.snapshot() into the Histogram stat"
+  try:
+    statsLock.acquire()
+    stats.setdefault(stat, Histogram()).merge(snapshot)
+  finally:
+    statsLock.release()
+
+def takeStats():
+  "Returns the stats gathered since the last call and starts afresh"
+  try:
+    statsLock.acquire()
+    taken = stats.copy()
+    stats.clear()
+    return taken
+  finally:
+    statsLock.release()
+
+
+class Histogram(object):
+  """Counts values in logarithmic buckets, each one growth times wider than
+  the last, so its percentiles are within that relative error of the real
+  ones. The memory used doesn't depend on how many values are added, for
+  durations in seconds there are at most a few hundred buckets. Values below
+  minValue all share the first bucket."""
+  minValue = 1e-6
+  growth = 1.05
+  logGrowth = math.log(growth)
+
+  def __init__(self):
+    self.buckets = {} # { bucket : count }
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def __len__(self):
+    return self.count
+
+  def add(self, value):
+    if value > self.minValue:
+      bucket = int(math.log(value / self.minValue) / self.logGrowth) + 1
+    else:
+      bucket = 0
+    self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+    self.count += 1
+    self.total += value
+    if value > self.max:
+      self.max = value
+
+  def mean(self):
+    if not self.count:
+      return 0.0
+    return self.total / self.count
+
+  def percentile(self, q):
+    "Returns the upper bound of the bucket holding the q'th value, 0 < q <= 1"
+    rank = q * self.count
+    seen = 0
+    for bucket in sorted(self.buckets):
+      seen += self.buckets[bucket]
+      if seen >= rank:
+        return min(self.max, self.minValue * self.growth ** bucket)
+    return self.max
+
+  def snapshot(self):
+    "Returns the histogram as a plain dict, so it can be unpickled safely"
+    return dict(buckets=self.buckets, count=self.count, total=self.total, max=self.max)
+
+  def merge(self, snapshot):
+    for bucket, count in snapshot['buckets'].items():
+      self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+    self.count += snapshot['count']
+    self.total += snapshot['total']
+    if snapshot['max'] > self.max:
+      self.max = snapshot['max']
+
+
+def recordHistogram(record, stat, histogram):
+  for (name, q) in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+    record('%s.%s' % (stat, name), histogram.percentile(q))
+  record('%s.max' % stat, histogram.max)
+
+
+def mergeWorkerStats(report):
+  """Folds a stats report from another carbon-cache worker into this
+  interval's stats, see carbon.workers"""
+  for stat, value in report['stats'].items():
+    if isinstance(value, list):
+      for item in value:
+        append(stat, item)
+    elif isinstance(value, dict):
+      mergeHistogram(stat, value)
+    elif stat in report['maxStats']:
+      max(stat, value)
+    else:
+      increment(stat, value)
+
+  workerGauges[report['worker']] = (time.time(), report['gauges'])
+
+
+def getWorkerGauge(name):
+  "Sums a gauge over the recent reports of the other cache workers"
+  cutoff = time.time() - 2 * settings.CARBON_METRIC_INTERVAL
+  total = 0
+  for worker, (reported, gauges) in workerGauges.items():
+    if reported < cutoff:
+      del workerGauges[worker]
+    else:
+      total += gauges.get(name, 0)
+  return total
 
 
 def getCpuUsage():
@@ -73,36 +214,106 @@ def getMemUsage():
 def recordMetrics():
   global lastUsage
   global prior_stats
-  myStats = stats.copy()
+
+  # The shards count coalesced and invalid datapoints under their own lock,
+  # both that and this run in the reactor thread
+  if settings.program == 'carbon-cache':
+    for shard in cache.MetricCache.shards:
+      if shard.coalesced:
+        increment('cache.coalescedPoints', shard.coalesced)
+        shard.coalesced = 0
+      if shard.invalid:
+        increment('cache.invalidPoints', shard.invalid)
+        shard.invalid = 0
+
+  myStats = takeStats()
   myPriorStats = {}
-  stats.clear()
+
+  # cache workers other than 0 report to worker 0 instead of recording
+  if settings.program == 'carbon-cache' and state.workerPool and not state.workerPool.primary:
+    gauges = {
+      'cache.queues' : len(cache.MetricCache),
+      'cache.size' : cache.MetricCache.size,
+      'cache.bytes' : cache.MetricCache.bytes,
+      'cpuUsage' : getCpuUsage(),
+      'handoff.queueSize' : state.workerPool.handoffQueueSize(),
+    }
+    if cache.MetricCache.spill is not None:
+      gauges['spill.size'] = cache.MetricCache.spill.size
+      gauges['spill.bytes'] = cache.MetricCache.spill.bytes
+    try: # This only works on Linux
+      gauges['memUsage'] = getMemUsage()
+    except:
+      pass
+    for stat, value in myStats.items():
+      if isinstance(value, Histogram):
+        myStats[stat] = value.snapshot()
+    state.workerPool.sendStats(myStats, maxStats, gauges)
+    return
 
   # cache metrics
   if settings.program == 'carbon-cache':
     record = cache_record
-    updateTimes = myStats.get('updateTimes', [])
+    updateTimes = myStats.get('updateTimes', Histogram())
     committedPoints = myStats.get('committedPoints', 0)
     creates = myStats.get('creates', 0)
+    droppedCreates = myStats.get('droppedCreates', 0)
     errors = myStats.get('errors', 0)
     cacheQueries = myStats.get('cacheQueries', 0)
     cacheOverflow = myStats.get('cache.overflow', 0)
 
     if updateTimes:
-      avgUpdateTime = sum(updateTimes) / len(updateTimes)
-      record('avgUpdateTime', avgUpdateTime)
+      record('avgUpdateTime', updateTimes.mean())
+      recordHistogram(record, 'updateTimes', updateTimes)
 
     if committedPoints:
       pointsPerUpdate = float(committedPoints) / len(updateTimes)
       record('pointsPerUpdate', pointsPerUpdate)
 
+    if 'maxDatapointAge' in myStats:
+      record('maxDatapointAge', myStats['maxDatapointAge'])
+    if 'overdueWrites' in myStats:
+      record('overdueWrites', myStats['overdueWrites'])
+
+    if 'updateRate' in myStats:
+      record('updateRate', myStats['updateRate'])
+      record('updateRateIncreases', myStats.get('updateRateIncreases', 0))
+      record('updateRateDecreases', myStats.get('updateRateDecreases', 0))
+
     record('updateOperations', len(updateTimes))
     record('committedPoints', committedPoints)
     record('creates', creates)
+    record('droppedCreates', droppedCreates)
     record('errors', errors)
+    record('throttledTime', myStats.get('throttledTime', 0))
     record('cache.queries', cacheQueries)
-    record('cache.queues', len(cache.MetricCache))
-    record('cache.size', cache.MetricCache.size)
+    if 'cacheQueryTimes' in myStats:
+      recordHistogram(record, 'cache.queryTimes', myStats['cacheQueryTimes'])
+    record('cache.queues', len(cache.MetricCache) + getWorkerGauge('cache.queues'))
+    record('cache.size', cache.MetricCache.size + getWorkerGauge('cache.size'))
     record('cache.overflow', cacheOverflow)
+    record('cache.bytes', cache.MetricCache.bytes + getWorkerGauge('cache.bytes'))
+    if cache.MetricCache.coalesce is not None:
+      record('cache.coalescedPoints', myStats.get('cache.coalescedPoints', 0))
+    if 'cache.invalidPoints' in myStats:
+      record('cache.invalidPoints', myStats['cache.invalidPoints'])
+    policyStat = cache.MetricCache.policy.stat
+    if policyStat != 'cache.overflow':
+      record(policyStat, myStats.get(policyStat, 0))
+    if cache.MetricCache.spill is not None:
+      record('spill.size', cache.MetricCache.spill.size + getWorkerGauge('spill.size'))
+      record('spill.bytes', cache.MetricCache.spill.bytes + getWorkerGauge('spill.bytes'))
+      record('spill.spilledPoints', myStats.get('spill.spilledPoints', 0))
+      record('spill.readPoints', myStats.get('spill.readPoints', 0))
+    if 'walSyncTimes' in myStats:
+      recordHistogram(record, 'wal.syncTimes', myStats['walSyncTimes'])
+      record('wal.loggedPoints', myStats.get('walLoggedPoints', 0))
+    if state.workerPool:
+      # The handoffs to the workers owning the datapoints
+      recordDestinationStats(record, myStats, myPriorStats)
+      record('handoff.queueSize', state.workerPool.handoffQueueSize() + getWorkerGauge('handoff.queueSize'))
+      record('handoff.pauses', myStats.get('handoffPauses', 0))
+      record('workerStatsDrops', myStats.get('workerStatsDrops', 0))
 
   # aggregator metrics
   elif settings.program == 'carbon-aggregator':
@@ -111,23 +322,17 @@ def recordMetrics():
     record('bufferedDatapoints',
            sum([b.size for b in BufferManager.buffers.values()]))
     record('aggregateDatapointsSent', myStats.get('aggregateDatapointsSent', 0))
+    recordDestinationQueues(record)
 
   # relay metrics
   else:
     record = relay_record
-    prefix = 'destinations.'
-    relay_stats =  [(k,v) for (k,v) in myStats.items() if k.startswith(prefix)]
-    for stat_name, stat_value in relay_stats:
-      record(stat_name, stat_value)
-      # Preserve the count of sent metrics so that the ratio of
-      # received : sent can be checked per-relay to determine the
-      # health of the destination.
-      if stat_name.endswith('.sent'):
-        myPriorStats[stat_name] = stat_value
+    recordDestinationStats(record, myStats, myPriorStats)
+    recordDestinationQueues(record)
 
   # common metrics
   record('metricsReceived', myStats.get('metricsReceived', 0))
-  record('cpuUsage', getCpuUsage())
+  record('cpuUsage', getCpuUsage() + getWorkerGauge('cpuUsage'))
 
   # And here preserve count of messages received in the prior periiod
   myPriorStats['metricsReceived'] = myStats.get('metricsReceived', 0)
@@ -135,7 +340,7 @@ def recordMetrics():
   prior_stats.update(myPriorStats)
 
   try: # This only works on Linux
-    record('memUsage', getMemUsage())
+    record('memUsage', getMemUsage() + getWorkerGauge('memUsage'))
   except:
     pass
 
@@ -147,7 +352,38 @@ def cache_record(metric, value):
     else:
       fullMetric = '%s.agents.%s-%s.%s' % (prefix, HOSTNAME, settings.instance, metric)
     datapoint = (time.time(), value)
-    cache.MetricCache.store(fullMetric, datapoint)
+    if state.workerPool:
+      state.workerPool.store(fullMetric, datapoint)
+    else:
+      cache.MetricCache.store(fullMetric, datapoint)
+
+def recordDestinationStats(record, myStats, myPriorStats):
+  "Records the destinations.* stats of the interval"
+  prefix = 'destinations.'
+  relay_stats =  [(k,v) for (k,v) in myStats.items() if k.startswith(prefix)]
+  for stat_name, stat_value in relay_stats:
+    if isinstance(stat_value, Histogram):
+      recordHistogram(record, stat_name, stat_value)
+      continue
+    record(stat_name, stat_value)
+    # Preserve the count of sent metrics so that the ratio of
+    # received : sent can be checked per-relay to determine the
+    # health of the destination.
+    if stat_name.endswith('.sent'):
+      myPriorStats[stat_name] = stat_value
+
+
+def recordDestinationQueues(record):
+  "Records how many datapoints each destination has queued in memory and spilled"
+  if state.clientManager is None:
+    return
+  for factory in state.clientManager.client_factories.values():
+    prefix = 'destinations.%s.' % factory.destinationName
+    record(prefix + 'queueSize', factory.queueSize)
+    if factory.spill is not None:
+      record(prefix + 'spill.size', factory.spill.size)
+      record(prefix + 'spill.bytes', factory.spill.bytes)
+
 
 def relay_record(metric, value):
     prefix = settings.CARBON_METRIC_PREFIX
@@ -1,7 +1,7 @@
 import traceback
 import whisper
 from carbon import log
-from carbon.storage import getFilesystemPath
+from carbon.storage import getFilesystemPath, invalidateWhisperFile
 
 
 
@@ -24,7 +24,11 @@ def setMetadata(metric, key, value):
 
   wsp_path = getFilesystemPath(metric)
   try:
+    # Writers close the file before their next update instead of writing
+    # through a stale cached header, and again after in case one reopened it
+    invalidateWhisperFile(wsp_path)
     old_value = whisper.setAggregationMethod(wsp_path, value)
+    invalidateWhisperFile(wsp_path)
     return dict(old_value=old_value, new_value=value)
   except:
     log.err()
@@ -7,7 +7,8 @@ from twisted.protocols.basic import LineOnlyReceiver, Int32StringReceiver
 from carbon import log, events, state, management
 from carbon.conf import settings
 from carbon.regexlist import WhiteList, BlackList
-from carbon.util import pickle, get_unpickler
+from carbon.util import pickle, get_unpickler, parseDatapoints
+from carbon.columnar import ColumnarDecoder
 
 
 class MetricReceiver:
@@ -19,13 +20,19 @@ class MetricReceiver:
     if settings.LOG_LISTENER_CONN_SUCCESS:
       log.listener("%s connection with %s established" % (self.__class__.__name__, self.peerName))
 
+    state.connectedMetricReceiverProtocols.add(self)
+    self.startFlowControl()
+
+  def startFlowControl(self):
     if state.metricReceiversPaused:
       self.pauseReceiving()
-
-    state.connectedMetricReceiverProtocols.add(self)
     events.pauseReceivingMetrics.addHandler(self.pauseReceiving)
     events.resumeReceivingMetrics.addHandler(self.resumeReceiving)
 
+  def stopFlowControl(self):
+    events.pauseReceivingMetrics.removeHandler(self.pauseReceiving)
+    events.resumeReceivingMetrics.removeHandler(self.resumeReceiving)
+
   def getPeerName(self):
     if hasattr(self.transport, 'getPeer'):
       peer = self.transport.getPeer()
@@ -48,26 +55,43 @@ class MetricReceiver:
       log.listener("%s connection with %s lost: %s" % (self.__class__.__name__, self.peerName, reason.value))
 
     state.connectedMetricReceiverProtocols.remove(self)
-    events.pauseReceivingMetrics.removeHandler(self.pauseReceiving)
-    events.resumeReceivingMetrics.removeHandler(self.resumeReceiving)
+    self.stopFlowControl()
 
   def metricReceived(self, metric, datapoint):
-    if BlackList and metric in BlackList:
-      instrumentation.increment('blacklistMatches')
-      return
-    if WhiteList and metric not in WhiteList:
-      instrumentation.increment('whitelistRejects')
-      return
-    if datapoint[1] != datapoint[1]: # filter out NaN values
-      return
-    if int(datapoint[0]) == -1: # use current time if none given: https://github.com/graphite-project/carbon/issues/54
-      datapoint = (time.time(), datapoint[1])
-    
-    events.metricReceived(metric, datapoint)
+    self.metricsReceived([(metric, datapoint)])
+
+  def metricsReceived(self, datapoints):
+    """Filters a list of (metric, datapoint) and hands what is left to the
+    metricsReceivedBatch event in one call"""
+    batch = []
+    for (metric, datapoint) in datapoints:
+      if BlackList and metric in BlackList:
+        instrumentation.increment('blacklistMatches')
+        continue
+      if WhiteList and metric not in WhiteList:
+        instrumentation.increment('whitelistRejects')
+        continue
+      if datapoint[1] != datapoint[1]: # filter out NaN values
+        continue
+      if int(datapoint[0]) == -1: # use current time if none given: https://github.com/graphite-project/carbon/issues/54
+        datapoint = (time.time(), datapoint[1])
+      batch.append((metric, datapoint))
+
+    if batch:
+      events.metricsReceivedBatch(batch)
 
 
 class MetricLineReceiver(MetricReceiver, LineOnlyReceiver):
   delimiter = '\n'
+  batch = None # the datapoints parsed from the data being received
+
+  def dataReceived(self, data):
+    self.batch = []
+    try:
+      LineOnlyReceiver.dataReceived(self, data)
+    finally:
+      batch, self.batch = self.batch, None
+      self.metricsReceived(batch)
 
   def lineReceived(self, line):
     try:
@@ -77,19 +101,26 @@ class MetricLineReceiver(MetricReceiver, LineOnlyReceiver):
       log.listener('invalid line received from client %s, ignoring' % self.peerName)
       return
 
-    self.metricReceived(metric, datapoint)
+    if self.batch is None:
+      self.metricReceived(metric, datapoint)
+    else:
+      self.batch.append((metric, datapoint))
 
 
 class MetricDatagramReceiver(MetricReceiver, DatagramProtocol):
   def datagramReceived(self, data, (host, port)):
+    batch = []
     for line in data.splitlines():
       try:
         metric, value, timestamp = line.strip().split()
         datapoint = ( float(timestamp), float(value) )
-
-        self.metricReceived(metric, datapoint)
       except:
         log.listener('invalid line received from %s, ignoring' % host)
+        continue
+
+      batch.append((metric, datapoint))
+
+    self.metricsReceived(batch)
 
 
 class MetricPickleReceiver(MetricReceiver, Int32StringReceiver):
@@ -97,25 +128,41 @@ class MetricPickleReceiver(MetricReceiver, Int32StringReceiver):
 
   def connectionMade(self):
     MetricReceiver.connectionMade(self)
-    self.unpickler = get_unpickler(insecure=settings.USE_INSECURE_UNPICKLER)
+    self.unpickler = get_unpickler(insecure=settings.USE_INSECURE_UNPICKLER, restricted=True)
 
   def stringReceived(self, data):
     try:
-      datapoints = self.unpickler.loads(data)
+      datapoints = parseDatapoints(self.unpickler.loads(data))
     except:
       log.listener('invalid pickle received from %s, ignoring' % self.peerName)
       return
 
-    for (metric, datapoint) in datapoints:
-      try:
-        datapoint = ( float(datapoint[0]), float(datapoint[1]) ) #force proper types
-      except:
-        continue
+    self.metricsReceived(datapoints)
 
-      self.metricReceived(metric, datapoint)
+
+class MetricColumnarReceiver(MetricReceiver, Int32StringReceiver):
+  "Receives the columnar protocol, see carbon.columnar"
+  MAX_LENGTH = 2 ** 20
+
+  def connectionMade(self):
+    MetricReceiver.connectionMade(self)
+    self.decoder = ColumnarDecoder()
+
+  def stringReceived(self, data):
+    try:
+      datapoints = self.decoder.decode(data)
+    except:
+      # Later messages can't be decoded without the names in this one
+      log.listener('invalid columnar message received from %s, disconnecting' % self.peerName)
+      self.transport.loseConnection()
+      return
+
+    self.metricsReceived(datapoints)
 
 
 class CacheManagementHandler(Int32StringReceiver):
+  instrumented = True # False where queries were already counted by another worker
+
   def connectionMade(self):
     peer = self.transport.getPeer()
     self.peerAddr = "%s:%d" % (peer.host, peer.port)
@@ -129,14 +176,30 @@ class CacheManagementHandler(Int32StringReceiver):
       log.query("%s connection lost: %s" % (self.peerAddr, reason.value))
 
   def stringReceived(self, rawRequest):
+    started = time.time()
     request = self.unpickler.loads(rawRequest)
+    # set-metadata goes to the owner too, so that its open whisper file is
+    # invalidated
+    if request['type'] in ('cache-query', 'set-metadata') and state.workerPool and \
+       not state.workerPool.owns(request['metric']):
+      d = state.workerPool.queryOwner(request)
+      d.addErrback(lambda failure: dict(error=failure.getErrorMessage()))
+      d.addCallback(self.sendResult)
+      if request['type'] == 'cache-query':
+        d.addCallback(lambda ignored: self.queryAnswered(started))
+      # Stop reading requests until the owning worker answers so responses
+      # go out in the order the requests came in.
+      if not d.called:
+        self.pauseProducing()
+        d.addBoth(lambda result: self.resumeProducing())
+      return
+
     if request['type'] == 'cache-query':
       metric = request['metric']
       datapoints = MetricCache.get(metric, [])
       result = dict(datapoints=datapoints)
       if settings.LOG_CACHE_HITS is True:
         log.query('[%s] cache query for \"%s\" returned %d values' % (self.peerAddr, metric, len(datapoints)))
-      instrumentation.increment('cacheQueries')
 
     elif request['type'] == 'get-metadata':
       result = management.getMetadata(request['metric'], request['key'])
@@ -147,9 +210,19 @@ class CacheManagementHandler(Int32StringReceiver):
     else:
       result = dict(error="Invalid request type \"%s\"" % request['type'])
 
+    self.sendResult(result)
+    if request['type'] == 'cache-query':
+      self.queryAnswered(started)
+
+  def sendResult(self, result):
     response = pickle.dumps(result, protocol=-1)
     self.sendString(response)
 
+  def queryAnswered(self, started):
+    if self.instrumented:
+      instrumentation.increment('cacheQueries')
+      instrumentation.observe('cacheQueryTimes', time.time() - started)
+
 
 # Avoid import circularities
 from carbon.cache import MetricCache
@@ -40,11 +40,18 @@ class CarbonRootService(MultiService):
 def createBaseService(config):
     from carbon.conf import settings
     from carbon.protocols import (MetricLineReceiver, MetricPickleReceiver,
-                                  MetricDatagramReceiver)
+                                  MetricDatagramReceiver, MetricColumnarReceiver)
 
     root_service = CarbonRootService()
     root_service.setName(settings.program)
 
+    # A pool of cache workers all bind the same receiver ports
+    if settings.program == 'carbon-cache' and settings.CACHE_WORKERS > 1:
+        from carbon.workers import ReusePortTCPServer as ReceiverTCPServer
+        from carbon.workers import ReusePortUDPServer as ReceiverUDPServer
+    else:
+        ReceiverTCPServer, ReceiverUDPServer = TCPServer, UDPServer
+
     use_amqp = settings.get("ENABLE_AMQP", False)
     if use_amqp:
         from carbon import amqp_listener
@@ -64,15 +71,18 @@ def createBaseService(config):
                                        MetricLineReceiver),
                                       (settings.PICKLE_RECEIVER_INTERFACE,
                                        settings.PICKLE_RECEIVER_PORT,
-                                       MetricPickleReceiver)):
+                                       MetricPickleReceiver),
+                                      (settings.COLUMNAR_RECEIVER_INTERFACE,
+                                       settings.COLUMNAR_RECEIVER_PORT,
+                                       MetricColumnarReceiver)):
         if port:
             factory = ServerFactory()
             factory.protocol = protocol
-            service = TCPServer(int(port), factory, interface=interface)
+            service = ReceiverTCPServer(int(port), factory, interface=interface)
             service.setServiceParent(root_service)
 
     if settings.ENABLE_UDP_LISTENER:
-        service = UDPServer(int(settings.UDP_RECEIVER_PORT),
+        service = ReceiverUDPServer(int(settings.UDP_RECEIVER_PORT),
                             MetricDatagramReceiver(),
                             interface=settings.UDP_RECEIVER_INTERFACE)
         service.setServiceParent(root_service)
@@ -115,24 +125,68 @@ def createCacheService(config):
     from carbon.protocols import CacheManagementHandler
 
     # Configure application components
-    events.metricReceived.addHandler(MetricCache.store)
+    MetricCache.configure(settings.CACHE_SHARDS, settings.CACHE_WRITE_STRATEGY,
+                          settings.WRITER_THREADS, settings.CACHE_MEMORY_POLICY)
+
+    if settings.CACHE_WORKERS > 1:
+      from carbon.workers import WorkerPool, getWorkerId
+      state.workerPool = WorkerPool(config, int(settings.CACHE_WORKERS), getWorkerId())
+      events.metricsReceivedBatch.addHandler(state.workerPool.storeBatch)
+    else:
+      events.metricsReceivedBatch.addHandler(MetricCache.storeBatch)
 
     root_service = createBaseService(config)
-    factory = ServerFactory()
-    factory.protocol = CacheManagementHandler
-    service = TCPServer(int(settings.CACHE_QUERY_PORT), factory,
-                        interface=settings.CACHE_QUERY_INTERFACE)
-    service.setServiceParent(root_service)
+
+    if state.workerPool:
+      state.workerPool.setServiceParent(root_service)
 
     # have to import this *after* settings are defined
-    from carbon.writer import WriterService
+    from carbon.writer import WriterService, loadCacheSnapshot, coalescingFor, writeDeadline
+
+    if settings.COALESCE_DATAPOINTS:
+      MetricCache.setCoalescing(coalescingFor)
+    if settings.WRITE_BATCH_INTERVALS > 1:
+      MetricCache.setDeadlines(writeDeadline, settings.WRITE_BATCH_INTERVALS)
+
+    # Restoring before the reactor runs puts the previous run's datapoints in
+    # the cache ahead of anything received
+    storeBatch = state.workerPool.storeBatch if state.workerPool else MetricCache.storeBatch
+    wal = None
+    if settings.ENABLE_WAL:
+      from carbon.wal import WriteAheadLog
+      wal = WriteAheadLog(settings.WAL_DIR, MetricCache, float(settings.WAL_SYNC_INTERVAL),
+                          int(settings.WAL_SEGMENT_SIZE))
+      MetricCache.setWriteAheadLog(wal)
+
+    loadCacheSnapshot(storeBatch)
+    if wal is not None:
+      wal.replay(storeBatch)
+      wal.setServiceParent(root_service)
+
+    if settings.ENABLE_CACHE_SPILL:
+      from carbon.spill import CacheSpill
+      MetricCache.spill = CacheSpill(settings.CACHE_SPILL_DIR, MetricCache,
+                                     int(settings.CACHE_SPILL_SEGMENT_SIZE),
+                                     float(settings.MAX_CACHE_SPILL_SIZE))
+      MetricCache.spill.setServiceParent(root_service)
+
+    # Only the first cache worker serves queries, it forwards them as needed
+    if not state.workerPool or state.workerPool.primary:
+      factory = ServerFactory()
+      factory.protocol = CacheManagementHandler
+      service = TCPServer(int(settings.CACHE_QUERY_PORT), factory,
+                          interface=settings.CACHE_QUERY_INTERFACE)
+      service.setServiceParent(root_service)
 
     service = WriterService()
     service.setServiceParent(root_service)
 
     if settings.USE_FLOW_CONTROL:
       events.cacheFull.addHandler(events.pauseReceivingMetrics)
-      events.cacheSpaceAvailable.addHandler(events.resumeReceivingMetrics)
+      if state.workerPool:
+        events.cacheSpaceAvailable.addHandler(state.workerPool.cacheSpaceAvailable)
+      else:
+        events.cacheSpaceAvailable.addHandler(events.resumeReceivingMetrics)
 
     return root_service
 
@@ -152,6 +206,7 @@ def createAggregatorService(config):
     router = ConsistentHashingRouter()
     client_manager = CarbonClientManager(router)
     client_manager.setServiceParent(root_service)
+    state.clientManager = client_manager
 
     events.metricReceived.addHandler(receiver.process)
     events.metricGenerated.addHandler(client_manager.sendDatapoint)
@@ -189,6 +244,7 @@ def createRelayService(config):
 
     client_manager = CarbonClientManager(router)
     client_manager.setServiceParent(root_service)
+    state.clientManager = client_manager
 
     events.metricReceived.addHandler(client_manager.sendDatapoint)
     events.metricGenerated.addHandler(client_manager.sendDatapoint)
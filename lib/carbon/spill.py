@@ -0,0 +1,237 @@
+"""Spills datapoints to disk instead of pausing the receivers when the
+MetricCache is full, or instead of dropping them when a destination's send
+queue is (see carbon.client.DestinationSpill).
+
+With ENABLE_CACHE_SPILL, datapoints received while the cache holds
+MAX_CACHE_SIZE datapoints or MAX_CACHE_MEMORY bytes are appended to segment files in CACHE_SPILL_DIR.
+Once anything is spilled every datapoint received is spilled too, until the
+spill has been read back, so that datapoints still reach the cache in the
+order they arrived. The spill is read back into the cache, oldest first,
+whenever the writers have brought the cache below 95% of its limits. Only
+when MAX_CACHE_SPILL_SIZE bytes are spilled do datapoints go into the cache
+regardless, triggering USE_FLOW_CONTROL as before.
+
+Datapoints are buffered in chunks of CHUNK_SIZE and marshalled to the
+current segment, which is rotated at CACHE_SPILL_SEGMENT_SIZE bytes. A
+segment is deleted once it has been read back, and once every segment has
+been the buffer is read back straight from memory. Segments are kept across
+restarts and read back after the next startup, the segment that was being
+read is read again from the start. A closed segment's name records how many
+datapoints it holds so the spill's size is known without reading it.
+"""
+
+import os
+import marshal
+from collections import deque
+
+from twisted.application.service import Service
+from twisted.internet.task import LoopingCall
+
+from carbon import log, instrumentation
+
+
+CHUNK_SIZE = 1000
+READ_INTERVAL = 0.1
+READ_BATCH_SIZE = 100000 # most datapoints read back per READ_INTERVAL
+SEGMENT_SUFFIX = '.spill'
+
+
+class SpillSegment(object):
+  def __init__(self, directory, number, count=0):
+    self.directory = directory
+    self.number = number
+    self.count = count # datapoints in the segment
+    self.read = 0 # datapoints read back so far
+    self.path = self.pathFor(count if count else None)
+    self.size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+    self.fh = None
+
+  def pathFor(self, count):
+    if count is None:
+      filename = '%016d%s' % (self.number, SEGMENT_SUFFIX)
+    else:
+      filename = '%016d-%d%s' % (self.number, count, SEGMENT_SUFFIX)
+    return os.path.join(self.directory, filename)
+
+  def chunks(self):
+    "Generates the chunks in the segment, up to the first torn one"
+    fh = open(self.path, 'rb')
+    try:
+      while True:
+        try:
+          yield marshal.load(fh)
+        except (EOFError, ValueError, TypeError):
+          return
+    finally:
+      fh.close()
+
+
+def listSegments(directory):
+  """Returns the segments in directory, oldest first. The datapoints in a
+  segment that wasn't closed, because carbon-cache crashed, are counted by
+  reading it."""
+  segments = []
+  for filename in os.listdir(directory):
+    name, suffix = os.path.splitext(filename)
+    if suffix != SEGMENT_SUFFIX:
+      continue
+    number, _, count = name.partition('-')
+    if not (number.isdigit() and (count.isdigit() or not count)):
+      continue
+    if count:
+      segment = SpillSegment(directory, int(number), int(count))
+    else:
+      segment = SpillSegment(directory, int(number))
+      segment.count = sum([ len(chunk) for chunk in segment.chunks() ])
+    segments.append(segment)
+  segments.sort(key=lambda segment: segment.number)
+  return segments
+
+
+class Spill(Service):
+  """Segment files of datapoints in directory, read back oldest first by the
+  readBack() of a subclass. append() and readBack() run in the reactor
+  thread."""
+  spilledStat = 'spill.spilledPoints'
+  readStat = 'spill.readPoints'
+
+  def __init__(self, directory, segmentSize=64 * 1024 * 1024, maxSize=float('inf')):
+    self.directory = directory
+    self.segmentSize = segmentSize
+    self.maxSize = maxSize
+    self.buffer = []
+    self.size = 0 # datapoints spilled and not yet read back
+    self.bytes = 0 # size of the segment files
+    self.segments = deque() # closed segments, oldest first
+    self.writing = None
+    self.reading = None # chunks() of segments[0]
+    self.nextSegment = 0
+    self.readTask = LoopingCall(self.readBack)
+
+  def __nonzero__(self):
+    return self.size > 0
+
+  def append(self, metric, datapoint):
+    """Spills datapoint unless MAX_CACHE_SPILL_SIZE is reached or the service
+    isn't running, returns whether it was"""
+    if not self.running or self.bytes >= self.maxSize:
+      return False
+    self.buffer.append((metric, datapoint))
+    self.size += 1
+    if len(self.buffer) >= CHUNK_SIZE:
+      self.flush()
+    return True
+
+  def flush(self):
+    "Writes the buffered datapoints to the current segment as one chunk"
+    if not self.buffer:
+      return
+    if self.writing is None:
+      self.writing = SpillSegment(self.directory, self.nextSegment)
+      self.writing.fh = open(self.writing.path, 'wb')
+      self.nextSegment += 1
+
+    segment = self.writing
+    chunk = marshal.dumps(self.buffer)
+    segment.fh.write(chunk)
+    segment.fh.flush()
+    segment.size += len(chunk)
+    segment.count += len(self.buffer)
+    self.bytes += len(chunk)
+    instrumentation.increment(self.spilledStat, len(self.buffer))
+    self.buffer = []
+
+    if segment.size >= self.segmentSize:
+      self.closeSegment()
+
+  def closeSegment(self):
+    "Renames the current segment to record its count and queues it for reading"
+    segment = self.writing
+    segment.fh.close()
+    segment.fh = None
+    path = segment.pathFor(segment.count)
+    os.rename(segment.path, path)
+    segment.path = path
+    self.segments.append(segment)
+    self.writing = None
+
+  def readChunk(self):
+    "Returns the oldest chunk not read back yet, or None if everything has been"
+    while True:
+      if not self.segments:
+        if self.writing is None:
+          # Only the buffer is left, it never has to touch the disk
+          chunk, self.buffer = self.buffer, []
+          if chunk:
+            instrumentation.increment(self.spilledStat, len(chunk))
+          return chunk or None
+        self.closeSegment()
+
+      segment = self.segments[0]
+      if self.reading is None:
+        self.reading = segment.chunks()
+      chunk = next(self.reading, None)
+      if chunk is None:
+        self.finishSegment()
+        continue
+
+      segment.read += len(chunk)
+      if segment.read >= segment.count:
+        self.finishSegment()
+      return chunk
+
+  def finishSegment(self):
+    "Deletes the segment being read back"
+    segment = self.segments.popleft()
+    self.reading = None
+    # A torn chunk at the end of a crashed segment loses its datapoints
+    self.size -= segment.count - segment.read
+    self.bytes -= segment.size
+    os.unlink(segment.path)
+
+  def readBack(self):
+    raise NotImplementedError()
+
+  def startService(self):
+    if not os.path.isdir(self.directory):
+      os.makedirs(self.directory)
+    for segment in listSegments(self.directory):
+      self.segments.append(segment)
+      self.size += segment.count
+      self.bytes += segment.size
+      self.nextSegment = segment.number + 1
+    if self.size:
+      log.msg("reading back %d datapoints spilled before the last shutdown" % self.size)
+    self.readTask.start(READ_INTERVAL, now=False)
+    Service.startService(self)
+
+  def stopService(self):
+    if self.readTask.running:
+      self.readTask.stop()
+    self.flush()
+    if self.writing is not None:
+      self.closeSegment()
+    Service.stopService(self)
+
+
+class CacheSpill(Spill):
+  "The spill tier of cache"
+  def __init__(self, directory, cache, segmentSize=64 * 1024 * 1024, maxSize=float('inf')):
+    Spill.__init__(self, directory, segmentSize, maxSize)
+    self.cache = cache
+
+  def readBack(self):
+    "Moves spilled datapoints into the cache while it has space"
+    try:
+      read = 0
+      while read < READ_BATCH_SIZE and self.size and self.cache.hasSpace():
+        chunk = self.readChunk()
+        if chunk is None:
+          break
+        self.cache.storeBatch(chunk, spilling=False)
+        self.size -= len(chunk)
+        read += len(chunk)
+      if read:
+        instrumentation.increment(self.readStat, read)
+    except:
+      log.err()
@@ -6,3 +6,5 @@ several modules.
 metricReceiversPaused = False
 cacheTooFull = False
 connectedMetricReceiverProtocols = set()
+workerPool = None # carbon.workers.WorkerPool when CACHE_WORKERS > 1
+clientManager = None # carbon.client.CarbonClientManager of carbon-relay and carbon-aggregator
@@ -12,15 +12,22 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License."""
 
-import os, re
+import os, re, time
 import whisper
 
-from os.path import join, exists, sep
+from collections import OrderedDict
+from os.path import join, exists, sep, relpath
+from threading import Lock
 from carbon.conf import OrderedConfigParser, settings
 from carbon.exceptions import CarbonConfigException
 from carbon.util import pickle
 from carbon import log
 
+try:
+  import fcntl
+except ImportError:
+  fcntl = None # whisper.LOCK is never set without it
+
 
 STORAGE_SCHEMAS_CONFIG = join(settings.CONF_DIR, 'storage-schemas.conf')
 STORAGE_AGGREGATION_CONFIG = join(settings.CONF_DIR, 'storage-aggregation.conf')
@@ -31,6 +38,189 @@ def getFilesystemPath(metric):
   return join(settings.LOCAL_DATA_DIR, metric_path)
 
 
+class MetricIndex:
+  """The metrics known to have a whisper file, so the writer does not have to
+  stat() every metric it writes. Metrics missing from the index are still
+  looked up on disk, so an incomplete index only costs a stat() and the
+  writer drops metrics whose files have gone missing with discard().
+
+  The index is filled by scan() and kept across restarts by save() and
+  load(), which use a plain file with one metric per line."""
+
+  def __init__(self, path=None):
+    self.path = path
+    self.metrics = set()
+    self.lock = Lock()
+
+  def __contains__(self, metric):
+    return metric in self.metrics
+
+  def __len__(self):
+    return len(self.metrics)
+
+  def exists(self, metric):
+    if metric in self.metrics:
+      return True
+    if exists(getFilesystemPath(metric)):
+      self.add(metric)
+      return True
+    return False
+
+  def add(self, metric):
+    try:
+      self.lock.acquire()
+      self.metrics.add(metric)
+    finally:
+      self.lock.release()
+
+  def discard(self, metric):
+    try:
+      self.lock.acquire()
+      self.metrics.discard(metric)
+    finally:
+      self.lock.release()
+
+  def update(self, metrics):
+    try:
+      self.lock.acquire()
+      self.metrics.update(metrics)
+    finally:
+      self.lock.release()
+
+  def scan(self, dataDir):
+    "Adds every whisper file found under dataDir"
+    for (root, dirs, files) in os.walk(dataDir):
+      prefix = relpath(root, dataDir).replace(sep, '.')
+      if prefix == '.':
+        prefix = ''
+      else:
+        prefix += '.'
+      self.update([ prefix + name[:-4] for name in files if name.endswith('.wsp') ])
+
+  def load(self):
+    fh = open(self.path, 'rb')
+    try:
+      self.update([ metric for metric in fh.read().split('\n') if metric ])
+    finally:
+      fh.close()
+
+  def save(self):
+    "Writes the index to a temporary file and renames it into place"
+    try:
+      self.lock.acquire()
+      metrics = list(self.metrics)
+    finally:
+      self.lock.release()
+
+    tmpPath = self.path + '.tmp'
+    fh = open(tmpPath, 'wb')
+    try:
+      fh.write('\n'.join(metrics))
+    finally:
+      fh.close()
+    os.rename(tmpPath, self.path)
+
+
+# Every WhisperFileCache, so invalidateWhisperFile() can reach them all
+whisperFileCaches = []
+
+
+def invalidateWhisperFile(path):
+  "Makes every WhisperFileCache reopen path, call it after changing a file"
+  for files in whisperFileCaches:
+    files.invalidated.add(path)
+
+
+class WhisperFileCache:
+  """Keeps up to maxSize whisper files open for updates, closing the least
+  recently used file first. whisper caches the parsed header of each open
+  file (whisper.CACHE_HEADERS) until the file is closed here.
+
+  Every checkInterval seconds the path of an open file is stat()ed, and the
+  file is reopened if the path no longer refers to it, so a file replaced
+  behind carbon's back, e.g. by whisper-resize.py, stops getting updates
+  within checkInterval. invalidateWhisperFile() has a file reopened right
+  away. Each writer thread has its own WhisperFileCache, but invalidation may
+  come from any thread.
+
+  With WHISPER_LOCK_WRITES the lock whisper takes on a file is released after
+  each update, so other processes and management.setMetadata() can still get
+  at the files kept open."""
+  checkInterval = 5
+
+  def __init__(self, maxSize):
+    self.maxSize = maxSize
+    self.files = OrderedDict() # { path : (file, time last checked, (st_dev, st_ino)) }
+    self.invalidated = set()
+    whisperFileCaches.append(self)
+
+  def __len__(self):
+    return len(self.files)
+
+  def open(self, path):
+    while self.invalidated:
+      self.close(self.invalidated.pop())
+
+    now = time.time()
+    entry = self.files.pop(path, None)
+    if entry is not None and now - entry[1] > self.checkInterval:
+      if self.replaced(path, entry[2]):
+        self.closeFile(entry[0])
+        entry = None
+      else:
+        entry = (entry[0], now, entry[2])
+
+    if entry is None:
+      fh = open(path, 'r+b', getattr(whisper, 'BUFFERING', 0))
+      if getattr(whisper, 'CAN_FADVISE', False) and getattr(whisper, 'FADVISE_RANDOM', False):
+        whisper.posix_fadvise(fh.fileno(), 0, 0, whisper.POSIX_FADV_RANDOM)
+      stat = os.fstat(fh.fileno())
+      entry = (fh, now, (stat.st_dev, stat.st_ino))
+      if len(self.files) >= self.maxSize:
+        self.closeFile(self.files.popitem(last=False)[1][0])
+
+    self.files[path] = entry
+    return entry[0]
+
+  def replaced(self, path, fileId):
+    "Whether path no longer refers to the file identified by fileId"
+    try:
+      stat = os.stat(path)
+    except OSError:
+      return True
+    return (stat.st_dev, stat.st_ino) != fileId
+
+  def update_many(self, path, points):
+    "Does what whisper.update_many() does, but on a cached file"
+    if not points:
+      return
+    points = [ (int(t), float(v)) for (t, v) in points ]
+    points.sort(key=lambda p: p[0], reverse=True)
+    fh = self.open(path)
+    try:
+      try:
+        whisper.file_update_many(fh, points)
+      finally:
+        if whisper.LOCK:
+          fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+    except:
+      self.close(path)
+      raise
+
+  def close(self, path):
+    entry = self.files.pop(path, None)
+    if entry is not None:
+      self.closeFile(entry[0])
+
+  def closeFile(self, fh):
+    getattr(whisper, '__headerCache', {}).pop(fh.name, None)
+    fh.close()
+
+  def closeAll(self):
+    while self.files:
+      self.closeFile(self.files.popitem()[1][0])
+
+
 class Schema:
   def test(self, metric):
     raise NotImplementedError()
@@ -79,7 +269,8 @@ class ListSchema(Schema):
       self.mtime = 0
       self.members = frozenset()
 
-  def test(self, metric):
+  def refresh(self):
+    "Reloads the list if it has changed on disk, returns True if it did"
     if exists(self.path):
       current_mtime = os.stat(self.path).st_mtime
 
@@ -88,7 +279,11 @@ class ListSchema(Schema):
         fh = open(self.path, 'rb')
         self.members = pickle.load(fh)
         fh.close()
+        return True
+
+    return False
 
+  def test(self, metric):
     return metric in self.members
 
 
@@ -190,6 +385,84 @@ def loadAggregationSchemas():
   schemaList.append(defaultAggregation)
   return schemaList
 
+def firstMatch(schemaList, metric):
+  for schema in schemaList:
+    if schema.matches(metric):
+      return schema
+  return None
+
+
+class SchemaMatcher:
+  """Resolves metrics to their (storage schema, aggregation schema) and
+  memoizes up to cacheSize results in an LRU.
+
+  reload() only re-reads the config files when their mtimes have changed
+  and swaps in the new schemas and an empty memo with a single assignment,
+  so writer threads never see a half loaded configuration. Lists referenced
+  by list= schemas are also only checked for changes by reload()."""
+
+  def __init__(self, cacheSize=100000):
+    self.cacheSize = cacheSize
+    self.lock = Lock()
+    self.mtimes = None
+    self.state = None # (schemas, aggregation schemas, memo)
+    self.reload()
+
+  def configMtimes(self):
+    mtimes = []
+    for path in (STORAGE_SCHEMAS_CONFIG, STORAGE_AGGREGATION_CONFIG):
+      try:
+        mtimes.append(os.stat(path).st_mtime)
+      except OSError:
+        mtimes.append(None)
+    return tuple(mtimes)
+
+  def reload(self):
+    "Returns True if the schemas changed"
+    mtimes = self.configMtimes()
+
+    if mtimes != self.mtimes:
+      self.state = (loadStorageSchemas(), loadAggregationSchemas(), OrderedDict())
+      self.mtimes = mtimes
+      return True
+
+    schemas, aggSchemas, memo = self.state
+    listsChanged = False
+    for schema in schemas + aggSchemas:
+      if isinstance(schema, ListSchema) and schema.refresh():
+        listsChanged = True
+
+    if listsChanged:
+      self.state = (schemas, aggSchemas, OrderedDict())
+    return listsChanged
+
+  def match(self, metric):
+    """Returns (storage schema, aggregation schema) for metric, either may be
+    None if nothing matched"""
+    schemas, aggSchemas, memo = self.state
+
+    try:
+      self.lock.acquire()
+      result = memo.pop(metric, None)
+      if result is not None:
+        memo[metric] = result
+        return result
+    finally:
+      self.lock.release()
+
+    result = (firstMatch(schemas, metric), firstMatch(aggSchemas, metric))
+
+    try:
+      self.lock.acquire()
+      memo[metric] = result
+      if len(memo) > self.cacheSize:
+        memo.popitem(last=False)
+    finally:
+      self.lock.release()
+
+    return result
+
+
 defaultArchive = Archive(60, 60 * 24 * 7) #default retention for unclassified data (7 days of minutely data)
 defaultSchema = DefaultSchema('default', [defaultArchive])
 defaultAggregation = DefaultSchema('default', (None, None))
@@ -0,0 +1,434 @@
+import os
+import time
+import tempfile
+import threading
+from unittest import TestCase
+from carbon.cache import ShardedMetricCache, DatapointQueue, writeSnapshot, readSnapshot
+from carbon.exceptions import CarbonConfigException
+from carbon import cache as cache_module
+from carbon import conf, state, instrumentation
+
+
+class DatapointQueueTest(TestCase):
+
+    def test_datapoints_are_float_tuples(self):
+        queue = DatapointQueue()
+        queue.append((1, 2))
+        queue.append((3.5, 4.5))
+        self.assertEqual(2, len(queue))
+        self.assertEqual([(1.0, 2.0), (3.5, 4.5)], queue.datapoints())
+        self.assertTrue(isinstance(queue.datapoints()[0][0], float))
+        self.assertEqual(queue.datapoints(), list(queue))
+
+
+class CoalescingTest(TestCase):
+
+    def setUp(self):
+        self.cache = ShardedMetricCache(4)
+        self.cache.setCoalescing(lambda metric: 0 if metric == "raw" else 60)
+
+    def test_keeps_the_last_point_within_a_step(self):
+        for (timestamp, value) in ((60, 1.0), (90, 5.0), (119, 2.0), (120, 3.0)):
+            self.cache.store("last", (timestamp, value))
+            self.cache.store("raw", (timestamp, value))
+        self.assertEqual(6, self.cache.size)
+        self.assertEqual([(119, 2.0), (120, 3.0)], self.cache.pop("last"))
+        self.assertEqual(4, len(self.cache.pop("raw")))
+        self.assertEqual(2, sum([shard.coalesced for shard in self.cache.shards]))
+
+    def test_pop_between_points_of_a_step(self):
+        """Whether or not the writer pops the queue within an interval, the
+        last datapoint written for it is the one kept without a pop."""
+        written = []
+        for (timestamp, value) in ((60, 1.0), (90, 5.0), (119, 2.0)):
+            self.cache.store("popped", (timestamp, value))
+            written.extend(self.cache.pop("popped"))
+            self.cache.store("kept", (timestamp, value))
+        self.assertEqual(written[-1:], self.cache.pop("kept"))
+
+    def test_survives_configure(self):
+        self.cache.configure(8)
+        self.cache.store("last", (60, 1.0))
+        self.cache.store("last", (61, 2.0))
+        self.assertEqual([(61, 2.0)], self.cache.pop("last"))
+
+
+class ShardedMetricCacheTest(TestCase):
+
+    def setUp(self):
+        self.cache = ShardedMetricCache(4)
+
+    def test_store_and_pop(self):
+        """Datapoints come back out of pop() in the order they were stored."""
+        self.cache.store("a.b", (1, 1.0))
+        self.cache.store("a.b", (2, 2.0))
+        self.assertEqual(2, self.cache.size)
+        self.assertEqual([(1, 1.0), (2, 2.0)], self.cache.pop("a.b"))
+        self.assertEqual(0, self.cache.size)
+        self.assertFalse(self.cache)
+
+    def test_store_batch(self):
+        batch = [("metric.%d" % (i % 10), (i, i)) for i in range(100)]
+        self.cache.storeBatch(batch)
+        self.assertEqual(10, len(self.cache))
+        self.assertEqual(100, self.cache.size)
+        self.assertEqual([(i, i) for i in range(3, 100, 10)],
+                         self.cache.pop("metric.3"))
+
+    def test_store_batch_drops_numbers_too_large_for_a_double(self):
+        self.cache.storeBatch([("a.b", (60, 1.0)), ("a.c", (60, 10 ** 400)), ("a.d", (60, 2.0))])
+        self.cache.store("a.b", (10 ** 400, 3.0))
+        self.assertEqual(2, self.cache.size)
+        self.assertEqual(["a.b", "a.d"], sorted(dict(self.cache.counts())))
+        self.assertEqual([(60, 1.0)], self.cache.pop("a.b"))
+        self.assertEqual([(60, 2.0)], self.cache.pop("a.d"))
+        self.assertEqual(0, self.cache.size)
+        self.assertEqual(2, sum([shard.invalid for shard in self.cache.shards]))
+
+    def test_store_into_existing_queue_matches_store_batch(self):
+        self.cache.store("a.b", (60, 1.0))
+        self.cache.store("a.b", (120, 10 ** 400))
+        self.cache.store("a.b", ("180", "3"))
+        self.assertEqual(2, self.cache.size)
+        self.assertEqual([(60, 1.0), (180, 3.0)], self.cache.pop("a.b"))
+        self.assertEqual(1, sum([shard.invalid for shard in self.cache.shards]))
+
+    def test_pop_missing_metric_raises_keyerror(self):
+        self.assertRaises(KeyError, self.cache.pop, "missing")
+
+    def test_counts_and_len_span_all_shards(self):
+        for i in range(100):
+            self.cache.store("metric.%d" % i, (i, i))
+        self.cache.store("metric.0", (100, 100))
+        self.assertEqual(100, len(self.cache))
+        self.assertEqual(101, self.cache.size)
+        counts = dict(self.cache.counts())
+        self.assertEqual(2, counts["metric.0"])
+        self.assertEqual(1, counts["metric.99"])
+        self.assertTrue(len([s for s in self.cache.shards if s]) > 1)
+
+    def test_get_returns_a_copy(self):
+        self.cache.store("a.b", (1, 1.0))
+        datapoints = self.cache.get("a.b", [])
+        datapoints.append((2, 2.0))
+        self.assertEqual([(1, 1.0)], self.cache.get("a.b"))
+        self.assertEqual([], self.cache.get("missing", []))
+
+    def test_configure_rehashes_existing_datapoints(self):
+        self.cache.store("a.b", (1, 1.0))
+        self.cache.configure(16)
+        self.assertEqual(16, len(self.cache.shards))
+        self.assertEqual([(1, 1.0)], self.cache.pop("a.b"))
+
+    def test_largest_metric_follows_queue_size(self):
+        self.assertEqual(None, self.cache.largestMetric())
+        for i in range(10):
+            self.cache.store("small.%d" % i, (i, i))
+        for i in range(5):
+            self.cache.store("big", (i, i))
+        self.cache.store("medium", (1, 1))
+        self.cache.store("medium", (2, 2))
+        self.assertEqual("big", self.cache.largestMetric())
+        self.cache.pop("big")
+        self.assertEqual("medium", self.cache.largestMetric())
+        self.cache.pop("medium")
+        self.assertTrue(self.cache.largestMetric().startswith("small."))
+        for i in range(10):
+            self.cache.pop("small.%d" % i)
+        self.assertEqual(None, self.cache.largestMetric())
+
+    def test_is_full(self):
+        self.addCleanup(conf.settings.__setitem__, "MAX_CACHE_SIZE",
+                        conf.settings.MAX_CACHE_SIZE)
+        conf.settings["MAX_CACHE_SIZE"] = 2
+        self.cache.shardFor("a.b").store("a.b", (1, 1.0))
+        self.assertFalse(self.cache.isFull())
+        self.cache.shardFor("c.d").store("c.d", (1, 1.0))
+        self.assertTrue(self.cache.isFull())
+
+
+class MemoryPolicyTest(TestCase):
+
+    def setUp(self):
+        for name in ("MAX_CACHE_MEMORY", "MAX_CACHE_SIZE"):
+            self.addCleanup(conf.settings.__setitem__, name, conf.settings[name])
+        self.addCleanup(setattr, state, "instrumentation", state.instrumentation)
+        state.instrumentation = instrumentation
+        instrumentation.stats.clear()
+        conf.settings["MAX_CACHE_MEMORY"] = 3 * (cache_module.QUEUE_BYTES + 3)
+
+    def test_bytes_are_tracked(self):
+        cache = ShardedMetricCache(4)
+        cache.store("a.b", (1, 1.0))
+        cache.store("a.b", (2, 2.0))
+        self.assertEqual(cache_module.QUEUE_BYTES + 3 + 2 * cache_module.POINT_BYTES,
+                         cache.bytes)
+        cache.pop("a.b")
+        self.assertEqual(0, cache.bytes)
+
+    def test_drop_newest(self):
+        cache = ShardedMetricCache(4, policy='drop-newest')
+        for name in ("a.a", "b.b", "c.c", "d.d"):
+            cache.store(name, (1, 1.0))
+        self.assertTrue(cache.isFull())
+        self.assertFalse("d.d" in cache)
+        self.assertEqual(1, instrumentation.stats['cache.droppedNewest'])
+
+        cache.pop("a.a")
+        cache.store("d.d", (1, 1.0))
+        self.assertTrue("d.d" in cache)
+
+    def test_drop_newest_batch(self):
+        cache = ShardedMetricCache(4, policy='drop-newest')
+        cache.storeBatch([(name, (1, 1.0)) for name in ("a.a", "b.b", "c.c")])
+        self.assertTrue(cache.isFull())
+        cache.storeBatch([("a.a", (2, 2.0)), ("d.d", (1, 1.0))])
+        self.assertEqual(3, cache.size)
+        self.assertEqual(2, instrumentation.stats['cache.droppedNewest'])
+
+    def test_drop_oldest(self):
+        cache = ShardedMetricCache(4, policy='drop-oldest')
+        for name in ("a.a", "b.b", "c.c"):
+            cache.store(name, (1, 1.0))
+            time.sleep(0.001)
+        self.assertFalse("a.a" in cache)
+        self.assertTrue("c.c" in cache)
+        self.assertEqual(1, instrumentation.stats['cache.droppedOldest'])
+
+    def test_invalid_policy(self):
+        self.assertRaises(CarbonConfigException, ShardedMetricCache, 4, policy='bogus')
+
+
+class DrainStrategyTest(TestCase):
+
+    def drain(self, cache):
+        order = []
+        while cache:
+            metric = cache.strategy.chooseItem()
+            order.append(metric)
+            cache.pop(metric)
+        self.assertEqual(None, cache.strategy.chooseItem())
+        return order
+
+    def test_invalid_strategy(self):
+        self.assertRaises(CarbonConfigException, ShardedMetricCache, 4,
+                          "bogus")
+
+    def test_max_strategy(self):
+        cache = ShardedMetricCache(4, "max")
+        cache.store("one", (1, 1))
+        for i in range(4):
+            cache.store("four", (i, i))
+        self.assertEqual(["four", "one"], self.drain(cache))
+
+    def test_oldest_strategy(self):
+        clock = iter(range(100)).next
+        self.addCleanup(setattr, cache_module.time, "time",
+                        cache_module.time.time)
+        cache_module.time.time = lambda: float(clock())
+        cache = ShardedMetricCache(4, "oldest")
+        for metric in ("c", "a", "b"):
+            cache.store(metric, (1, 1))
+        for i in range(8):
+            cache.store("b", (i, i))
+        self.assertEqual(["c", "a", "b"], self.drain(cache))
+
+    def test_path_strategy(self):
+        cache = ShardedMetricCache(4, "path")
+        for metric in ("b.a", "a.b.c", "a.b-c", "a.a"):
+            cache.store(metric, (1, 1))
+        self.assertEqual(["a.a", "a.b-c", "a.b.c", "b.a"], self.drain(cache))
+
+    def test_order_due(self):
+        cache = ShardedMetricCache(4, "max")
+        cache.store("one", (1, 1))
+        for i in range(4):
+            cache.store("four", (i, i))
+        cache.store("two", (1, 1))
+        cache.store("two", (2, 2))
+        self.assertEqual(["four", "two", "one"],
+                         cache.strategy.orderDue(list(cache.queues())))
+
+        cache = ShardedMetricCache(4, "path")
+        for metric in ("b", "c", "a"):
+            cache.store(metric, (1, 1))
+        self.assertEqual(["a", "b", "c"],
+                         cache.strategy.orderDue(list(cache.queues())))
+
+    def test_naive_strategy_visits_every_metric(self):
+        cache = ShardedMetricCache(4, "naive")
+        for i in range(10):
+            cache.store("metric.%d" % i, (1, 1))
+        self.assertEqual(10, len(set(self.drain(cache))))
+
+
+class ArrivalsTest(TestCase):
+
+    def test_stale_arrivals_are_compacted(self):
+        cache = ShardedMetricCache(1, "max", policy='drop-oldest')
+        shard = cache.shards[0]
+        cache.store("starved", (1, 1.0))
+        for i in range(5000):
+            cache.store("busy", (i, 1.0))
+            cache.pop("busy")
+        self.assertTrue(len(shard.arrivals) <= 2 * len(shard) + cache_module.ARRIVALS_SLACK)
+        self.assertEqual("starved", cache.oldestMetric())
+
+    def test_overdue_metric(self):
+        clock = iter(range(100)).next
+        self.addCleanup(setattr, cache_module.time, "time",
+                        cache_module.time.time)
+        cache_module.time.time = lambda: float(clock())
+        cache = ShardedMetricCache(4, "oldest")
+        cache.store("old", (1, 1.0))
+        cache.store("new", (1, 1.0))
+        self.assertEqual(None, cache.overdueMetric(0.0))
+        self.assertEqual("old", cache.overdueMetric(1.0))
+
+    def test_overdue_metric_needs_arrivals(self):
+        cache = ShardedMetricCache(4, "max")
+        cache.store("old", (1, 1.0))
+        self.assertEqual(None, cache.overdueMetric(time.time() + 1))
+
+
+class DeadlineTest(TestCase):
+
+    def setUp(self):
+        self.cache = ShardedMetricCache(4)
+        self.cache.setDeadlines(lambda metric: 60, 3)
+
+    def due(self, now):
+        return sorted([ metric for (metric, queue) in self.cache.dueQueues(now) ])
+
+    def test_queue_is_due_at_its_deadline(self):
+        self.cache.store("a", (1, 1.0))
+        queue = dict(self.cache.queues())["a"]
+        self.assertEqual(queue.created + 60, queue.deadline)
+        self.assertEqual([], self.due(queue.deadline - 1))
+        self.assertEqual(["a"], self.due(queue.deadline))
+        # It stays due until it is written
+        self.assertEqual(["a"], self.due(queue.deadline))
+        self.cache.pop("a")
+        self.assertEqual([], self.due(queue.deadline))
+
+    def test_queue_is_due_with_a_full_batch(self):
+        for i in range(3):
+            self.cache.store("full", (i, 1.0))
+        for i in range(2):
+            self.cache.store("partial", (i, 1.0))
+        self.assertEqual(["full"], self.due(time.time()))
+        self.cache.pop("full")
+        self.cache.store("full", (4, 1.0))
+        self.assertEqual([], self.due(time.time()))
+
+    def test_existing_queues_are_indexed(self):
+        cache = ShardedMetricCache(4)
+        cache.store("a", (1, 1.0))
+        cache.setDeadlines(lambda metric: 0, 3)
+        self.assertEqual(["a"], [ metric for (metric, queue) in cache.dueQueues(time.time()) ])
+
+    def test_reconfigure_keeps_deadlines(self):
+        self.cache.store("a", (1, 1.0))
+        self.cache.configure(8)
+        self.assertEqual(["a"], self.due(time.time() + 60))
+
+    def test_stale_deadlines_are_compacted(self):
+        self.cache.configure(1)
+        shard = self.cache.shards[0]
+        for i in range(5000):
+            self.cache.store("busy", (i, 1.0))
+            self.cache.pop("busy")
+        self.assertTrue(len(shard.deadlines) <= cache_module.ARRIVALS_SLACK + 1)
+
+
+class PartitionTest(TestCase):
+
+    def test_shards_are_rounded_up_to_the_writers(self):
+        cache = ShardedMetricCache(5, writers=2)
+        self.assertEqual(6, cache.shardCount)
+        self.assertEqual([3, 3], [len(p.shards) for p in cache.partitions])
+
+    def test_partitions_split_the_metrics(self):
+        cache = ShardedMetricCache(8, writers=3)
+        metrics = ["metric.%d" % i for i in range(200)]
+        for metric in metrics:
+            cache.store(metric, (1, 1.0))
+        owned = [set(partition) for partition in cache.partitions]
+        self.assertEqual(set(metrics), set.union(*owned))
+        self.assertEqual(len(metrics), sum([len(o) for o in owned]))
+        for metric in metrics:
+            self.assertEqual(1, len([p for p in cache.partitions if metric in p]))
+        self.assertEqual(cache.size, sum([p.size for p in cache.partitions]))
+
+    def test_partition_strategy_only_drains_its_shards(self):
+        cache = ShardedMetricCache(4, writers=2)
+        for i in range(50):
+            cache.store("metric.%d" % i, (1, 1.0))
+        partition = cache.partitions[1]
+        drained = []
+        while True:
+            metric = partition.strategy.chooseItem()
+            if metric is None:
+                break
+            drained.append(metric)
+            partition.pop(metric)
+        self.assertFalse(partition)
+        self.assertEqual(len(drained), 50 - len(cache))
+        self.assertTrue(cache.partitions[0])
+
+
+class PartitionWakeupTest(TestCase):
+
+    def test_store_wakes_waiting_writer(self):
+        cache = ShardedMetricCache(4, writers=2)
+        partition = cache.partitions[0]
+        metric = [m for m in ("metric.%d" % i for i in range(100))
+                  if hash(m) % 4 % 2 == 0][0]
+        result = []
+        waiter = threading.Thread(target=lambda: result.append(partition.waitForData(5)))
+        started = time.time()
+        waiter.start()
+        while not partition.waiting:
+            time.sleep(0.001)
+        cache.store(metric, (1, 1.0))
+        waiter.join()
+        self.assertEqual([True], result)
+        self.assertTrue(time.time() - started < 5)
+
+    def test_wait_times_out_when_empty(self):
+        partition = ShardedMetricCache(2).partitions[0]
+        self.assertFalse(partition.waitForData(0.01))
+        self.assertFalse(partition.waiting)
+
+
+class SnapshotTest(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mktemp(suffix='.snapshot')
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def test_round_trip(self):
+        cache = ShardedMetricCache(4)
+        for i in range(2500):
+            cache.store('metric%d' % i, (60, float(i)))
+        cache.store('metric0', (120, 1.5))
+        writeSnapshot(self.path, cache.queues())
+
+        restored = ShardedMetricCache(4)
+        for metric, datapoints in readSnapshot(self.path):
+            for datapoint in datapoints:
+                restored.store(metric, datapoint)
+        self.assertEqual(cache.size, restored.size)
+        self.assertEqual([(60, 0.0), (120, 1.5)], restored.pop('metric0'))
+        self.assertEqual([(60, 2499.0)], restored.pop('metric2499'))
+
+    def test_truncated_snapshot_raises(self):
+        cache = ShardedMetricCache(1)
+        cache.store('foo', (60, 1.0))
+        writeSnapshot(self.path, cache.queues())
+        with open(self.path, 'r+b') as fh:
+            fh.truncate(os.path.getsize(self.path) - 1)
+        self.assertRaises(EOFError, list, readSnapshot(self.path))
@@ -0,0 +1,115 @@
+import shutil
+import tempfile
+from unittest import TestCase
+
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+
+from carbon import client, spill
+from carbon import conf
+from carbon.util import pickle
+
+
+class SendSchedulingTest(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.addCleanup(setattr, client, "reactor", client.reactor)
+        client.reactor = self.clock
+        self.factory = client.CarbonClientFactory(("127.0.0.1", 2004, None))
+        self.transport = StringTransport()
+        self.factory.buildProtocol(None).makeConnection(self.transport)
+        self.messages = []
+        self.factory.connectedProtocol.sendString = self.messages.append
+
+    def test_one_send_per_batch(self):
+        for i in range(10):
+            self.factory.sendDatapoint("a.b", (i, i))
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+        self.clock.advance(conf.settings.TIME_TO_DEFER_SENDING)
+        self.assertEqual(1, len(self.messages))
+        self.assertFalse(self.factory.hasQueuedDatapoints())
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_full_message_is_sent_early(self):
+        self.addCleanup(setattr, conf.settings, "TIME_TO_DEFER_SENDING",
+                        conf.settings.TIME_TO_DEFER_SENDING)
+        conf.settings.TIME_TO_DEFER_SENDING = 10
+        for i in range(conf.settings.MAX_DATAPOINTS_PER_MESSAGE):
+            self.factory.sendDatapoint("a.b", (i, i))
+        self.clock.advance(0)
+        self.assertEqual(1, len(self.messages))
+
+
+class DestinationSpillTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.addCleanup(setattr, conf.settings, "MAX_QUEUE_SIZE",
+                        conf.settings.MAX_QUEUE_SIZE)
+        conf.settings.MAX_QUEUE_SIZE = 10
+        self.addCleanup(setattr, spill, "CHUNK_SIZE", spill.CHUNK_SIZE)
+        spill.CHUNK_SIZE = 4
+        self.addCleanup(setattr, client, "reactor", client.reactor)
+        client.reactor = Clock()
+        self.factory = client.CarbonClientFactory(("127.0.0.1", 2004, None),
+                                                  spillDir=self.directory)
+        self.factory.spill.startService()
+        self.factory.spill.readTask.stop()
+
+    def test_overflow_is_spilled_and_read_back_in_order(self):
+        for i in range(25):
+            self.factory.sendDatapoint("a.b", (i, i))
+        self.assertEqual(10, self.factory.queueSize)
+        self.assertEqual(15, self.factory.spill.size)
+
+        # Nothing is read back until the destination is connected
+        self.factory.spill.readBack()
+        self.assertEqual(15, self.factory.spill.size)
+
+        self.factory.buildProtocol(None)
+        self.factory.queue.clear()
+        # Up to MAX_QUEUE_SIZE, a chunk at a time
+        self.factory.spill.readBack()
+        self.assertEqual(12, self.factory.queueSize)
+        received = self.factory.takeSomeFromQueue()
+        self.factory.spill.readBack()
+        self.assertEqual(0, self.factory.spill.size)
+        self.assertEqual([("a.b", (i, i)) for i in range(10, 25)],
+                         received + list(self.factory.queue))
+
+    def test_spill_drains_while_datapoints_keep_arriving(self):
+        self.addCleanup(setattr, client, "SEND_QUEUE_LOW_WATERMARK",
+                        client.SEND_QUEUE_LOW_WATERMARK)
+        client.SEND_QUEUE_LOW_WATERMARK = 8
+        clock = client.reactor
+        readTask = self.factory.spill.readTask
+        readTask.clock = clock
+        readTask.start(spill.READ_INTERVAL, now=False)
+        self.addCleanup(readTask.stop)
+        sent = 0
+        for sent in range(25):
+            self.factory.sendDatapoint("a.b", (sent, sent))
+        sent += 1
+        self.assertEqual(15, self.factory.spill.size)
+        protocol = self.factory.buildProtocol(None)
+        messages = []
+        protocol.sendString = messages.append
+        protocol.makeConnection(StringTransport())
+
+        # 2000 datapoints a second, the timer alone would read back at most
+        # MAX_QUEUE_SIZE per READ_INTERVAL
+        for step in range(500):
+            for i in range(2):
+                self.factory.sendDatapoint("a.b", (sent, sent))
+                sent += 1
+            clock.advance(0.001)
+        self.assertTrue(self.factory.spill.size < 10)
+        clock.advance(0.001)
+        self.assertEqual(0, self.factory.spill.size)
+
+        received = []
+        for message in messages:
+            received.extend(pickle.loads(message))
+        self.assertEqual([("a.b", (i, i)) for i in range(sent)], received)
@@ -0,0 +1,64 @@
+from unittest import TestCase
+
+from carbon import columnar
+from carbon.columnar import ColumnarEncoder, ColumnarDecoder
+
+
+class ColumnarProtocolTest(TestCase):
+
+    def setUp(self):
+        self.encoder = ColumnarEncoder()
+        self.decoder = ColumnarDecoder()
+
+    def roundTrip(self, datapoints):
+        return self.decoder.decode(self.encoder.encode(datapoints))
+
+    def test_names_are_sent_once(self):
+        first = [("a.b", (60, 1.0)), ("a.c", (60, 2.5)), ("a.b", (120, 3))]
+        self.assertEqual([("a.b", (60.0, 1.0)), ("a.c", (60.0, 2.5)),
+                          ("a.b", (120.0, 3.0))], self.roundTrip(first))
+        message = self.encoder.encode([("a.c", (180, 4.0))])
+        self.assertFalse("a.c" in message)
+        self.assertEqual([("a.c", (180.0, 4.0))], self.decoder.decode(message))
+
+    def test_compression(self):
+        self.encoder = ColumnarEncoder(compressionLevel=6)
+        datapoints = [("a.b.%d" % i, (60, float(i))) for i in range(100)]
+        self.assertEqual(datapoints, self.roundTrip(datapoints))
+
+    def test_dictionary_reset(self):
+        self.addCleanup(setattr, columnar, "MAX_NAMES", columnar.MAX_NAMES)
+        columnar.MAX_NAMES = 2
+        self.roundTrip([("a", (60, 1.0)), ("b", (60, 1.0))])
+        self.assertEqual([("c", (60.0, 1.0)), ("a", (60.0, 2.0))],
+                         self.roundTrip([("c", (60, 1.0)), ("a", (60, 2.0))]))
+        self.assertEqual(["a", "c"], sorted(self.decoder.names))
+
+    def test_decoder_limits_names(self):
+        self.addCleanup(setattr, columnar, "MAX_NAMES", columnar.MAX_NAMES)
+        columnar.MAX_NAMES = 2
+        self.roundTrip([("a", (60, 1.0)), ("b", (60, 1.0))])
+        # As sent by a peer that never resets its dictionary
+        columnar.MAX_NAMES = 3
+        message = self.encoder.encode([("c", (60, 1.0))])
+        columnar.MAX_NAMES = 2
+        self.assertRaises(ValueError, self.decoder.decode, message)
+
+    def test_drops_unencodable_names(self):
+        self.assertEqual([("a", (60.0, 1.0)), ("\xc3\xa9", (60.0, 1.0))],
+                         self.roundTrip([("", (60, 1.0)), ("a\0b", (60, 1.0)),
+                                         ("a", (60, 1.0)), (u"\xe9", (60, 1.0))]))
+
+    def test_truncated_message_raises(self):
+        message = self.encoder.encode([("a", (60, 1.0))])
+        self.assertRaises(ValueError, self.decoder.decode, message[:-1])
+
+    def test_unknown_name_raises(self):
+        self.encoder.encode([("a", (60, 1.0))])
+        message = self.encoder.encode([("a", (120, 1.0))])
+        self.assertRaises(IndexError, self.decoder.decode, message)
+
+    def test_drops_numbers_too_large_for_a_double(self):
+        self.assertEqual([("a.b", (60.0, 1.0)), ("a.d", (60.0, 2.0))],
+                         self.roundTrip([("a.b", (60, 1.0)), ("a.c", (60, 10 ** 400)),
+                                         ("a.d", (60, 2.0))]))
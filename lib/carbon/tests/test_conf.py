@@ -353,3 +353,27 @@ class ReadConfigTest(MockerTestCase):
                         pidfile=None, logdir=None),
             ROOT_DIR="foo")
         self.assertEqual("boo/carbon-foo-x", settings.LOG_DIR)
+
+    def test_worker_state_paths_from_config_get_the_worker_id(self):
+        """
+        Paths a cache worker keeps its own state in get the worker id added
+        when they are set in the configuration file.
+        """
+        config = self.makeFile(
+            content=("[cache]\nWAL_DIR = /var/carbon/wal/\n"
+                     "CACHE_SNAPSHOT_FILE = /var/carbon/cache.snapshot"))
+        orig_value = os.environ.get("CARBON_CACHE_WORKER", None)
+        if orig_value is not None:
+            self.addCleanup(os.environ.__setitem__, "CARBON_CACHE_WORKER", orig_value)
+        else:
+            self.addCleanup(os.environ.__delitem__, "CARBON_CACHE_WORKER")
+        os.environ["CARBON_CACHE_WORKER"] = "2"
+        settings = read_config(
+            "carbon-cache",
+            FakeOptions(config=config, instance="a",
+                        pidfile="/run/carbon-cache-a-worker-2.pid", logdir=None),
+            ROOT_DIR="foo")
+        self.assertEqual("/var/carbon/wal-worker-2", settings.WAL_DIR)
+        self.assertEqual("/var/carbon/cache-worker-2.snapshot", settings.CACHE_SNAPSHOT_FILE)
+        self.assertEqual("/run/carbon-cache-a-worker-2.metrics", settings.METRIC_INDEX_FILE)
+        self.assertEqual("/run/carbon-cache-a-worker-2.spill", settings.CACHE_SPILL_DIR)
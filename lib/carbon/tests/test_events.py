@@ -0,0 +1,25 @@
+from unittest import TestCase
+
+from carbon.events import PointEvent, BatchEvent
+
+
+class BatchEventTest(TestCase):
+
+    def setUp(self):
+        self.pointEvent = PointEvent('pointEvent')
+        self.batchEvent = BatchEvent('batchEvent', self.pointEvent)
+        self.batches = []
+        self.points = []
+        self.batchEvent.addHandler(self.batches.append)
+        self.pointEvent.addHandler(lambda metric, datapoint: self.points.append((metric, datapoint)))
+
+    def test_point_handlers_get_every_datapoint(self):
+        batch = [("a", (1, 1.0)), ("b", (1, 2.0))]
+        self.batchEvent(batch)
+        self.assertEqual([batch], self.batches)
+        self.assertEqual(batch, self.points)
+
+    def test_point_event_sends_a_batch_of_one(self):
+        self.pointEvent("a", (1, 1.0))
+        self.assertEqual([[("a", (1, 1.0))]], self.batches)
+        self.assertEqual([("a", (1, 1.0))], self.points)
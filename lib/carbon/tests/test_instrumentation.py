@@ -0,0 +1,97 @@
+import sys
+import threading
+from unittest import TestCase
+
+from carbon import instrumentation
+from carbon.instrumentation import Histogram
+
+
+class HistogramTest(TestCase):
+
+    def test_percentiles_are_within_bucket_error(self):
+        histogram = Histogram()
+        for i in range(1, 1001):
+            histogram.add(i / 1000.0)
+        self.assertEqual(1000, len(histogram))
+        self.assertEqual(1.0, histogram.max)
+        self.assertAlmostEqual(0.5005, histogram.mean())
+        for q in (0.5, 0.9, 0.99):
+            value = histogram.percentile(q)
+            self.assertTrue(q <= value <= q * Histogram.growth, (q, value))
+
+    def test_memory_is_bounded(self):
+        histogram = Histogram()
+        for i in range(100000):
+            histogram.add(i * 0.0001)
+        self.assertTrue(len(histogram.buckets) < 400)
+        self.assertEqual(histogram.max, histogram.percentile(1))
+
+    def test_merge_snapshot(self):
+        first, second = Histogram(), Histogram()
+        first.add(0.001)
+        second.add(0.1)
+        second.add(0.2)
+        first.merge(second.snapshot())
+        self.assertEqual(3, len(first))
+        self.assertEqual(0.2, first.max)
+        self.assertAlmostEqual(0.301, first.total)
+        self.assertTrue(0.1 <= first.percentile(0.5) <= 0.1 * Histogram.growth)
+
+    def test_empty_histogram(self):
+        histogram = Histogram()
+        self.assertEqual(0.0, histogram.mean())
+        self.assertEqual(0.0, histogram.percentile(0.99))
+
+
+class ConcurrentStatsTest(TestCase):
+
+    def setUp(self):
+        self.checkInterval = sys.getcheckinterval()
+        # Switch threads as often as possible to provoke lost updates
+        sys.setcheckinterval(1)
+        instrumentation.takeStats()
+
+    def tearDown(self):
+        sys.setcheckinterval(self.checkInterval)
+
+    def test_no_updates_are_lost(self):
+        def work():
+            for i in range(2000):
+                instrumentation.increment('test.count')
+                instrumentation.observe('test.times', 0.001)
+        threads = [threading.Thread(target=work) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = instrumentation.takeStats()
+        self.assertEqual(8000, stats['test.count'])
+        self.assertEqual(8000, len(stats['test.times']))
+        self.assertEqual({}, instrumentation.takeStats())
+
+
+class MergeWorkerStatsTest(TestCase):
+
+    def setUp(self):
+        instrumentation.takeStats()
+        self.addCleanup(instrumentation.takeStats)
+        self.addCleanup(instrumentation.workerGauges.clear)
+
+    def test_reports_are_folded_in(self):
+        instrumentation.increment('committedPoints', 5)
+        instrumentation.max('maxDatapointAge', 30)
+        histogram = Histogram()
+        histogram.add(0.5)
+        instrumentation.mergeWorkerStats(dict(
+            worker=1,
+            stats={'committedPoints': 7, 'maxDatapointAge': 10,
+                   'updateTimes': histogram.snapshot(), 'queries': [1, 2]},
+            maxStats=['maxDatapointAge'],
+            gauges={'cache.size': 42}))
+
+        stats = instrumentation.takeStats()
+        self.assertEqual(12, stats['committedPoints'])
+        self.assertEqual(30, stats['maxDatapointAge'])
+        self.assertEqual(1, len(stats['updateTimes']))
+        self.assertEqual([1, 2], stats['queries'])
+        self.assertEqual(42, instrumentation.getWorkerGauge('cache.size'))
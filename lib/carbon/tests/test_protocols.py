@@ -0,0 +1,55 @@
+import tempfile
+from unittest import TestCase
+
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
+from twisted.test.proto_helpers import StringTransport
+
+from carbon import conf
+# carbon.storage looks up CONF_DIR when it is imported
+conf.settings.setdefault('CONF_DIR', tempfile.gettempdir())
+from carbon import events, state, instrumentation
+from carbon.protocols import MetricLineReceiver, MetricDatagramReceiver, MetricPickleReceiver
+from carbon.util import pickle
+
+
+class MetricReceiverTest(TestCase):
+
+    def setUp(self):
+        self.addCleanup(setattr, state, "instrumentation", state.instrumentation)
+        state.instrumentation = instrumentation
+        self.batches = []
+        events.metricsReceivedBatch.addHandler(self.batches.append)
+        self.addCleanup(events.metricsReceivedBatch.removeHandler, self.batches.append)
+
+    def connect(self, protocol):
+        protocol.makeConnection(StringTransport())
+        self.addCleanup(protocol.connectionLost, Failure(ConnectionDone()))
+        return protocol
+
+    def test_line_receiver_batches_each_chunk(self):
+        protocol = self.connect(MetricLineReceiver())
+        protocol.dataReceived("a.b 1 60\nnot a datapoint\nc.d 2")
+        self.assertEqual([[("a.b", (60.0, 1.0))]], self.batches)
+
+        # The partial line is completed by the next chunk
+        protocol.dataReceived(" 60\ne.f 3 60\n")
+        self.assertEqual([("c.d", (60.0, 2.0)), ("e.f", (60.0, 3.0))], self.batches[1])
+        self.assertEqual(2, len(self.batches))
+
+    def test_line_receiver_without_complete_lines_sends_nothing(self):
+        protocol = self.connect(MetricLineReceiver())
+        protocol.dataReceived("a.b 1")
+        protocol.dataReceived("bad\n")
+        self.assertEqual([], self.batches)
+
+    def test_datagram_receiver_batches_each_datagram(self):
+        protocol = MetricDatagramReceiver()
+        protocol.datagramReceived("a.b 1 60\nnope\nc.d 2 60", ("127.0.0.1", 2003))
+        self.assertEqual([[("a.b", (60.0, 1.0)), ("c.d", (60.0, 2.0))]], self.batches)
+
+    def test_pickle_receiver_drops_a_bad_entry(self):
+        protocol = self.connect(MetricPickleReceiver())
+        message = [("a.b", (60, 1.0)), ("bad", "x"), ("c.d", (60, 2))]
+        protocol.stringReceived(pickle.dumps(message, protocol=-1))
+        self.assertEqual([[("a.b", (60.0, 1.0)), ("c.d", (60.0, 2.0))]], self.batches)
@@ -0,0 +1,80 @@
+import shutil
+import tempfile
+from unittest import TestCase
+
+from carbon import conf
+from carbon.cache import ShardedMetricCache
+from carbon import spill as spill_module
+from carbon.spill import CacheSpill
+
+
+class CacheSpillTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.maxCacheSize = conf.settings.MAX_CACHE_SIZE
+        conf.settings.MAX_CACHE_SIZE = 10
+        self.originalChunkSize = spill_module.CHUNK_SIZE
+        spill_module.CHUNK_SIZE = 4
+        self.cache = ShardedMetricCache(4)
+        self.spill = self.makeSpill()
+
+    def tearDown(self):
+        conf.settings.MAX_CACHE_SIZE = self.maxCacheSize
+        spill_module.CHUNK_SIZE = self.originalChunkSize
+        shutil.rmtree(self.directory)
+
+    def makeSpill(self):
+        spill = CacheSpill(self.directory, self.cache, segmentSize=64)
+        self.cache.spill = spill
+        spill.startService()
+        spill.readTask.stop()
+        return spill
+
+    def store(self, count, start=0):
+        for i in range(start, start + count):
+            self.cache.store('metric%d' % (i % 3), (i, float(i)))
+
+    def test_spills_once_full(self):
+        self.store(25)
+        self.assertEqual(10, self.cache.size)
+        self.assertEqual(15, self.spill.size)
+        self.assertTrue(self.spill.bytes > 0)
+
+    def test_reads_back_in_order_as_room_frees(self):
+        self.store(25)
+        self.cache.pop('metric0')
+        self.cache.pop('metric1')
+        self.cache.pop('metric2')
+        conf.settings.MAX_CACHE_SIZE = 100
+        self.spill.readBack()
+        self.assertEqual(0, self.spill.size)
+        self.assertEqual(0, self.spill.bytes)
+        self.assertEqual([(10.0, 10.0), (13.0, 13.0), (16.0, 16.0),
+                          (19.0, 19.0), (22.0, 22.0)], self.cache.pop('metric1'))
+
+    def test_reads_back_up_to_low_watermark(self):
+        self.store(25)
+        self.cache.pop('metric0')
+        self.cache.pop('metric1')
+        self.cache.pop('metric2')
+        self.spill.readBack()
+        self.assertEqual(12, self.cache.size)
+        self.assertEqual(3, self.spill.size)
+
+    def test_keeps_spilling_until_read_back(self):
+        self.store(12)
+        self.cache.pop('metric0')
+        self.store(1, start=12)
+        self.assertEqual(3, self.spill.size)
+
+    def test_survives_restart(self):
+        self.store(25)
+        self.spill.stopService()
+        self.spill = self.makeSpill()
+        self.assertEqual(15, self.spill.size)
+        for metric in ('metric0', 'metric1', 'metric2'):
+            self.cache.pop(metric)
+        conf.settings.MAX_CACHE_SIZE = 100
+        self.spill.readBack()
+        self.assertEqual(15, self.cache.size)
@@ -0,0 +1,179 @@
+import os
+import time
+import shutil
+import tempfile
+from unittest import TestCase
+
+import whisper
+
+from carbon import conf
+
+# carbon.storage builds its config paths from CONF_DIR when it is imported,
+# the tests point them at their own files anyway
+conf.settings.setdefault('CONF_DIR', tempfile.gettempdir())
+from carbon import storage
+
+
+class SchemaMatcherTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.schemasConfig = os.path.join(self.dir, 'storage-schemas.conf')
+        self.aggregationConfig = os.path.join(self.dir, 'storage-aggregation.conf')
+        self.writeConfig(self.schemasConfig,
+                         "[foo]\npattern = ^foo\\.\nretentions = 10:10\n")
+        self.writeConfig(self.aggregationConfig,
+                         "[foo]\npattern = ^foo\\.\naggregationMethod = max\n")
+        self.originalPaths = (storage.STORAGE_SCHEMAS_CONFIG,
+                              storage.STORAGE_AGGREGATION_CONFIG)
+        storage.STORAGE_SCHEMAS_CONFIG = self.schemasConfig
+        storage.STORAGE_AGGREGATION_CONFIG = self.aggregationConfig
+
+    def tearDown(self):
+        (storage.STORAGE_SCHEMAS_CONFIG,
+         storage.STORAGE_AGGREGATION_CONFIG) = self.originalPaths
+        shutil.rmtree(self.dir)
+
+    def writeConfig(self, path, contents, mtime=None):
+        fh = open(path, 'w')
+        fh.write(contents)
+        fh.close()
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+
+    def test_match_falls_through_to_defaults(self):
+        matcher = storage.SchemaMatcher()
+        schema, aggSchema = matcher.match('foo.bar')
+        self.assertEqual('foo', schema.name)
+        self.assertEqual('foo', aggSchema.name)
+        schema, aggSchema = matcher.match('bar.baz')
+        self.assertEqual('default', schema.name)
+        self.assertEqual('default', aggSchema.name)
+
+    def test_memo_is_bounded(self):
+        matcher = storage.SchemaMatcher(cacheSize=2)
+        for metric in ('foo.a', 'foo.b', 'foo.a', 'foo.c'):
+            matcher.match(metric)
+        self.assertEqual(['foo.a', 'foo.c'], list(matcher.state[2]))
+
+    def test_reload_only_when_config_changes(self):
+        matcher = storage.SchemaMatcher()
+        state = matcher.state
+        self.assertFalse(matcher.reload())
+        self.assertTrue(matcher.state is state)
+
+        self.writeConfig(self.schemasConfig,
+                         "[bar]\npattern = ^foo\\.\nretentions = 60:10\n",
+                         mtime=os.stat(self.schemasConfig).st_mtime + 10)
+        self.assertTrue(matcher.reload())
+        self.assertEqual('bar', matcher.match('foo.bar')[0].name)
+
+
+class MetricIndexTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.dataDir = os.path.join(self.dir, 'whisper')
+        os.makedirs(os.path.join(self.dataDir, 'foo', 'bar'))
+        for path in ('top.wsp', 'foo/a.wsp', 'foo/bar/b.wsp', 'foo/notes.txt'):
+            open(os.path.join(self.dataDir, path), 'w').close()
+        self.index = storage.MetricIndex(os.path.join(self.dir, 'index'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_scan_finds_whisper_files(self):
+        self.index.scan(self.dataDir)
+        self.assertEqual(set(['top', 'foo.a', 'foo.bar.b']), self.index.metrics)
+
+    def test_save_and_load(self):
+        self.index.scan(self.dataDir)
+        self.index.save()
+        loaded = storage.MetricIndex(self.index.path)
+        loaded.load()
+        self.assertEqual(self.index.metrics, loaded.metrics)
+
+    def test_exists_falls_back_to_filesystem(self):
+        originalDataDir = conf.settings.get('LOCAL_DATA_DIR')
+        conf.settings['LOCAL_DATA_DIR'] = self.dataDir
+        try:
+            self.assertTrue(self.index.exists('foo.a'))
+            self.assertTrue('foo.a' in self.index)
+            self.assertFalse(self.index.exists('foo.missing'))
+            self.assertFalse('foo.missing' in self.index)
+        finally:
+            if originalDataDir is None:
+                del conf.settings['LOCAL_DATA_DIR']
+            else:
+                conf.settings['LOCAL_DATA_DIR'] = originalDataDir
+
+
+class WhisperFileCacheTest(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.paths = [os.path.join(self.dir, '%d.wsp' % i) for i in range(3)]
+        for path in self.paths:
+            whisper.create(path, [(1, 60)])
+        self.files = storage.WhisperFileCache(2)
+
+    def tearDown(self):
+        self.files.closeAll()
+        storage.whisperFileCaches.remove(self.files)
+        shutil.rmtree(self.dir)
+
+    def test_update_many_writes_through_open_file(self):
+        now = int(time.time())
+        self.files.update_many(self.paths[0], [(now - 1, 1.0), (now, 2.0)])
+        self.files.update_many(self.paths[0], [(now - 2, 3.0)])
+        timeInfo, values = whisper.fetch(self.paths[0], now - 3, now + 1)
+        self.assertEqual([3.0, 1.0, 2.0], [v for v in values if v is not None])
+        self.assertEqual(1, len(self.files))
+
+    def test_least_recently_used_file_is_closed(self):
+        now = int(time.time())
+        for path in (self.paths[0], self.paths[1], self.paths[0], self.paths[2]):
+            self.files.update_many(path, [(now, 1.0)])
+        self.assertEqual([self.paths[0], self.paths[2]], list(self.files.files))
+
+    def test_invalidated_file_is_reopened(self):
+        fh = self.files.open(self.paths[0])
+        storage.invalidateWhisperFile(self.paths[0])
+        self.assertTrue(fh.closed is False)
+        self.assertTrue(self.files.open(self.paths[0]) is not fh)
+        self.assertTrue(fh.closed)
+
+    def test_replaced_file_is_reopened(self):
+        now = int(time.time())
+        self.files.update_many(self.paths[0], [(now, 1.0)])
+        fh = self.files.files[self.paths[0]][0]
+        replacement = self.paths[0] + '.new'
+        whisper.create(replacement, [(1, 60)])
+        os.rename(replacement, self.paths[0])
+
+        # The path is only checked once checkInterval has passed
+        self.assertTrue(self.files.open(self.paths[0]) is fh)
+        self.files.files[self.paths[0]] = (fh, 0, self.files.files[self.paths[0]][2])
+        self.files.update_many(self.paths[0], [(now, 2.0)])
+        self.assertTrue(fh.closed)
+        timeInfo, values = whisper.fetch(self.paths[0], now - 1, now + 1)
+        self.assertEqual([2.0], [v for v in values if v is not None])
+
+    def test_unchanged_file_stays_open(self):
+        fh = self.files.open(self.paths[0])
+        self.files.files[self.paths[0]] = (fh, 0, self.files.files[self.paths[0]][2])
+        self.assertTrue(self.files.open(self.paths[0]) is fh)
+        self.assertTrue(self.files.files[self.paths[0]][1] > 0)
+
+    def test_lock_is_released_after_update(self):
+        import fcntl
+        whisper.LOCK = True
+        try:
+            self.files.update_many(self.paths[0], [(int(time.time()), 1.0)])
+        finally:
+            whisper.LOCK = False
+        other = open(self.paths[0], 'r+b')
+        try:
+            fcntl.flock(other.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        finally:
+            other.close()
@@ -0,0 +1,83 @@
+from unittest import TestCase
+
+from carbon import util
+from carbon.util import TokenBucket, RestrictedUnpickler, parseDatapoints, pickle
+
+
+class TokenBucketTest(TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.slept = []
+        self.originalTime = util.time
+        util.time = self
+        self.bucket = TokenBucket(10, 2)
+
+    def tearDown(self):
+        util.time = self.originalTime
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+    def test_starts_full_and_drains(self):
+        self.assertEqual(10, self.bucket.tokens)
+        self.assertTrue(self.bucket.drain(10))
+        self.assertFalse(self.bucket.drain(1))
+
+    def test_refills_at_fill_rate_up_to_capacity(self):
+        self.bucket.drain(10)
+        self.now += 2
+        self.assertEqual(4, self.bucket.tokens)
+        self.now += 100
+        self.assertEqual(10, self.bucket.tokens)
+
+    def test_blocking_drain_sleeps_until_refilled(self):
+        self.bucket.drain(10)
+        self.assertTrue(self.bucket.drain(1, blocking=True))
+        self.assertEqual([0.5], self.slept)
+        self.assertTrue(self.bucket.drain(2, blocking=True))
+        self.assertEqual([0.5, 1.0], self.slept)
+
+    def test_set_fill_rate_keeps_tokens_earned_so_far(self):
+        self.bucket.drain(10)
+        self.now += 1
+        self.bucket.setFillRate(4)
+        self.now += 1
+        self.assertEqual(6, self.bucket.tokens)
+
+
+class PickleDecodingTest(TestCase):
+
+    def test_well_formed_message_is_returned_as_is(self):
+        message = [("a.b", (60, 1.0)), (u"a.c", (120, 2))]
+        decoded = RestrictedUnpickler.loads(pickle.dumps(message, protocol=-1))
+        self.assertEqual(message, decoded)
+        self.assertTrue(parseDatapoints(decoded) is decoded)
+
+    def test_other_shapes_are_coerced_or_dropped(self):
+        message = [("a.b", ["60", 1]), ("a.c",), (5, (60, 1.0)),
+                   ("a.d", (60, "x")), ("a.e", (60, 1.0, 0))]
+        self.assertEqual([("a.b", (60.0, 1.0)), ("a.e", (60.0, 1.0))],
+                         parseDatapoints(message))
+
+    def test_number_too_large_for_a_double_is_dropped(self):
+        message = [("a.b", (60, 1.0)), ("a.c", (60, 10 ** 400)), ("a.d", (60, 2.0))]
+        self.assertEqual([("a.b", (60.0, 1.0)), ("a.d", (60.0, 2.0))],
+                         parseDatapoints(message))
+
+    def test_dict_datapoint_is_dropped(self):
+        message = [("a.b", (60, 1.0)), ("a.c", {5: 1, 7: 2}), ("a.d", (120, 2.0))]
+        self.assertEqual([("a.b", (60.0, 1.0)), ("a.d", (120.0, 2.0))],
+                         parseDatapoints(message))
+
+    def test_rejects_anything_but_a_list(self):
+        self.assertRaises(ValueError, parseDatapoints, {"a.b": (60, 1.0)})
+
+    def test_rejects_globals(self):
+        for obj in (set([1]), ValueError("x"), [("a.b", (60, object()))]):
+            self.assertRaises(pickle.UnpicklingError, RestrictedUnpickler.loads,
+                              pickle.dumps(obj, protocol=-1))
@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from carbon.cache import ShardedMetricCache
+from carbon.wal import WriteAheadLog, listSegments
+
+
+class WriteAheadLogTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = ShardedMetricCache(4)
+        self.wal = WriteAheadLog(self.directory, self.cache, segmentSize=1)
+        self.cache.setWriteAheadLog(self.wal)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def commit(self, wal):
+        wal.sync()
+        wal.commit(*wal.commits.get())
+
+    def replay(self):
+        cache = ShardedMetricCache(4)
+        wal = WriteAheadLog(self.directory, cache)
+        cache.setWriteAheadLog(wal)
+        wal.replay(cache.storeBatch)
+        return cache, wal
+
+    def test_replays_committed_datapoints(self):
+        self.cache.store('foo', (60, 1.0))
+        self.cache.store('bar', (60, 2.0))
+        self.commit(self.wal)
+        self.cache.store('foo', (120, 3.0))
+
+        cache, wal = self.replay()
+        self.assertEqual([(60, 1.0)], cache.pop('foo'))
+        self.assertEqual([(60, 2.0)], cache.pop('bar'))
+        self.assertEqual(2, len(wal.buffer))
+
+    def test_ignores_torn_record(self):
+        self.cache.store('foo', (60, 1.0))
+        self.commit(self.wal)
+        path = self.wal.closed[0].path
+        with open(path, 'ab') as fh:
+            fh.write('\x00\x00\x01\x00garbage')
+
+        cache, wal = self.replay()
+        self.assertEqual([(60, 1.0)], cache.pop('foo'))
+
+    def test_truncates_once_datapoints_are_written(self):
+        self.cache.store('foo', (60, 1.0))
+        self.commit(self.wal)
+        self.assertEqual(1, len(listSegments(self.directory)))
+
+        self.cache.pop('foo')
+        self.commit(self.wal)
+        self.assertEqual([], listSegments(self.directory))
+
+    def test_pins_hold_back_truncation(self):
+        held = []
+        self.wal.addPin(lambda: min(held or [None]))
+        self.cache.store('foo', (60, 1.0))
+        held.append(self.cache.popQueue('foo').created)
+        self.commit(self.wal)
+        self.commit(self.wal)
+        self.assertEqual(1, len(listSegments(self.directory)))
+
+        del held[:]
+        self.commit(self.wal)
+        self.assertEqual([], listSegments(self.directory))
+
+    def test_replayed_segments_removed_after_commit(self):
+        self.cache.store('foo', (60, 1.0))
+        self.commit(self.wal)
+        old = listSegments(self.directory)
+
+        cache, wal = self.replay()
+        self.assertEqual(old[-1][0] + 1, wal.nextSegment)
+        self.commit(wal)
+        self.assertFalse(os.path.exists(old[0][1]))
+        cache, wal = self.replay()
+        self.assertEqual([(60, 1.0)], cache.pop('foo'))
@@ -0,0 +1,149 @@
+import tempfile
+from unittest import TestCase
+
+from twisted.internet.defer import succeed
+from twisted.test.proto_helpers import StringTransport
+
+from carbon import conf
+# carbon.storage looks up CONF_DIR when it is imported
+conf.settings.setdefault('CONF_DIR', tempfile.gettempdir())
+from carbon import events, state, workers
+from carbon.protocols import CacheManagementHandler
+from carbon.util import pickle
+from carbon.workers import WorkerPool, WorkerRouter, workerFor
+
+
+def ownedBy(workerId, workerCount, count=1):
+    "Returns count metric names owned by workerId"
+    metrics = ("metric.%d" % i for i in xrange(10000))
+    return [m for m in metrics if workerFor(m, workerCount) == workerId][:count]
+
+
+class RecordingCache(object):
+    def __init__(self):
+        self.stored = []
+
+    def storeBatch(self, batch):
+        self.stored.extend(batch)
+
+
+class WorkerForTest(TestCase):
+
+    def test_owner_is_stable(self):
+        # crc32 based, so every process agrees on the owner
+        self.assertEqual(workerFor("carbon.agents.a", 4), workerFor("carbon.agents.a", 4))
+        self.assertEqual(1, workerFor("a.b.c", 1) + 1)
+
+    def test_metrics_spread_over_the_workers(self):
+        counts = [0] * 4
+        for i in range(4000):
+            counts[workerFor("metric.%d" % i, 4)] += 1
+        for count in counts:
+            self.assertTrue(800 < count < 1200, counts)
+
+    def test_router_picks_the_owners_handoff_port(self):
+        router = WorkerRouter(3)
+        destinations = [("127.0.0.1", 2404 + i, str(i)) for i in range(3)]
+        for destination in destinations:
+            router.addDestination(destination)
+        for workerId in range(3):
+            metric = ownedBy(workerId, 3)[0]
+            self.assertEqual([destinations[workerId]], list(router.getDestinations(metric)))
+
+        router.removeDestination(destinations[1])
+        self.assertEqual([], list(router.getDestinations(ownedBy(1, 3)[0])))
+
+
+class WorkerPoolTest(TestCase):
+
+    def setUp(self):
+        self.pool = WorkerPool({}, 3, 0)
+        self.cache = RecordingCache()
+        self.addCleanup(setattr, workers, "MetricCache", workers.MetricCache)
+        workers.MetricCache = self.cache
+        self.addCleanup(setattr, state, "metricReceiversPaused", state.metricReceiversPaused)
+        self.addCleanup(setattr, state, "cacheTooFull", state.cacheTooFull)
+        state.cacheTooFull = False
+        self.addCleanup(setattr, conf.settings, "MAX_QUEUE_SIZE", conf.settings.MAX_QUEUE_SIZE)
+        conf.settings.MAX_QUEUE_SIZE = 10
+        self.flowEvents = []
+        for event in (events.pauseReceivingMetrics, events.resumeReceivingMetrics):
+            handler = lambda name=event.name: self.flowEvents.append(name)
+            event.addHandler(handler)
+            self.addCleanup(event.removeHandler, handler)
+
+    def queued(self, workerId):
+        factory = self.pool.client_manager.client_factories[self.pool.handoffDestination(workerId)]
+        return list(factory.queue)
+
+    def test_store_batch_splits_by_owner(self):
+        mine = ownedBy(0, 3, 2)
+        theirs = ownedBy(1, 3, 2) + ownedBy(2, 3, 1)
+        batch = [(metric, (1, 1.0)) for metric in mine + theirs]
+        self.pool.storeBatch(batch)
+        self.assertEqual([(metric, (1, 1.0)) for metric in mine], self.cache.stored)
+        self.assertEqual([(metric, (1, 1.0)) for metric in theirs[:2]], self.queued(1))
+        self.assertEqual([(theirs[2], (1, 1.0))], self.queued(2))
+
+    def test_full_handoff_queue_pauses_instead_of_dropping(self):
+        metric = ownedBy(1, 3)[0]
+        for i in range(25):
+            self.pool.store(metric, (i, 1.0))
+        self.assertEqual(25, len(self.queued(1)))
+        self.assertEqual(["pauseReceivingMetrics"], self.flowEvents)
+
+        factory = self.pool.client_manager.client_factories[self.pool.handoffDestination(1)]
+        factory.queue.clear()
+        factory.queueHasSpace.callback(0)
+        self.assertEqual(["pauseReceivingMetrics", "resumeReceivingMetrics"], self.flowEvents)
+
+    def test_cache_space_waits_for_the_handoff_queues(self):
+        for i in range(10):
+            self.pool.store(ownedBy(2, 3)[0], (i, 1.0))
+        self.pool.cacheSpaceAvailable()
+        self.assertEqual(["pauseReceivingMetrics"], self.flowEvents)
+
+        factory = self.pool.client_manager.client_factories[self.pool.handoffDestination(2)]
+        factory.queue.clear()
+        factory.queueHasSpace.callback(0)
+        self.pool.cacheSpaceAvailable()
+        self.assertEqual(["pauseReceivingMetrics", "resumeReceivingMetrics", "resumeReceivingMetrics"],
+                         self.flowEvents)
+
+    def test_query_owner_forwards_to_the_owning_worker(self):
+        requests = {}
+
+        class QueryClient(object):
+            def __init__(self, workerId):
+                self.workerId = workerId
+
+            def query(self, request):
+                requests[self.workerId] = request
+                return succeed(dict(datapoints=[]))
+
+        self.pool.queryClients = dict((i, QueryClient(i)) for i in (1, 2))
+        request = dict(type='cache-query', metric=ownedBy(2, 3)[0])
+        results = []
+        self.pool.queryOwner(request).addCallback(results.append)
+        self.assertEqual({2: request}, requests)
+        self.assertEqual([dict(datapoints=[])], results)
+
+
+class ForwardedRequestTest(TestCase):
+
+    def setUp(self):
+        self.pool = WorkerPool({}, 2, 0)
+        self.forwarded = []
+        self.pool.queryOwner = lambda request: self.forwarded.append(request) or succeed(dict(ok=True))
+        self.addCleanup(setattr, state, "workerPool", state.workerPool)
+        state.workerPool = self.pool
+        self.handler = CacheManagementHandler()
+        self.transport = StringTransport()
+        self.handler.makeConnection(self.transport)
+
+    def test_set_metadata_goes_to_the_owner(self):
+        request = dict(type='set-metadata', metric=ownedBy(1, 2)[0],
+                       key='aggregationMethod', value='max')
+        self.handler.stringReceived(pickle.dumps(request, protocol=-1))
+        self.assertEqual([request], self.forwarded)
+        self.assertTrue(self.transport.value())
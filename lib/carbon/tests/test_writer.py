@@ -0,0 +1,446 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+from twisted.internet.task import Clock
+
+from carbon import conf
+
+# carbon.writer loads the storage schemas when it is imported
+conf.settings.setdefault('CONF_DIR', tempfile.gettempdir())
+from carbon import storage
+schemasDir = tempfile.mkdtemp()
+originalPaths = (storage.STORAGE_SCHEMAS_CONFIG, storage.STORAGE_AGGREGATION_CONFIG)
+storage.STORAGE_SCHEMAS_CONFIG = os.path.join(schemasDir, 'storage-schemas.conf')
+storage.STORAGE_AGGREGATION_CONFIG = os.path.join(schemasDir, 'storage-aggregation.conf')
+fh = open(storage.STORAGE_SCHEMAS_CONFIG, 'w')
+fh.write("[default]\nmatch-all = true\nretentions = 60:1440\n")
+fh.close()
+try:
+    from carbon import writer
+finally:
+    (storage.STORAGE_SCHEMAS_CONFIG, storage.STORAGE_AGGREGATION_CONFIG) = originalPaths
+    shutil.rmtree(schemasDir)
+
+from carbon import util, instrumentation, state, events
+from carbon.cache import ShardedMetricCache
+from carbon.util import TokenBucket
+
+
+class FakeTime(object):
+    "Stands in for the time module in carbon.util"
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class ThrottleUpdatesTest(TestCase):
+
+    def setUp(self):
+        self.clock = FakeTime()
+        self.originalTime = util.time
+        util.time = self.clock
+        self.originalBucket = writer.updateBucket
+        self.originalRates = dict([ (key, conf.settings.get(key)) for key in
+                                    ('MAX_UPDATES_PER_SECOND', 'MAX_UPDATES_PER_SECOND_ON_SHUTDOWN') ])
+
+    def tearDown(self):
+        util.time = self.originalTime
+        writer.updateBucket = self.originalBucket
+        for (key, value) in self.originalRates.items():
+            if value is None:
+                conf.settings.pop(key, None)
+            else:
+                conf.settings[key] = value
+
+    def test_unlimited_rate_never_waits(self):
+        writer.updateBucket = writer.makeUpdateBucket(float('inf'))
+        self.assertEqual(None, writer.updateBucket)
+        for i in range(1000):
+            writer.throttleUpdates()
+        self.assertEqual([], self.clock.slept)
+
+    def test_bursts_then_waits_for_the_rate(self):
+        writer.updateBucket = TokenBucket(3, 2)
+        for i in range(3):
+            writer.throttleUpdates()
+        self.assertEqual([], self.clock.slept)
+        writer.throttleUpdates()
+        writer.throttleUpdates()
+        self.assertEqual([0.5, 0.5], self.clock.slept)
+        self.assertTrue('throttledTime' in instrumentation.stats)
+
+    def test_shutdown_swaps_in_the_shutdown_rate(self):
+        conf.settings.MAX_UPDATES_PER_SECOND = 2
+        conf.settings.MAX_UPDATES_PER_SECOND_ON_SHUTDOWN = 10
+        writer.updateBucket = writer.makeUpdateBucket(conf.settings.MAX_UPDATES_PER_SECOND)
+        bucket = writer.updateBucket
+        writer.shutdownModifyUpdateSpeed()
+        self.assertFalse(writer.updateBucket is bucket)
+        self.assertEqual(10, writer.updateBucket.fillRate)
+        self.assertEqual(10, conf.settings.MAX_UPDATES_PER_SECOND)
+
+    def test_rate_is_kept_without_a_shutdown_rate(self):
+        conf.settings.pop('MAX_UPDATES_PER_SECOND_ON_SHUTDOWN', None)
+        bucket = writer.updateBucket = TokenBucket(1, 1)
+        writer.shutdownModifyUpdateSpeed()
+        self.assertTrue(writer.updateBucket is bucket)
+
+    def test_unlimited_shutdown_rate_stops_throttling(self):
+        conf.settings.MAX_UPDATES_PER_SECOND = 1
+        conf.settings.MAX_UPDATES_PER_SECOND_ON_SHUTDOWN = float('inf')
+        writer.updateBucket = TokenBucket(1, 1)
+        writer.throttleUpdates()
+        writer.shutdownModifyUpdateSpeed()
+        for i in range(100):
+            writer.throttleUpdates()
+        self.assertEqual([], self.clock.slept)
+
+
+class FakeCache(object):
+    size = 0
+
+
+class UpdateRateControllerTest(TestCase):
+
+    def setUp(self):
+        self.originalCache = writer.MetricCache
+        self.originalBucket = writer.updateBucket
+        self.cache = writer.MetricCache = FakeCache()
+        self.controller = writer.UpdateRateController(100, targetLatency=0.01)
+        self.controller.task.clock = Clock()
+        self.controller.start()
+
+    def tearDown(self):
+        self.controller.stop()
+        writer.MetricCache = self.originalCache
+        writer.updateBucket = self.originalBucket
+
+    def adjust(self, latency, cacheSize):
+        for i in range(10):
+            self.controller.updateTimes.add(latency)
+        self.cache.size = cacheSize
+        self.controller.adjust()
+        self.assertEqual(self.controller.rate, writer.updateBucket.fillRate)
+        return self.controller.rate
+
+    def test_starts_at_the_configured_rate(self):
+        self.assertEqual(100, self.controller.rate)
+        self.assertEqual(100, writer.updateBucket.fillRate)
+
+    def test_decreases_when_latency_is_over_target(self):
+        self.assertEqual(50, self.adjust(0.1, cacheSize=1000))
+        self.assertEqual(25, self.adjust(0.1, cacheSize=2000))
+
+    def test_decrease_is_clamped_to_min_rate(self):
+        for i in range(10):
+            self.adjust(0.1, cacheSize=1000)
+        self.assertEqual(self.controller.minRate, self.controller.rate)
+
+    def test_increases_while_the_cache_is_not_draining(self):
+        self.controller.rate = 50
+        self.assertEqual(55, self.adjust(0.001, cacheSize=1000))
+        self.assertEqual(60, self.adjust(0.001, cacheSize=1000))
+
+    def test_holds_while_the_cache_drains_or_is_empty(self):
+        self.controller.rate = 50
+        self.adjust(0.001, cacheSize=1000)
+        self.assertEqual(55, self.adjust(0.001, cacheSize=500))
+        self.assertEqual(55, self.adjust(0.001, cacheSize=0))
+
+    def test_increase_is_clamped_to_max_rate(self):
+        self.controller.rate = 98
+        self.assertEqual(100, self.adjust(0.001, cacheSize=1000))
+        self.assertEqual(100, self.adjust(0.001, cacheSize=2000))
+
+    def test_unlimited_max_rate_starts_at_a_finite_rate(self):
+        controller = writer.UpdateRateController(float('inf'), targetLatency=0.01)
+        self.assertEqual(1000, controller.rate)
+
+
+class RecordingWhisper(object):
+    "Stands in for the whisper module in carbon.writer"
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.writers = {} # { path : set of thread names }
+        self.points = 0
+
+    def create(self, path, *args):
+        with self.lock:
+            self.writers.setdefault(path, set())
+
+    def update_many(self, path, datapoints):
+        time.sleep(0.0001)
+        with self.lock:
+            self.writers.setdefault(path, set()).add(threading.current_thread().name)
+            self.points += len(datapoints)
+
+
+class WriterPoolTest(TestCase):
+
+    def setUp(self):
+        self.originals = (writer.whisper, writer.updateBucket, conf.settings.get('LOCAL_DATA_DIR'))
+        conf.settings['LOCAL_DATA_DIR'] = tempfile.gettempdir()
+        self.whisper = writer.whisper = RecordingWhisper()
+        writer.updateBucket = None
+        self.metrics = ["pool.metric%d" % i for i in range(300)]
+        writer.knownMetrics.update(self.metrics)
+        self.cache = ShardedMetricCache(8, writers=4)
+        for i in range(3):
+            for metric in self.metrics:
+                self.cache.store(metric, (60 * i, 1.0))
+
+    def tearDown(self):
+        (writer.whisper, writer.updateBucket, dataDir) = self.originals
+        for metric in self.metrics:
+            writer.knownMetrics.discard(metric)
+        if dataDir is None:
+            del conf.settings['LOCAL_DATA_DIR']
+        else:
+            conf.settings['LOCAL_DATA_DIR'] = dataDir
+
+    def test_threads_drain_disjoint_partitions(self):
+        updates = []
+        threads = [threading.Thread(target=lambda p=p: updates.append(writer.writeCachedDataPoints(p)),
+                                    name='writer%d' % i)
+                   for (i, p) in enumerate(self.cache.partitions)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertFalse(self.cache)
+        self.assertEqual(900, self.whisper.points)
+        self.assertEqual(300, sum(updates))
+        self.assertEqual(300, len(self.whisper.writers))
+        # No whisper file is ever written by two threads
+        self.assertEqual(set([1]), set([len(names) for names in self.whisper.writers.values()]))
+        self.assertEqual(4, len(set.union(*self.whisper.writers.values())))
+
+
+class OverdueWriteTest(TestCase):
+
+    def setUp(self):
+        self.originalDataDir = conf.settings.get('LOCAL_DATA_DIR')
+        conf.settings['LOCAL_DATA_DIR'] = tempfile.gettempdir()
+        self.metrics = ["overdue.old", "overdue.busy"]
+        writer.knownMetrics.update(self.metrics)
+        self.cache = ShardedMetricCache(4, "max", policy='drop-oldest')
+        self.cache.store("overdue.old", (1, 1.0))
+        for i in range(8):
+            self.cache.store("overdue.busy", (i, 1.0))
+
+    def tearDown(self):
+        for metric in self.metrics:
+            writer.knownMetrics.discard(metric)
+        if self.originalDataDir is None:
+            del conf.settings['LOCAL_DATA_DIR']
+        else:
+            conf.settings['LOCAL_DATA_DIR'] = self.originalDataDir
+
+    def writeOrder(self):
+        return [ metric for (metric, datapoints, path) in writer.optimalWriteOrder(self.cache) ]
+
+    def test_strategy_order_while_nothing_is_overdue(self):
+        self.assertEqual(["overdue.busy", "overdue.old"], self.writeOrder())
+
+    def test_overdue_queue_is_written_first(self):
+        conf.settings.MAX_DATAPOINT_AGE = -1
+        self.addCleanup(delattr, conf.settings, 'MAX_DATAPOINT_AGE')
+        self.assertEqual(["overdue.old", "overdue.busy"], self.writeOrder())
+
+
+class WriteDeadlineTest(TestCase):
+
+    def setUp(self):
+        self.originalIntervals = conf.settings.WRITE_BATCH_INTERVALS
+        conf.settings.WRITE_BATCH_INTERVALS = 3
+        writer.knownMetrics.update(["deadline.known", "deadline.full"])
+
+    def tearDown(self):
+        conf.settings.WRITE_BATCH_INTERVALS = self.originalIntervals
+        writer.knownMetrics.discard("deadline.known")
+        writer.knownMetrics.discard("deadline.full")
+
+    def test_deadline_is_intervals_of_the_finest_archive(self):
+        self.assertEqual(180, writer.writeDeadline("deadline.known"))
+
+    def test_metric_without_a_file_is_due_at_once(self):
+        self.assertEqual(0, writer.writeDeadline("deadline.unknown"))
+
+    def test_due_metrics_come_from_the_index(self):
+        cache = ShardedMetricCache(4, "max")
+        cache.setDeadlines(writer.writeDeadline, 3)
+        cache.store("deadline.unknown", (1, 1.0))
+        for i in range(3):
+            cache.store("deadline.full", (i, 1.0))
+        cache.store("deadline.known", (1, 1.0))
+        self.assertEqual(["deadline.full", "deadline.unknown"],
+                         writer.dueMetrics(cache, time.time()))
+        self.assertEqual(["deadline.full", "deadline.known", "deadline.unknown"],
+                         sorted(writer.dueMetrics(cache, time.time() + 180)))
+
+
+class StoppedReactor(object):
+    "Stands in for the reactor in carbon.writer once it has shut down"
+    running = False
+
+
+class CreateQueueTest(TestCase):
+
+    def setUp(self):
+        self.queue = writer.CreateQueue(maxSize=5)
+
+    def test_hold_and_take(self):
+        self.assertTrue(self.queue.hold("a.b", [(60, 1.0)], created=10))
+        self.assertTrue(self.queue.hold("a.b", [(120, 2.0)], created=20))
+        self.assertTrue("a.b" in self.queue)
+        self.assertEqual(2, self.queue.size)
+        self.assertEqual(10, self.queue.oldest())
+        self.assertEqual("a.b", self.queue.next(timeout=0))
+        self.queue.markReady("a.b")
+        self.assertEqual(None, self.queue.next(timeout=0))
+        self.assertEqual("a.b", self.queue.next(timeout=0, ready=True))
+        self.assertEqual([(60, 1.0), (120, 2.0)], self.queue.take("a.b"))
+        self.assertFalse("a.b" in self.queue)
+        self.assertEqual(0, self.queue.size)
+        self.assertEqual(None, self.queue.oldest())
+
+    def test_drops_datapoints_past_the_max_size(self):
+        self.assertTrue(self.queue.hold("a.b", [(60, 1.0)] * 4, created=10))
+        self.assertFalse(self.queue.hold("a.c", [(60, 1.0)] * 2, created=10))
+        self.assertFalse("a.c" in self.queue)
+        self.assertTrue(self.queue.hold("a.c", [(60, 1.0)], created=10))
+        self.assertEqual(5, self.queue.size)
+
+    def test_restore_stores_into_the_cache(self):
+        self.addCleanup(setattr, writer, "createQueue", writer.createQueue)
+        self.addCleanup(setattr, writer, "MetricCache", writer.MetricCache)
+        writer.createQueue = self.queue
+        cache = writer.MetricCache = ShardedMetricCache(4)
+        self.queue.hold("a.b", [(60, 1.0), (120, 2.0)], created=10)
+        self.queue.markReady("a.b")
+        writer.restoreDatapoints("a.b")
+        self.assertEqual([(60, 1.0), (120, 2.0)], cache.pop("a.b"))
+        self.assertEqual(0, len(self.queue))
+
+
+class CreateOnShutdownTest(TestCase):
+
+    def setUp(self):
+        self.originals = (writer.whisper, writer.reactor, writer.createQueue,
+                          writer.updateBucket, conf.settings.get('LOCAL_DATA_DIR'))
+        self.dataDir = tempfile.mkdtemp()
+        conf.settings['LOCAL_DATA_DIR'] = self.dataDir
+        self.whisper = writer.whisper = RecordingWhisper()
+        writer.reactor = StoppedReactor()
+        writer.createQueue = writer.CreateQueue(100)
+        writer.updateBucket = None
+
+    def tearDown(self):
+        (writer.whisper, writer.reactor, writer.createQueue, writer.updateBucket, dataDir) = self.originals
+        for metric in ("shutdown.a", "shutdown.b"):
+            writer.knownMetrics.discard(metric)
+        writer.runningWriters.clear()
+        shutil.rmtree(self.dataDir)
+        if dataDir is None:
+            del conf.settings['LOCAL_DATA_DIR']
+        else:
+            conf.settings['LOCAL_DATA_DIR'] = dataDir
+
+    def test_held_datapoints_are_written_once_the_writers_stop(self):
+        writer.createQueue.hold("shutdown.a", [(60, 1.0), (120, 2.0)], created=10)
+        writer.createQueue.markReady("shutdown.a")
+        writer.runningWriters.add("partition")
+        creator = threading.Thread(target=writer.createForever)
+        creator.start()
+        # Handed over by a writer still draining the cache
+        writer.createQueue.hold("shutdown.b", [(60, 3.0)], created=20)
+        writer.runningWriters.discard("partition")
+        creator.join(5)
+
+        self.assertFalse(creator.is_alive())
+        self.assertEqual(0, len(writer.createQueue))
+        self.assertEqual(3, self.whisper.points)
+        self.assertEqual(sorted([writer.getFilesystemPath("shutdown.a"), writer.getFilesystemPath("shutdown.b")]),
+                         sorted(self.whisper.writers))
+
+
+class ShutdownDrainTest(TestCase):
+
+    def setUp(self):
+        self.originals = (writer.whisper, writer.reactor, writer.MetricCache, writer.updateBucket,
+                          conf.settings.WRITE_BATCH_INTERVALS, conf.settings.get('LOCAL_DATA_DIR'),
+                          conf.settings.get('MAX_UPDATES_PER_SECOND_ON_SHUTDOWN'))
+        conf.settings['LOCAL_DATA_DIR'] = tempfile.gettempdir()
+        conf.settings.pop('MAX_UPDATES_PER_SECOND_ON_SHUTDOWN', None)
+        conf.settings.WRITE_BATCH_INTERVALS = 3
+        self.whisper = writer.whisper = RecordingWhisper()
+        writer.reactor = StoppedReactor()
+        writer.updateBucket = None
+        self.metrics = ["drain.metric%d" % i for i in range(20)]
+        writer.knownMetrics.update(self.metrics)
+        self.cache = writer.MetricCache = ShardedMetricCache(4, "max", writers=2)
+        self.cache.setDeadlines(writer.writeDeadline, 3)
+        for metric in self.metrics:
+            self.cache.store(metric, (60, 1.0))
+
+    def tearDown(self):
+        (writer.whisper, writer.reactor, writer.MetricCache, writer.updateBucket,
+         conf.settings.WRITE_BATCH_INTERVALS, dataDir, shutdownRate) = self.originals
+        writer.drainAll.clear()
+        for metric in self.metrics:
+            writer.knownMetrics.discard(metric)
+        for (key, value) in (('LOCAL_DATA_DIR', dataDir), ('MAX_UPDATES_PER_SECOND_ON_SHUTDOWN', shutdownRate)):
+            if value is None:
+                conf.settings.pop(key, None)
+            else:
+                conf.settings[key] = value
+
+    def test_queues_not_yet_due_are_written_on_shutdown(self):
+        self.assertEqual([], writer.dueMetrics(self.cache, time.time()))
+        writer.shutdownModifyUpdateSpeed()
+        for partition in self.cache.partitions:
+            writer.writeForever(partition)
+        self.assertFalse(self.cache)
+        self.assertEqual(0, self.cache.size)
+        self.assertEqual(20, self.whisper.points)
+
+
+class DropNewMetricsTest(TestCase):
+
+    def setUp(self):
+        self.addCleanup(setattr, conf.settings, "MAX_CACHE_SIZE", conf.settings.MAX_CACHE_SIZE)
+        conf.settings.MAX_CACHE_SIZE = 2
+        self.addCleanup(setattr, state, "instrumentation", state.instrumentation)
+        state.instrumentation = instrumentation
+        instrumentation.stats.clear()
+        writer.knownMetrics.add("known.metric")
+        self.addCleanup(writer.knownMetrics.discard, "known.metric")
+        self.paused = []
+        handler = lambda: self.paused.append(True)
+        events.cacheFull.addHandler(handler)
+        self.addCleanup(events.cacheFull.removeHandler, handler)
+
+    def test_known_metrics_are_stored_while_full(self):
+        cache = ShardedMetricCache(4, policy='drop-new-metrics')
+        for i in range(3):
+            cache.store("new.metric%d" % i, (60, 1.0))
+        self.assertTrue(cache.isFull())
+        self.assertFalse("new.metric2" in cache)
+        self.assertEqual(1, instrumentation.stats['cache.droppedNewMetrics'])
+
+        for i in range(3):
+            cache.store("known.metric", (60 * i, 1.0))
+        self.assertEqual(3, len(cache.pop("known.metric")))
+        self.assertEqual([], self.paused)
@@ -1,8 +1,10 @@
 import sys
 import os
 import pwd
+import time
 
 from os.path import abspath, basename, dirname, join
+from threading import Lock
 try:
   from cStringIO import StringIO
 except ImportError:
@@ -113,6 +115,61 @@ def parseDestinations(destination_strings):
 
 
 
+class TokenBucket(object):
+  """Holds up to capacity tokens, refilled at fillRate tokens per second.
+  Safe to share between threads."""
+  def __init__(self, capacity, fillRate):
+    self.capacity = float(capacity)
+    self.fillRate = float(fillRate)
+    self._tokens = self.capacity
+    self.timestamp = time.time()
+    self.lock = Lock()
+
+  def _refill(self, now):
+    if self._tokens < self.capacity:
+      self._tokens = min(self.capacity, self._tokens + self.fillRate * (now - self.timestamp))
+    self.timestamp = now
+
+  @property
+  def tokens(self):
+    try:
+      self.lock.acquire()
+      self._refill(time.time())
+      return self._tokens
+    finally:
+      self.lock.release()
+
+  def setFillRate(self, fillRate):
+    try:
+      self.lock.acquire()
+      self._refill(time.time())
+      self.fillRate = float(fillRate)
+    finally:
+      self.lock.release()
+
+  def drain(self, cost, blocking=False):
+    """Takes cost tokens and returns True. If there are not enough tokens
+    this returns False, or if blocking is set it sleeps until the tokens
+    would have been refilled and returns True."""
+    try:
+      self.lock.acquire()
+      self._refill(time.time())
+      if self._tokens >= cost:
+        self._tokens -= cost
+        return True
+      if not blocking:
+        return False
+      # The tokens are taken up front, so concurrent callers queue up behind
+      # each other rather than all waking at once
+      wait = (cost - self._tokens) / self.fillRate
+      self._tokens -= cost
+    finally:
+      self.lock.release()
+
+    time.sleep(wait)
+    return True
+
+
 # This whole song & dance is due to pickle being insecure
 # yet performance critical for carbon. We leave the insecure
 # mode (which is faster) as an option (USE_INSECURE_UNPICKLER).
@@ -161,8 +218,65 @@ else:
       return cls(StringIO(pickle_string)).load()
  
 
-def get_unpickler(insecure=False):
+if USING_CPICKLE:
+  class RestrictedUnpickler(object):
+    """Only builds lists, tuples, dicts, strings and numbers, which is all
+    the pickle protocol needs. cPickle refuses every global, extension and
+    instance opcode when find_global is None, so anything else is rejected
+    before a single class is looked up."""
+    @staticmethod
+    def loads(pickle_string):
+      pickle_obj = pickle.Unpickler(StringIO(pickle_string))
+      pickle_obj.find_global = None
+      return pickle_obj.load()
+
+else:
+  RestrictedUnpickler = SafeUnpickler
+
+
+def get_unpickler(insecure=False, restricted=False):
   if insecure:
     return pickle
+  elif restricted:
+    return RestrictedUnpickler
   else:
     return SafeUnpickler
+
+
+METRIC_TYPES = frozenset([str, unicode])
+# A long may not fit a double, those take the float() path below
+NUMBER_TYPES = frozenset([float, int])
+
+
+def parseDatapoints(message):
+  """Returns the (metric, (timestamp, value)) of an unpickled pickle protocol
+  message, dropping entries of any other shape. A message whose entries all
+  have the expected types is returned as it is, that check costs half as
+  much as coercing every number with float(), which is only done otherwise."""
+  if message.__class__ is not list:
+    raise ValueError("Expected a list of datapoints, not %s" % type(message).__name__)
+
+  # Only a tuple datapoint is unpacked here, anything else that happens to
+  # unpack into two items, like a dict, is left to the per-entry checks below
+  try:
+    for metric, datapoint in message:
+      if datapoint.__class__ is not tuple:
+        break
+      timestamp, value = datapoint
+      if metric.__class__ not in METRIC_TYPES or timestamp.__class__ not in NUMBER_TYPES or \
+         value.__class__ not in NUMBER_TYPES:
+        break
+    else:
+      return message
+  except (TypeError, ValueError):
+    pass
+
+  datapoints = []
+  for entry in message:
+    try:
+      metric, datapoint = entry
+      if metric.__class__ in METRIC_TYPES:
+        datapoints.append((metric, (float(datapoint[0]), float(datapoint[1]))))
+    except (TypeError, ValueError, OverflowError, IndexError, KeyError):
+      continue
+  return datapoints
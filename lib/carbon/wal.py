@@ -0,0 +1,228 @@
+"""A write-ahead log of the datapoints stored in the MetricCache.
+
+Datapoints are buffered as they are stored and handed to a commit thread every
+WAL_SYNC_INTERVAL seconds, which appends the whole batch to the current segment
+file as one checksummed record and fsyncs it (a group commit). Segments are
+rotated once they reach WAL_SEGMENT_SIZE bytes or MAX_SEGMENT_AGE seconds, and
+a closed segment is deleted once every datapoint it holds has been written to
+whisper. At startup the segments left behind by the previous run are replayed
+into the cache.
+
+A datapoint is still unwritten while it is queued in the cache, held by the
+writer for the creator thread, or being written by a writer thread. Each of
+those places is a pin returning the earliest created time of the datapoints
+it holds, and closed segments are only deleted behind the earliest pin.
+
+Records are encoded with marshal, which is several times faster than pickle
+for lists of tuples. The segments are private to the process that wrote them
+and checksummed, so the usual concerns about marshal don't apply.
+"""
+
+import os
+import time
+import struct
+import marshal
+import threading
+from Queue import Queue
+from zlib import crc32
+
+from twisted.application.service import Service
+from twisted.internet.task import LoopingCall
+
+from carbon import log, instrumentation
+
+
+RECORD_HEADER = struct.Struct('!LL') # payload length, crc32 of the payload
+SEGMENT_SUFFIX = '.wal'
+MAX_SEGMENT_AGE = 60
+
+
+def listSegments(directory):
+  "Returns the (number, path) of every segment in directory, oldest first"
+  segments = []
+  for filename in os.listdir(directory):
+    name, suffix = os.path.splitext(filename)
+    if suffix == SEGMENT_SUFFIX and name.isdigit():
+      segments.append((int(name), os.path.join(directory, filename)))
+  return sorted(segments)
+
+
+def readSegment(path):
+  """Generates the batches of (metric, datapoint) logged to the segment at
+  path. A crash can leave the last record torn, reading stops at the first
+  record that is incomplete or fails its checksum."""
+  fh = open(path, 'rb')
+  try:
+    while True:
+      header = fh.read(RECORD_HEADER.size)
+      if not header:
+        return
+      if len(header) == RECORD_HEADER.size:
+        length, checksum = RECORD_HEADER.unpack(header)
+        payload = fh.read(length)
+        if len(payload) == length and crc32(payload) & 0xffffffff == checksum:
+          yield marshal.loads(payload)
+          continue
+      log.msg("WAL segment %s is torn or corrupt after %d bytes, ignoring the rest of it" %
+              (path, fh.tell()))
+      return
+  finally:
+    fh.close()
+
+
+class Segment(object):
+  def __init__(self, path):
+    self.path = path
+    self.fh = open(path, 'ab')
+    self.opened = time.time()
+    self.size = 0
+    self.closedAt = None
+
+
+class WriteAheadLog(Service):
+  """Logs the datapoints stored in cache to segment files in directory.
+  append() and sync() run in the reactor thread, the files are only touched
+  by the commit thread."""
+  def __init__(self, directory, cache, syncInterval=1.0, segmentSize=64 * 1024 * 1024):
+    self.directory = directory
+    self.cache = cache
+    self.syncInterval = syncInterval
+    self.segmentSize = segmentSize
+    self.buffer = []
+    self.pins = [ lambda: cache.oldestQueue()[0] ]
+    self.commits = Queue()
+    self.segment = None
+    self.closed = [] # closed segments, oldest first
+    self.superseded = [] # files to delete once their datapoints are logged
+    self.nextSegment = 0
+    self.syncTask = LoopingCall(self.sync)
+    self.thread = None
+
+  def addPin(self, pin):
+    """pin is called in the reactor thread and returns the earliest created
+    time of the unwritten datapoints held outside the cache, or None"""
+    self.pins.append(pin)
+
+  def append(self, metric, datapoint):
+    self.buffer.append((metric, datapoint))
+
+  def extend(self, datapoints):
+    self.buffer.extend(datapoints)
+
+  def replay(self, storeBatch):
+    """Calls storeBatch() with each batch of (metric, datapoint) logged by the
+    previous run. They get logged again as they are stored, the old segments
+    are deleted once that has been committed."""
+    if not os.path.isdir(self.directory):
+      os.makedirs(self.directory)
+      return
+
+    count, segments = 0, 0
+    for number, path in listSegments(self.directory):
+      for batch in readSegment(path):
+        storeBatch(batch)
+        count += len(batch)
+      self.supersede(path)
+      self.nextSegment = number + 1
+      segments += 1
+
+    if segments:
+      log.msg("replayed %d datapoints from %d WAL segments" % (count, segments))
+
+  def supersede(self, path):
+    """Deletes path once everything stored so far has been committed, it
+    must only be called before the service starts"""
+    self.superseded.append(path)
+
+  def removeSegments(self):
+    "Deletes every segment, it must only be called once the service has stopped"
+    for number, path in listSegments(self.directory):
+      self.removeSegment(path)
+
+  def lowWater(self):
+    "Returns the earliest created time of any unwritten datapoint"
+    # The cache has to be checked before the writers and the writers before
+    # the create queue, that's the order datapoints move through them in.
+    pinned = [ created for created in [ pin() for pin in self.pins ]
+               if created is not None ]
+    return min(pinned or [time.time()])
+
+  def sync(self):
+    "Hands the datapoints appended since the last sync to the commit thread"
+    batch, self.buffer = self.buffer, []
+    self.commits.put((time.time(), batch, self.lowWater()))
+
+  def commitForever(self):
+    while True:
+      commit = self.commits.get()
+      if commit is None:
+        break
+      try:
+        self.commit(*commit)
+      except:
+        log.err()
+
+  def commit(self, swapped, batch, lowWater):
+    """Appends batch to the current segment and fsyncs it, then rotates the
+    segment if it is due and deletes closed segments older than lowWater"""
+    if batch:
+      if self.segment is None:
+        self.openSegment()
+      started = time.time()
+      payload = marshal.dumps(batch)
+      fh = self.segment.fh
+      fh.write(RECORD_HEADER.pack(len(payload), crc32(payload) & 0xffffffff))
+      fh.write(payload)
+      fh.flush()
+      os.fsync(fh.fileno())
+      self.segment.size += RECORD_HEADER.size + len(payload)
+      instrumentation.observe('walSyncTimes', time.time() - started)
+      instrumentation.increment('walLoggedPoints', len(batch))
+
+    while self.superseded:
+      self.removeSegment(self.superseded.pop(0))
+
+    segment = self.segment
+    if segment is not None and (segment.size >= self.segmentSize or
+                                swapped - segment.opened >= MAX_SEGMENT_AGE):
+      self.closeSegment(swapped)
+
+    # Every datapoint in a segment was appended before it was closed
+    while self.closed and self.closed[0].closedAt < lowWater:
+      self.removeSegment(self.closed.pop(0).path)
+
+  def openSegment(self):
+    path = os.path.join(self.directory, '%016d%s' % (self.nextSegment, SEGMENT_SUFFIX))
+    self.nextSegment += 1
+    self.segment = Segment(path)
+
+  def closeSegment(self, closedAt):
+    self.segment.fh.close()
+    self.segment.closedAt = closedAt
+    self.closed.append(self.segment)
+    self.segment = None
+
+  def removeSegment(self, path):
+    try:
+      os.unlink(path)
+    except OSError:
+      log.err()
+
+  def startService(self):
+    if not os.path.isdir(self.directory):
+      os.makedirs(self.directory)
+    self.thread = threading.Thread(target=self.commitForever, name='WriteAheadLog')
+    self.thread.daemon = True
+    self.thread.start()
+    self.syncTask.start(self.syncInterval, now=False)
+    Service.startService(self)
+
+  def stopService(self):
+    if self.syncTask.running:
+      self.syncTask.stop()
+    self.sync()
+    self.commits.put(None)
+    self.thread.join()
+    if self.segment is not None:
+      self.segment.fh.close()
+    Service.stopService(self)
@@ -0,0 +1,393 @@
+"""Support for running carbon-cache as a pool of CACHE_WORKERS processes.
+
+Every worker binds the line, pickle and UDP receiver ports with SO_REUSEPORT
+so the kernel spreads incoming connections across the pool. Each metric is
+owned by exactly one worker, chosen by a stable hash of its name, and a worker
+hands off datapoints it does not own to the owner over a local pickle
+connection. That way every whisper file still has a single writer.
+
+Worker 0 is the process started by twistd. It spawns and supervises the other
+workers, is the only one listening on CACHE_QUERY_PORT (forwarding queries for
+metrics it does not own), and records instrumentation for the whole pool from
+the stats the other workers report to it.
+
+Handoffs are never dropped. While a handoff queue holds MAX_QUEUE_SIZE
+datapoints or more the worker pauses its receivers, and a worker whose cache
+is full stops reading handoffs, so a full cache anywhere in the pool
+eventually pauses the receivers of every worker handing off to it.
+"""
+
+import os
+import sys
+import socket
+from collections import deque
+from zlib import crc32
+
+from twisted.application.service import MultiService
+from twisted.application.internet import TCPServer, UDPServer
+from twisted.internet import reactor, tcp, udp
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.protocol import ProcessProtocol, ServerFactory, ReconnectingClientFactory
+from twisted.internet.task import LoopingCall
+from twisted.protocols.basic import Int32StringReceiver
+
+from carbon.cache import MetricCache
+from carbon.client import CarbonClientManager, CarbonClientFactory
+from carbon.conf import settings, WORKER_ENVIRONMENT_KEY
+from carbon.protocols import MetricPickleReceiver, CacheManagementHandler
+from carbon.routers import DatapointRouter
+from carbon.util import pickle, get_unpickler
+from carbon import log, instrumentation, events, state
+
+
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15) # 15 is the Linux value
+MASTER_ENVIRONMENT_KEY = 'CARBON_CACHE_MASTER_PID'
+
+
+def getWorkerId():
+  return int(os.environ.get(WORKER_ENVIRONMENT_KEY, 0))
+
+
+def workerFor(metric, workerCount):
+  "Stable across processes and restarts, unlike hash()"
+  return (crc32(metric) & 0xffffffff) % workerCount
+
+
+class ReusePortTCPPort(tcp.Port):
+  def createInternetSocket(self):
+    s = tcp.Port.createInternetSocket(self)
+    s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    return s
+
+
+class ReusePortUDPPort(udp.Port):
+  def createInternetSocket(self):
+    s = udp.Port.createInternetSocket(self)
+    s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    return s
+
+
+class ReusePortTCPServer(TCPServer):
+  "A TCPServer whose port can be bound by every worker at once"
+  def _getPort(self):
+    port, factory = self.args
+    p = ReusePortTCPPort(port, factory, reactor=reactor, **self.kwargs)
+    p.startListening()
+    return p
+
+
+class ReusePortUDPServer(UDPServer):
+  "A UDPServer whose port can be bound by every worker at once"
+  def _getPort(self):
+    port, protocol = self.args
+    p = ReusePortUDPPort(port, protocol, reactor=reactor, **self.kwargs)
+    p.startListening()
+    return p
+
+
+class WorkerRouter(DatapointRouter):
+  "Routes each metric to the handoff port of the worker that owns it"
+  def __init__(self, workerCount):
+    self.workerCount = workerCount
+    self.destinations = {} # { workerId : (host, port, instance) }
+
+  def addDestination(self, destination):
+    self.destinations[int(destination[2])] = destination
+
+  def removeDestination(self, destination):
+    self.destinations.pop(int(destination[2]), None)
+
+  def getDestinations(self, metric):
+    destination = self.destinations.get(workerFor(metric, self.workerCount))
+    if destination is not None:
+      yield destination
+
+
+class MetricHandoffReceiver(MetricPickleReceiver):
+  """Receives datapoints another worker has already accepted on our behalf,
+  plus the periodic stats reports sent to worker 0.
+
+  Handoffs are only paused while this worker's cache is full, not whenever
+  its receivers are: two workers whose handoff queues to each other had both
+  filled up would never read from each other again."""
+  def startFlowControl(self):
+    if not settings.USE_FLOW_CONTROL:
+      return
+    if state.cacheTooFull:
+      self.pauseReceiving()
+    events.cacheFull.addHandler(self.pauseReceiving)
+    events.cacheSpaceAvailable.addHandler(self.resumeReceiving)
+
+  def stopFlowControl(self):
+    events.cacheFull.removeHandler(self.pauseReceiving)
+    events.cacheSpaceAvailable.removeHandler(self.resumeReceiving)
+
+  def stringReceived(self, data):
+    try:
+      message = self.unpickler.loads(data)
+    except:
+      log.listener('invalid handoff received from %s, ignoring' % self.peerName)
+      return
+
+    if isinstance(message, dict):
+      instrumentation.mergeWorkerStats(message)
+      return
+
+    MetricCache.storeBatch(message)
+
+
+class HandoffClientFactory(CarbonClientFactory):
+  """Sends datapoints to the handoff port of the worker that owns them. The
+  queue is unbounded, reaching MAX_QUEUE_SIZE pauses this worker's receivers
+  through the pool instead of dropping datapoints."""
+  def __init__(self, destination, pool):
+    CarbonClientFactory.__init__(self, destination, 'pickle')
+    self.pool = pool
+
+  def sendDatapoint(self, metric, datapoint):
+    instrumentation.increment(self.attemptedRelays)
+    self.enqueue(metric, datapoint)
+    if self.queueSize >= settings.MAX_QUEUE_SIZE and not self.queueFull.called:
+      self.queueFull.callback(self.queueSize)
+
+    if self.connectedProtocol:
+      self.scheduleSend()
+    else:
+      instrumentation.increment(self.queuedUntilConnected)
+
+  def queueFullCallback(self, result):
+    log.clients('%s handoff queue is full (%d datapoints)' % (self, result))
+    self.pool.handoffFull(self.destination)
+
+  def queueSpaceAvailable(self):
+    self.pool.handoffHasSpace(self.destination)
+
+
+class HandoffClientManager(CarbonClientManager):
+  "Keeps a HandoffClientFactory connected to every other worker"
+  def __init__(self, pool):
+    # Handoffs carry stats reports too, which only the pickle protocol can
+    CarbonClientManager.__init__(self, pool.router, 'pickle', spill=False)
+    self.pool = pool
+
+  def createFactory(self, destination):
+    return HandoffClientFactory(destination, self.pool)
+
+
+class ForwardedQueryHandler(CacheManagementHandler):
+  """Answers the cache queries and set-metadata requests worker 0 forwards,
+  the queries were already counted there"""
+  instrumented = False
+
+
+class CacheQueryClientProtocol(Int32StringReceiver):
+  def connectionMade(self):
+    self.pending = deque()
+    self.unpickler = get_unpickler(insecure=settings.USE_INSECURE_UNPICKLER)
+    self.factory.connectedProtocol = self
+
+  def query(self, request):
+    d = Deferred()
+    self.pending.append(d)
+    self.sendString(pickle.dumps(request, protocol=-1))
+    return d
+
+  def stringReceived(self, data):
+    self.pending.popleft().callback(self.unpickler.loads(data))
+
+  def connectionLost(self, reason):
+    self.factory.connectedProtocol = None
+    while self.pending:
+      self.pending.popleft().errback(reason)
+
+
+class CacheQueryClientFactory(ReconnectingClientFactory):
+  "Persistent connection to the internal cache query port of another worker"
+  protocol = CacheQueryClientProtocol
+  maxDelay = 5
+  connectedProtocol = None
+
+  def query(self, request):
+    if self.connectedProtocol is None:
+      return succeed(dict(error="worker cache query port is not connected"))
+    return self.connectedProtocol.query(request)
+
+
+class WorkerProcessProtocol(ProcessProtocol):
+  "Logs a child worker's output and respawns it if it dies"
+  def __init__(self, pool, workerId):
+    self.pool = pool
+    self.workerId = workerId
+
+  def outReceived(self, data):
+    for line in data.splitlines():
+      log.msg("[worker %d] %s" % (self.workerId, line))
+
+  errReceived = outReceived
+
+  def processEnded(self, reason):
+    log.msg("cache worker %d exited: %s" % (self.workerId, reason.value))
+    self.pool.workerEnded(self.workerId)
+
+
+class WorkerPool(MultiService):
+  """Wires one carbon-cache process into a pool of workers: listens for
+  handoffs (and, on workers other than 0, forwarded cache queries) and keeps
+  client connections to every other worker."""
+  def __init__(self, options, workerCount, workerId):
+    MultiService.__init__(self)
+    self.options = options
+    self.workerCount = workerCount
+    self.workerId = workerId
+    self.primary = (workerId == 0)
+    self.processes = {} # { workerId : IProcessTransport }
+    self.queryClients = {} # { workerId : CacheQueryClientFactory }
+    self.fullHandoffs = set() # destinations whose handoff queue is full
+
+    factory = ServerFactory()
+    factory.protocol = MetricHandoffReceiver
+    service = TCPServer(self.handoffPort(workerId), factory, interface='127.0.0.1')
+    service.setServiceParent(self)
+
+    if not self.primary:
+      factory = ServerFactory()
+      factory.protocol = ForwardedQueryHandler
+      service = TCPServer(self.queryPort(workerId), factory, interface='127.0.0.1')
+      service.setServiceParent(self)
+      self.parentCheck = LoopingCall(self.checkParent)
+
+    self.router = WorkerRouter(workerCount)
+    self.client_manager = HandoffClientManager(self)
+    self.client_manager.setServiceParent(self)
+    for otherId in range(workerCount):
+      if otherId != workerId:
+        self.client_manager.startClient(self.handoffDestination(otherId))
+
+  def handoffPort(self, workerId):
+    return int(settings.WORKER_HANDOFF_PORT) + workerId
+
+  def queryPort(self, workerId):
+    return int(settings.WORKER_QUERY_PORT) + workerId
+
+  def handoffDestination(self, workerId):
+    return ('127.0.0.1', self.handoffPort(workerId), str(workerId))
+
+  def owns(self, metric):
+    return workerFor(metric, self.workerCount) == self.workerId
+
+  def store(self, metric, datapoint):
+    if self.owns(metric):
+      MetricCache.store(metric, datapoint)
+    else:
+      self.client_manager.sendDatapoint(metric, datapoint)
+
+  def storeBatch(self, batch):
+    owned = []
+    for (metric, datapoint) in batch:
+      if self.owns(metric):
+        owned.append((metric, datapoint))
+      else:
+        self.client_manager.sendDatapoint(metric, datapoint)
+    MetricCache.storeBatch(owned)
+
+  def handoffFull(self, destination):
+    "Pauses the receivers while any handoff queue is full"
+    if not self.fullHandoffs and settings.USE_FLOW_CONTROL:
+      events.pauseReceivingMetrics()
+    self.fullHandoffs.add(destination)
+    instrumentation.increment('handoffPauses')
+
+  def handoffHasSpace(self, destination):
+    self.fullHandoffs.discard(destination)
+    if not self.fullHandoffs and not state.cacheTooFull and settings.USE_FLOW_CONTROL:
+      events.resumeReceivingMetrics()
+
+  def handoffQueueSize(self):
+    return sum([ factory.queueSize for factory in self.client_manager.client_factories.values() ])
+
+  def cacheSpaceAvailable(self):
+    "Resumes the receivers paused by a full cache unless a handoff queue is full"
+    if not self.fullHandoffs:
+      events.resumeReceivingMetrics()
+
+  def queryOwner(self, request):
+    """Forwards a cache query or set-metadata request to the worker owning
+    request['metric']"""
+    ownerId = workerFor(request['metric'], self.workerCount)
+    return self.queryClients[ownerId].query(request)
+
+  def sendStats(self, stats, maxStats, gauges):
+    "Reports this worker's stats for the interval to worker 0"
+    factory = self.client_manager.client_factories.get(self.handoffDestination(0))
+    if factory is None or not getattr(factory.connectedProtocol, 'connected', False):
+      log.msg("cache worker 0 is not connected, dropping stats for this interval")
+      # Reported with the next interval's stats
+      instrumentation.increment('workerStatsDrops')
+      return
+    message = dict(worker=self.workerId, stats=stats, maxStats=list(maxStats), gauges=gauges)
+    factory.connectedProtocol.sendString(pickle.dumps(message, protocol=-1))
+
+  def startService(self):
+    MultiService.startService(self)
+    if self.primary:
+      for workerId in range(1, self.workerCount):
+        self.spawnWorker(workerId)
+        factory = self.queryClients[workerId] = CacheQueryClientFactory()
+        reactor.connectTCP('127.0.0.1', self.queryPort(workerId), factory)
+    else:
+      self.parentCheck.start(5, now=False)
+
+  def stopService(self):
+    if self.primary:
+      for process in self.processes.values():
+        try:
+          process.signalProcess('TERM')
+        except:
+          log.err()
+    elif self.parentCheck.running:
+      self.parentCheck.stop()
+    for factory in self.queryClients.values():
+      factory.stopTrying()
+    return MultiService.stopService(self)
+
+  def spawnWorker(self, workerId):
+    options = self.options
+    instance = options['instance']
+    pidfile = os.path.join(settings.PID_DIR, 'carbon-cache-%s-worker-%d.pid' % (instance, workerId))
+    args = [sys.executable, '-c', 'from twisted.scripts.twistd import run; run()',
+            '--nodaemon', '--no_save', '--pidfile', pidfile]
+    try:
+      from twisted.internet import epollreactor
+      args.append('--reactor=epoll')
+    except:
+      pass
+
+    args.extend(['carbon-cache', '--config', options['config'], '--instance', instance])
+    for name in ('whitelist', 'blacklist'):
+      if options.get(name):
+        args.extend(['--%s' % name, options[name]])
+    args.append('start')
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(sys.path)
+    env[WORKER_ENVIRONMENT_KEY] = str(workerId)
+    env[MASTER_ENVIRONMENT_KEY] = str(os.getpid())
+
+    log.msg("spawning cache worker %d" % workerId)
+    self.processes[workerId] = reactor.spawnProcess(
+      WorkerProcessProtocol(self, workerId), sys.executable, args, env)
+
+  def workerEnded(self, workerId):
+    self.processes.pop(workerId, None)
+    if self.running:
+      reactor.callLater(5, self.respawnWorker, workerId)
+
+  def respawnWorker(self, workerId):
+    if self.running and workerId not in self.processes:
+      self.spawnWorker(workerId)
+
+  def checkParent(self):
+    "Workers shut down if the process that spawned them goes away"
+    if str(os.getppid()) != os.environ.get(MASTER_ENVIRONMENT_KEY):
+      log.msg("cache worker 0 has exited, shutting down")
+      reactor.stop()
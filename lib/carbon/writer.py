@@ -15,14 +15,18 @@ limitations under the License."""
 
 import os
 import time
+from collections import OrderedDict
+from itertools import chain
 from os.path import exists, dirname
+from threading import Condition, Event, Lock
 
 import whisper
 from carbon import state
-from carbon.cache import MetricCache
-from carbon.storage import getFilesystemPath, loadStorageSchemas,\
-    loadAggregationSchemas
+from carbon.cache import MetricCache, DatapointQueue, writeSnapshot, readSnapshot
+from carbon.storage import getFilesystemPath, SchemaMatcher, MetricIndex,\
+    WhisperFileCache, invalidateWhisperFile
 from carbon.conf import settings
+from carbon.util import TokenBucket
 from carbon import log, events, instrumentation
 
 from twisted.internet import reactor
@@ -30,182 +34,621 @@ from twisted.internet.task import LoopingCall
 from twisted.application.service import Service
 
 
-lastCreateInterval = 0
-createCount = 0
-schemas = loadStorageSchemas()
-agg_schemas = loadAggregationSchemas()
-CACHE_SIZE_LOW_WATERMARK = settings.MAX_CACHE_SIZE * 0.95
+schemas = SchemaMatcher(settings.SCHEMA_CACHE_SIZE)
+knownMetrics = MetricIndex(settings.get('METRIC_INDEX_FILE'))
 
 
-def optimalWriteOrder():
-  """Generates metrics with the most cached values first and applies a soft
-  rate limit on new metrics"""
-  global lastCreateInterval
-  global createCount
-  metrics = MetricCache.counts()
+def makeUpdateBucket(updatesPerSecond):
+  if updatesPerSecond == float('inf'):
+    return None
+  return TokenBucket(max(1, settings.UPDATE_BURST_SIZE), updatesPerSecond)
 
-  t = time.time()
-  metrics.sort(key=lambda item: item[1], reverse=True)  # by queue size, descending
-  log.debug("Sorted %d cache queues in %.6f seconds" % (len(metrics),
-                                                        time.time() - t))
 
-  for metric, queueSize in metrics:
-    if state.cacheTooFull and MetricCache.size < CACHE_SIZE_LOW_WATERMARK:
-      events.cacheSpaceAvailable()
+# The update rate limit is shared by every writer thread
+updateBucket = makeUpdateBucket(settings.MAX_UPDATES_PER_SECOND)
+rateController = None # UpdateRateController when ADAPTIVE_UPDATE_RATE is on
 
-    dbFilePath = getFilesystemPath(metric)
-    dbFileExists = exists(dbFilePath)
 
-    if not dbFileExists:
-      createCount += 1
-      now = time.time()
+def throttleUpdates():
+  """Paces update operations to MAX_UPDATES_PER_SECOND across all writer
+  threads, allowing bursts of UPDATE_BURST_SIZE"""
+  bucket = updateBucket
+  if bucket is None or bucket.drain(1):
+    return
 
-      if now - lastCreateInterval >= 60:
-        lastCreateInterval = now
-        createCount = 1
+  throttleStart = time.time()
+  bucket.drain(1, blocking=True)
+  instrumentation.increment('throttledTime', time.time() - throttleStart)
 
-      elif createCount >= settings.MAX_CREATES_PER_MINUTE:
-        # dropping queued up datapoints for new metrics prevents filling up the entire cache
-        # when a bunch of new metrics are received.
+
+class UpdateRateController:
+  """Adjusts the rate updateBucket refills at, aiming to drain the cache as
+  fast as the disk allows without saturating it. Every interval the 90th
+  percentile update time is compared to targetLatency: when it is over, the
+  rate is halved, otherwise the rate goes up by a fixed step as long as the
+  cache isn't already shrinking (additive increase, multiplicative
+  decrease). The rate stays between minRate and maxRate."""
+  interval = 5
+  minRate = 10.0
+  decreaseFactor = 0.5
+
+  def __init__(self, maxRate, targetLatency):
+    self.maxRate = maxRate
+    self.targetLatency = targetLatency
+    if maxRate == float('inf'):
+      self.rate = 1000.0
+    else:
+      self.rate = float(maxRate)
+    self.step = max(1.0, self.rate / 20)
+    self.updateTimes = instrumentation.Histogram()
+    self.lock = Lock() # updateTimes is added to by every writer thread
+    self.lastCacheSize = MetricCache.size
+    self.task = LoopingCall(self.adjust)
+
+  def start(self):
+    global updateBucket
+    updateBucket = TokenBucket(max(1, settings.UPDATE_BURST_SIZE), self.rate)
+    self.task.start(self.interval, now=False)
+
+  def stop(self):
+    if self.task.running:
+      self.task.stop()
+
+  def observe(self, updateTime):
+    try:
+      self.lock.acquire()
+      self.updateTimes.add(updateTime)
+    finally:
+      self.lock.release()
+
+  def adjust(self):
+    try:
+      self.lock.acquire()
+      updateTimes, self.updateTimes = self.updateTimes, instrumentation.Histogram()
+    finally:
+      self.lock.release()
+    cacheSize = MetricCache.size
+    cacheGrowth = cacheSize - self.lastCacheSize
+    self.lastCacheSize = cacheSize
+    latency = updateTimes.percentile(0.9)
+
+    if latency > self.targetLatency and self.rate > self.minRate:
+      self.rate = max(self.minRate, self.rate * self.decreaseFactor)
+      instrumentation.increment('updateRateDecreases')
+    elif latency <= self.targetLatency and cacheSize and cacheGrowth >= 0 and self.rate < self.maxRate:
+      self.rate = min(self.maxRate, self.rate + self.step)
+      instrumentation.increment('updateRateIncreases')
+
+    updateBucket.setFillRate(self.rate)
+    instrumentation.max('updateRate', self.rate)
+
+
+class CreateQueue:
+  """Datapoints of the metrics waiting for the creator thread to create their
+  whisper files, in the order the metrics were first seen. Once a file has
+  been created its metric is ready and the datapoints wait for the reactor
+  thread to take() them back into the MetricCache. At most maxSize
+  datapoints are held, points that don't fit are dropped so a flood of new
+  metrics can't use up all the memory."""
+  def __init__(self, maxSize):
+    self.maxSize = maxSize
+    self.size = 0
+    self.pending = OrderedDict() # { metric : (created, datapoints) }
+    self.ready = {}
+    self.condition = Condition()
+
+  def __len__(self):
+    return len(self.pending) + len(self.ready)
+
+  def __contains__(self, metric):
+    return metric in self.pending or metric in self.ready
+
+  def hold(self, metric, datapoints, created):
+    """Adds datapoints taken from a cache queue created at created, returns
+    False if they were dropped"""
+    try:
+      self.condition.acquire()
+      if self.size + len(datapoints) > self.maxSize:
+        return False
+      entry = self.pending.get(metric) or self.ready.get(metric)
+      if entry is None:
+        self.pending[metric] = (created, list(datapoints))
+      else:
+        entry[1].extend(datapoints)
+      self.size += len(datapoints)
+      self.condition.notify()
+      return True
+    finally:
+      self.condition.release()
+
+  def next(self, timeout, ready=False):
+    """Waits up to timeout seconds for a metric to create, returns None if
+    there is none. With ready, metrics whose file was created are returned
+    too, ahead of the others."""
+    try:
+      self.condition.acquire()
+      if not self.pending and not (ready and self.ready):
+        self.condition.wait(timeout)
+      if ready:
+        for metric in self.ready:
+          return metric
+      for metric in self.pending:
+        return metric
+      return None
+    finally:
+      self.condition.release()
+
+  def markReady(self, metric):
+    try:
+      self.condition.acquire()
+      self.ready[metric] = self.pending.pop(metric)
+    finally:
+      self.condition.release()
+
+  def take(self, metric):
+    "Removes metric from the queue and returns its held datapoints"
+    try:
+      self.condition.acquire()
+      entry = self.ready.pop(metric, None) or self.pending.pop(metric)
+      self.size -= len(entry[1])
+      return entry[1]
+    finally:
+      self.condition.release()
+
+  def flush(self, metric, write):
+    """Calls write(metric, datapoints) with the metric's held datapoints and
+    removes them. The lock is held throughout, so a writer thread handing
+    over more datapoints waits and adds them as a new entry instead of
+    writing to the file at the same time."""
+    try:
+      self.condition.acquire()
+      entry = self.ready.pop(metric, None) or self.pending.pop(metric)
+      self.size -= len(entry[1])
+      write(metric, entry[1])
+    finally:
+      self.condition.release()
+
+  def held(self):
+    "Returns the (metric, datapoints) held in the queue"
+    try:
+      self.condition.acquire()
+      return [ (metric, list(entry[1])) for (metric, entry) in
+               self.pending.items() + self.ready.items() ]
+    finally:
+      self.condition.release()
+
+  def oldest(self):
+    "Returns the earliest created time of the held datapoints, or None"
+    try:
+      self.condition.acquire()
+      created = [ entry[0] for entry in self.pending.values() + self.ready.values() ]
+      return min(created or [None])
+    finally:
+      self.condition.release()
+
+
+createQueue = CreateQueue(settings.MAX_CREATE_QUEUE_SIZE)
+stopWriting = Event() # set on shutdown when CACHE_SNAPSHOT_ON_SHUTDOWN is on
+drainAll = Event() # set on shutdown otherwise, write deadlines no longer apply
+runningWriters = set() # partitions whose writeForever() hasn't returned
+
+if settings.MAX_CREATES_PER_MINUTE == float('inf'):
+  createBucket = None
+else:
+  createBucket = TokenBucket(settings.MAX_CREATES_PER_MINUTE, settings.MAX_CREATES_PER_MINUTE / 60.0)
+
+
+def writeDeadline(metric):
+  """Returns how many seconds the metric's datapoints may wait in the
+  MetricCache to be written together: WRITE_BATCH_INTERVALS intervals of its
+  finest archive, but no more than MAX_WRITE_DELAY. Metrics without a whisper
+  file are due at once so that it gets created.
+
+  The MetricCache calls this in the reactor thread when it creates a queue,
+  so only the in-memory index is checked and never the disk."""
+  if metric not in knownMetrics:
+    return 0
+  schema = schemas.match(metric)[0]
+  if schema is None:
+    return 0
+  step = min([ archive.secondsPerPoint for archive in schema.archives ])
+  return min(step * settings.WRITE_BATCH_INTERVALS, settings.MAX_WRITE_DELAY)
+
+
+def dueMetrics(cache, now):
+  """Returns the metrics in cache that are due to be written, in the order of
+  the CACHE_WRITE_STRATEGY. A metric is due once it has WRITE_BATCH_INTERVALS
+  datapoints queued or its oldest one reaches the writeDeadline(), which the
+  cache indexes its queues by so only the due ones are looked at."""
+  return cache.strategy.orderDue(cache.dueQueues(now))
+
+
+def optimalWriteOrder(cache=MetricCache):
+  """Generates metrics in the order chosen by the CACHE_WRITE_STRATEGY and
+  hands metrics without a whisper file over to the creator thread. cache is
+  the partition of the MetricCache owned by the calling writer thread.
+
+  With WRITE_BATCH_INTERVALS only the metrics that are due are written, as
+  found by the cache's deadline index. Deadlines are ignored while the cache
+  is running out of space and when draining it on shutdown.
+
+  Otherwise, while arrivals are tracked, a queue that has waited longer than
+  MAX_DATAPOINT_AGE is written ahead of the strategy's choice, checking once
+  a second, so that it can't keep the write-ahead log pinned forever."""
+  due = None
+  if MetricCache.deadline is not None and MetricCache.hasSpace() and not drainAll.isSet():
+    due = iter(dueMetrics(cache, time.time()))
+  nextAgeCheck = 0
+
+  while cache and not stopWriting.isSet():
+    if due is None:
+      metric = None
+      if time.time() >= nextAgeCheck:
+        metric = cache.overdueMetric(time.time() - settings.MAX_DATAPOINT_AGE)
+        if metric is None:
+          nextAgeCheck = time.time() + 1
+        else:
+          instrumentation.increment('overdueWrites')
+      if metric is None:
+        metric = cache.strategy.chooseItem()
+    else:
+      metric = next(due, None)
+    if metric is None:
+      break
+
+    if state.cacheTooFull and MetricCache.hasSpace():
+      events.cacheSpaceAvailable()
+
+    # Datapoints taken out of the cache keep the write-ahead log from being
+    # truncated until they are written, 0 covers the moment before we know
+    # how old they are
+    cache.inflight = 0
+    try:
+      if metric in createQueue or not knownMetrics.exists(metric):
         try:
-          MetricCache.pop(metric)
+          queue = cache.popQueue(metric)
         except KeyError:
-          pass
+          continue
 
+        # dropping queued up datapoints for new metrics prevents filling up memory
+        # when a bunch of new metrics are received.
+        if not createQueue.hold(metric, queue.datapoints(), queue.created):
+          instrumentation.increment('droppedCreates', len(queue))
         continue
 
-    try:  # metrics can momentarily disappear from the MetricCache due to the implementation of MetricCache.store()
-      datapoints = MetricCache.pop(metric)
-    except KeyError:
-      log.msg("MetricCache contention, skipping %s update for now" % metric)
-      continue  # we simply move on to the next metric when this race condition occurs
+      try:  # metrics can momentarily disappear from the MetricCache due to the implementation of MetricCache.store()
+        queue = cache.popQueue(metric)
+      except KeyError:
+        log.msg("MetricCache contention, skipping %s update for now" % metric)
+        continue  # we simply move on to the next metric when this race condition occurs
 
-    yield (metric, datapoints, dbFilePath, dbFileExists)
+      cache.inflight = queue.created
+      datapoints = queue.datapoints()
+      instrumentation.max('maxDatapointAge', time.time() - queue.created)
 
+      yield (metric, datapoints, getFilesystemPath(metric))
+    finally:
+      cache.inflight = None
 
-def writeCachedDataPoints():
-  "Write datapoints until the MetricCache is completely empty"
+
+def writeCachedDataPoints(cache=MetricCache, files=None):
+  """Write datapoints until the given part of the MetricCache is completely
+  empty, or has nothing due to be written, through the WhisperFileCache files
+  if one is given. Returns the number of update operations."""
   updates = 0
-  lastSecond = 0
+  while cache and not stopWriting.isSet():
+    passUpdates = updates
+    for (metric, datapoints, dbFilePath) in optimalWriteOrder(cache):
+      updates += 1
+      updateMetric(metric, datapoints, dbFilePath, files)
+
+    if updates == passUpdates:
+      break
 
-  while MetricCache:
-    dataWritten = False
+  return updates
 
-    for (metric, datapoints, dbFilePath, dbFileExists) in optimalWriteOrder():
-      dataWritten = True
 
-      if not dbFileExists:
-        archiveConfig = None
-        xFilesFactor, aggregationMethod = None, None
+def updateMetric(metric, datapoints, dbFilePath=None, files=None):
+  "Writes datapoints to the metric's whisper file, applying MAX_UPDATES_PER_SECOND"
+  if dbFilePath is None:
+    dbFilePath = getFilesystemPath(metric)
+  try:
+    t1 = time.time()
+    if files is None:
+      whisper.update_many(dbFilePath, datapoints)
+    else:
+      files.update_many(dbFilePath, datapoints)
+    t2 = time.time()
+    updateTime = t2 - t1
+  except:
+    log.msg("Error writing to %s" % (dbFilePath))
+    log.err()
+    instrumentation.increment('errors')
+    # The file may have been removed behind our back, if so it will be
+    # recreated the next time this metric is written
+    if not exists(dbFilePath):
+      knownMetrics.discard(metric)
+    return
 
-        for schema in schemas:
-          if schema.matches(metric):
-            log.creates('new metric %s matched schema %s' % (metric, schema.name))
-            archiveConfig = [archive.getTuple() for archive in schema.archives]
-            break
+  pointCount = len(datapoints)
+  instrumentation.increment('committedPoints', pointCount)
+  instrumentation.observe('updateTimes', updateTime)
+  controller = rateController
+  if controller is not None:
+    controller.observe(updateTime)
 
-        for schema in agg_schemas:
-          if schema.matches(metric):
-            log.creates('new metric %s matched aggregation schema %s' % (metric, schema.name))
-            xFilesFactor, aggregationMethod = schema.archives
-            break
+  if settings.LOG_UPDATES:
+    log.updates("wrote %d datapoints for %s in %.5f seconds" % (pointCount, metric, updateTime))
 
-        if not archiveConfig:
-          raise Exception("No storage schema matched the metric '%s', check your storage-schemas.conf file." % metric)
+  # Rate limit update operations
+  throttleUpdates()
 
-        dbDir = dirname(dbFilePath)
-        try:
-            os.makedirs(dbDir, 0755)
-        except OSError as e:
-            log.err("%s" % e)
-        log.creates("creating database file %s (archive=%s xff=%s agg=%s)" %
-                    (dbFilePath, archiveConfig, xFilesFactor, aggregationMethod))
-        whisper.create(dbFilePath, archiveConfig, xFilesFactor, aggregationMethod, settings.WHISPER_SPARSE_CREATE, settings.WHISPER_FALLOCATE_CREATE)
-        instrumentation.increment('creates')
 
+def createMetric(metric):
+  "Creates the whisper file for metric, applying MAX_CREATES_PER_MINUTE"
+  if knownMetrics.exists(metric):
+    return
+
+  if createBucket is not None:
+    createBucket.drain(1, blocking=True)
+
+  dbFilePath = getFilesystemPath(metric)
+  xFilesFactor, aggregationMethod = None, None
+  schema, aggSchema = schemas.match(metric)
+
+  if schema is None:
+    raise Exception("No storage schema matched the metric '%s', check your storage-schemas.conf file." % metric)
+
+  log.creates('new metric %s matched schema %s' % (metric, schema.name))
+  archiveConfig = [archive.getTuple() for archive in schema.archives]
+
+  if aggSchema is not None:
+    log.creates('new metric %s matched aggregation schema %s' % (metric, aggSchema.name))
+    xFilesFactor, aggregationMethod = aggSchema.archives
+
+  dbDir = dirname(dbFilePath)
+  try:
+      os.makedirs(dbDir, 0755)
+  except OSError as e:
+      log.err("%s" % e)
+  log.creates("creating database file %s (archive=%s xff=%s agg=%s)" %
+              (dbFilePath, archiveConfig, xFilesFactor, aggregationMethod))
+  whisper.create(dbFilePath, archiveConfig, xFilesFactor, aggregationMethod, settings.WHISPER_SPARSE_CREATE, settings.WHISPER_FALLOCATE_CREATE)
+  knownMetrics.add(metric)
+  invalidateWhisperFile(dbFilePath)
+  instrumentation.increment('creates')
+
+
+def createForever():
+  """Creates whisper files for the metrics in the createQueue so that slow
+  creates don't hold up the writer threads. Once a file exists its held
+  datapoints go back into the MetricCache for the writers to write, so each
+  file is still only ever updated by one thread."""
+  while reactor.running and not stopWriting.isSet():
+    metric = createQueue.next(timeout=1)
+    if metric is None or not createHeld(metric):
+      continue
+
+    # The cache is only ever stored into from the reactor thread, which also
+    # takes the datapoints so that they never go unaccounted for by the WAL
+    createQueue.markReady(metric)
+    reactor.callFromThread(restoreDatapoints, metric)
+
+  # Without a cache snapshot the writers drain the MetricCache while the
+  # reactor shuts down and nothing takes datapoints back into it, so the
+  # metrics they hand over are created and written here until they're done
+  if not stopWriting.isSet():
+    while runningWriters or len(createQueue):
+      metric = createQueue.next(timeout=1, ready=True)
+      if metric is not None and createHeld(metric):
+        createQueue.flush(metric, updateMetric)
+
+
+def createHeld(metric):
+  "Creates the file of a metric in the createQueue, dropping its datapoints on failure"
+  try:
+    createMetric(metric)
+    return True
+  except:
+    log.msg("Error creating %s" % metric)
+    log.err()
+    instrumentation.increment('errors')
+    createQueue.take(metric)
+    return False
+
+
+def restoreDatapoints(metric):
+  MetricCache.storeBatch([ (metric, datapoint) for datapoint in createQueue.take(metric) ])
+
+
+def writeForever(partition):
+  """Drains a MetricCachePartition for as long as the reactor runs. When the
+  partition is empty the writer blocks until a datapoint arrives and then
+  waits WRITE_BATCH_DELAY more, so a burst of datapoints is written together
+  rather than one update at a time."""
+  files = None
+  if settings.WHISPER_FILE_CACHE_SIZE:
+    files = WhisperFileCache(max(1, settings.WHISPER_FILE_CACHE_SIZE // len(MetricCache.partitions)))
+
+  runningWriters.add(partition)
+  try:
+    while reactor.running and not stopWriting.isSet():
       try:
-        t1 = time.time()
-        whisper.update_many(dbFilePath, datapoints)
-        t2 = time.time()
-        updateTime = t2 - t1
+        updates = writeCachedDataPoints(partition, files)
       except:
-        log.msg("Error writing to %s" % (dbFilePath))
         log.err()
-        instrumentation.increment('errors')
-      else:
-        pointCount = len(datapoints)
-        instrumentation.increment('committedPoints', pointCount)
-        instrumentation.append('updateTimes', updateTime)
+        time.sleep(1)  # Don't spin on persistent errors
+        continue
 
-        if settings.LOG_UPDATES:
-          log.updates("wrote %d datapoints for %s in %.5f seconds" % (pointCount, metric, updateTime))
+      # The timeout only lets us notice the reactor stopping
+      if not partition:
+        if partition.waitForData(timeout=1):
+          time.sleep(settings.WRITE_BATCH_DELAY)
+      elif not updates and settings.WRITE_BATCH_INTERVALS > 1:
+        time.sleep(1)  # Nothing is due to be written yet
 
-        # Rate limit update operations
-        thisSecond = int(t2)
+    # The reactor may have stopped while we were waiting
+    if drainAll.isSet():
+      writeCachedDataPoints(partition, files)
+  finally:
+    runningWriters.discard(partition)
 
-        if thisSecond != lastSecond:
-          lastSecond = thisSecond
-          updates = 0
-        else:
-          updates += 1
-          if updates >= settings.MAX_UPDATES_PER_SECOND:
-            time.sleep(int(t2 + 1) - t2)
+  if files is not None:
+    files.closeAll()
 
-    # Avoid churning CPU when only new metrics are in the cache
-    if not dataWritten:
-      time.sleep(0.1)
 
+def coalescingFor(metric):
+  """Returns the step MetricCache coalesces the metric's datapoints in, the
+  finest archive's precision. Only the last value in each interval is kept
+  whatever the aggregation method, the writer can pop the queue between two
+  datapoints of an interval and the later one overwrites the earlier on
+  disk."""
+  schema = schemas.match(metric)[0]
+  if schema is None:
+    return 0
+  return min([ archive.secondsPerPoint for archive in schema.archives ])
 
-def writeForever():
-  while reactor.running:
-    try:
-      writeCachedDataPoints()
-    except:
-      log.err()
 
-    time.sleep(1)  # The writer thread only sleeps when the cache is empty or an error occurs
+def reloadSchemas():
+  try:
+    if schemas.reload():
+      log.msg("Reloaded storage and aggregation schemas")
+  except:
+    log.msg("Failed to reload storage and aggregation schemas")
+    log.err()
 
 
-def reloadStorageSchemas():
-  global schemas
+def loadMetricIndex():
+  "Fills the index of existing whisper files, from its last save if possible"
   try:
-    schemas = loadStorageSchemas()
+    if knownMetrics.path and exists(knownMetrics.path):
+      knownMetrics.load()
+      log.msg("Loaded %d known metrics from %s" % (len(knownMetrics), knownMetrics.path))
+    else:
+      knownMetrics.scan(settings.LOCAL_DATA_DIR)
+      log.msg("Found %d known metrics in %s" % (len(knownMetrics), settings.LOCAL_DATA_DIR))
+      saveMetricIndex()
   except:
-    log.msg("Failed to reload storage schemas")
+    log.msg("Failed to load the index of known metrics")
     log.err()
 
 
-def reloadAggregationSchemas():
-  global agg_schemas
+def saveMetricIndex():
+  if not knownMetrics.path:
+    return
   try:
-    agg_schemas = loadAggregationSchemas()
+    knownMetrics.save()
   except:
-    log.msg("Failed to reload aggregation schemas")
+    log.msg("Failed to save the index of known metrics to %s" % knownMetrics.path)
     log.err()
 
 
 def shutdownModifyUpdateSpeed():
+    global updateBucket
+    drainAll.set()
     try:
+        if rateController is not None:
+            rateController.stop()
         settings.MAX_UPDATES_PER_SECOND = settings.MAX_UPDATES_PER_SECOND_ON_SHUTDOWN
+        updateBucket = makeUpdateBucket(settings.MAX_UPDATES_PER_SECOND)
         log.msg("Carbon shutting down.  Changed the update rate to: " + str(settings.MAX_UPDATES_PER_SECOND_ON_SHUTDOWN))
     except KeyError:
         log.msg("Carbon shutting down.  Update rate not changed")
 
 
+def saveCacheSnapshot():
+  """Saves everything not yet written, the MetricCache and the datapoints
+  held for the creator thread, to CACHE_SNAPSHOT_FILE. Runs after shutdown
+  once the writer threads have stopped."""
+  started = time.time()
+  held = []
+  for (metric, datapoints) in createQueue.held():
+    queue = DatapointQueue()
+    for datapoint in datapoints:
+      queue.append(datapoint)
+    held.append((metric, queue))
+
+  path = settings.CACHE_SNAPSHOT_FILE
+  try:
+    writeSnapshot(path, chain(MetricCache.queues(), held))
+  except:
+    log.msg("Failed to save the cache snapshot to %s" % path)
+    log.err()
+    return
+
+  log.msg("Saved %d datapoints to cache snapshot %s in %.2f seconds" %
+          (MetricCache.size + createQueue.size, path, time.time() - started))
+
+  # The snapshot holds everything the write-ahead log would replay
+  if MetricCache.wal is not None:
+    MetricCache.wal.removeSegments()
+
+
+def loadCacheSnapshot(storeBatch):
+  """Calls storeBatch() with each metric's datapoints in the snapshot saved
+  at the last shutdown, before anything is received"""
+  path = settings.CACHE_SNAPSHOT_FILE
+  if not exists(path):
+    return
+
+  started = time.time()
+  count = 0
+  try:
+    for (metric, datapoints) in readSnapshot(path):
+      batch = [ (metric, datapoint) for datapoint in datapoints ]
+      storeBatch(batch)
+      count += len(batch)
+  except:
+    log.msg("Failed to load the cache snapshot %s, moving it aside" % path)
+    log.err()
+    os.rename(path, path + '.bad')
+    return
+
+  log.msg("Loaded %d datapoints from cache snapshot %s in %.2f seconds" %
+          (count, path, time.time() - started))
+
+  # With a write-ahead log the snapshot is kept until its datapoints are logged
+  if MetricCache.wal is not None:
+    MetricCache.wal.supersede(path)
+  else:
+    os.unlink(path)
+
+
 class WriterService(Service):
 
     def __init__(self):
-        self.storage_reload_task = LoopingCall(reloadStorageSchemas)
-        self.aggregation_reload_task = LoopingCall(reloadAggregationSchemas)
+        self.schema_reload_task = LoopingCall(reloadSchemas)
 
     def startService(self):
-        self.storage_reload_task.start(60, False)
-        self.aggregation_reload_task.start(60, False)
-        reactor.addSystemEventTrigger('before', 'shutdown', shutdownModifyUpdateSpeed)
-        reactor.callInThread(writeForever)
+        global rateController
+        self.schema_reload_task.start(60, False)
+        if settings.ADAPTIVE_UPDATE_RATE:
+            rateController = UpdateRateController(settings.MAX_UPDATES_PER_SECOND,
+                                                  settings.TARGET_UPDATE_LATENCY)
+            rateController.start()
+        if settings.CACHE_SNAPSHOT_ON_SHUTDOWN:
+            # Writers finish their current update and the reactor's thread
+            # pool joins them during shutdown, leaving the cache to save
+            reactor.addSystemEventTrigger('before', 'shutdown', stopWriting.set)
+            reactor.addSystemEventTrigger('after', 'shutdown', saveCacheSnapshot)
+        else:
+            reactor.addSystemEventTrigger('before', 'shutdown', shutdownModifyUpdateSpeed)
+        # Each writer thread drains its own partition of the cache, so no
+        # whisper file is ever updated by two threads at once.
+        reactor.suggestThreadPoolSize(12 + len(MetricCache.partitions))
+        reactor.callInThread(loadMetricIndex)
+        reactor.callInThread(createForever)
+        if MetricCache.wal is not None:
+          for partition in MetricCache.partitions:
+            MetricCache.wal.addPin(lambda partition=partition: partition.inflight)
+          MetricCache.wal.addPin(createQueue.oldest)
+        for partition in MetricCache.partitions:
+          reactor.callInThread(writeForever, partition)
         Service.startService(self)
 
     def stopService(self):
-        self.storage_reload_task.stop()
-        self.aggregation_reload_task.stop()
+        self.schema_reload_task.stop()
+        if rateController is not None:
+            rateController.stop()
+        saveMetricIndex()
         Service.stopService(self)